@@ -1,11 +1,17 @@
-from flaskr import pages
+from flaskr import instrumentation, pages
 
 from flaskr.backend import Backend
 
+from flaskr.blobstore import configure_storage, shared_client
+
+from flaskr.instrumentation import InstrumentedClient
+
 from flask import Flask
 
 from flask_login import LoginManager
 
+import atexit
+
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
@@ -36,6 +42,50 @@ def create_app(test_config=None):
 
     # TODO(Project 1): Make additional modifications here for logging in, backends
     # and additional endpoints.
-    backend = Backend()
+    # STORAGE_BACKEND picks where the wiki is stored: 'gcs' (the default), 'local'
+    # (a directory given by STORAGE_ROOT) or 'memory'.
+    # PAGE_FETCH_WORKERS caps how many wiki pages are downloaded at the same time, and
+    # VOTE_FLUSH_INTERVAL is how many seconds the votes on a page are collected before being written,
+    # and HISTORY_FLUSH_INTERVAL how many seconds the pages viewed by users are. USER_CACHE_TTL is
+    # how many seconds a signed in user is trusted before their account is read again.
+    # MAX_UPLOAD_BYTES is the largest file that can be uploaded as a wiki page. RECORD_CODEC is how page
+    # files and accounts are written, 'json' or 'binary'; either is read, so switch to 'binary' once every
+    # server runs a version that can read it.
+    storage_backend = app.config.get('STORAGE_BACKEND', 'gcs')
+    options = {
+        'max_workers':
+            app.config.get('PAGE_FETCH_WORKERS', 8),
+        'vote_flush_interval':
+            app.config.get('VOTE_FLUSH_INTERVAL', 0.5),
+        'history_flush_interval':
+            app.config.get('HISTORY_FLUSH_INTERVAL', 5),
+        'user_cache_ttl':
+            app.config.get('USER_CACHE_TTL', 60),
+        'max_upload_bytes':
+            app.config.get('MAX_UPLOAD_BYTES', 10 * 1024 * 1024),
+        'record_codec':
+            app.config.get('RECORD_CODEC', 'json'),
+    }
+    # Requests far larger than any allowed upload are turned down before their body is read.
+    app.config.setdefault('MAX_CONTENT_LENGTH',
+                          options['max_upload_bytes'] + 1024 * 1024)
+    # The storage client is shared by the whole process, so its connections are reused by every request.
+    # It is wrapped so the storage operations of each request are counted and logged.
+    # Users made without a bucket get theirs from the same storage as the backend.
+    configure_storage(storage_backend, app.config.get('STORAGE_ROOT'))
+    storage_client = InstrumentedClient(shared_client())
+    backend = Backend(storage_client=storage_client, **options)
+    instrumentation.init_app(app)
+
+    # Votes and views still waiting to be written are not lost when the server stops.
+    atexit.register(backend.votes.flush)
+    atexit.register(backend.history.flush)
     pages.make_endpoints(app, backend)
+
+    @app.cli.command('compress-pages')
+    def compress_pages():
+        '''Compresses the wiki pages stored before pages were compressed'''
+        count, before, after = backend.compress_pages()
+        print(f'Compressed {count} pages from {before} to {after} bytes')
+
     return app
@@ -0,0 +1,156 @@
+'''
+Storage of the user accounts, split into separately stored parts.
+
+Contains the AccountStore class. A user's account used to be a single object holding their password hash
+next to their bio, profile picture, uploads and 100 last viewed pages, so every change rewrote all of it
+and signing in downloaded all of it. Each part is now an object of its own, read and written on its own.
+'''
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from flaskr.records import JsonCodec, decode_record
+
+# The fields of each part of an account, in the order get_user_account returns them.
+ACCOUNT_PARTS = {
+    'credentials': ('hashed_password', 'account_creation'),
+    'uploads': ('wikis_uploaded',),
+    'history': ('wiki_history',),
+    'profile': ('pfp_filename', 'about_me'),
+}
+
+# The value of each field for an account that does not have it yet.
+ACCOUNT_DEFAULTS = {
+    'wikis_uploaded': [],
+    'wiki_history': [],
+    'pfp_filename': None,
+    'about_me': '',
+}
+
+
+def check_username(username):
+    ''' Raises ValueError if a username can not be given to an account.
+        The credentials are stored under the username itself, next to the other parts of the accounts and the
+        profile pictures, so a username must not be a name those objects can take.
+    '''
+    if not username.isprintable():
+        raise ValueError('Usernames can not contain control characters')
+    if '/' in username or username.startswith('_'):
+        raise ValueError("Usernames can not contain '/' or start with '_'")
+    if username.endswith('.jpg'):
+        raise ValueError("Usernames can not end with '.jpg'")
+
+
+def part_blob_name(username, part):
+    ''' Returns the name of the object storing a part of an account.
+        The credentials keep the name the whole account used to have, so existing accounts can sign in.
+        Example : ('user1', 'profile') -> '_profile/user1.json'
+    '''
+    if part == 'credentials':
+        return username
+    return f'_{part}/{username}.json'
+
+
+class AccountStore:
+    '''
+    Reads and writes the parts of the user accounts: credentials, uploads, history and profile.
+
+    Accounts created before the split are a single object under the username, which is read as their
+    credentials. Their other parts are taken from that object until the part is first written.
+
+    Attributes:
+        bucket = The users bucket.
+        max_attempts = How many times a conflicting update is retried before giving up.
+        codec = The codec the parts are written with. Parts written by any codec are read.
+    '''
+
+    def __init__(self, bucket, max_attempts=5, codec=None):
+        '''Initializes an AccountStore object'''
+        self.bucket = bucket
+        self.max_attempts = max_attempts
+        self.codec = JsonCodec() if codec is None else codec
+
+    def _download(self, name):
+        ''' Returns a stored dictionary along with its generation.
+            Raises NotFound if there is no such object.
+        '''
+        blob = self.bucket.blob(name)
+        return decode_record(blob.download_as_string()), blob.generation
+
+    def _read(self, username, part):
+        ''' Returns the fields of a part of an account along with the part's generation (0 if the part
+            was never written), or (None, 0) if there is no such account.
+        '''
+        try:
+            stored, generation = self._download(part_blob_name(username, part))
+        except NotFound:
+            if part == 'credentials':
+                return None, 0
+            # Accounts created before the split keep every field with their credentials.
+            try:
+                stored, _ = self._download(
+                    part_blob_name(username, 'credentials'))
+            except NotFound:
+                return None, 0
+            generation = 0
+        if stored is None:
+            return None, 0
+        return {
+            field: stored.get(field, ACCOUNT_DEFAULTS.get(field))
+            for field in ACCOUNT_PARTS[part]
+        }, generation
+
+    def read(self, username, part):
+        '''Returns the fields of a part of an account, or None if there is no such account'''
+        return self._read(username, part)[0]
+
+    def read_all(self, username):
+        '''Returns every field of an account, or None if there is no such account'''
+        account = self.read(username, 'credentials')
+        if account is None:
+            return None
+        for part in ('uploads', 'history', 'profile'):
+            account.update(self.read(username, part) or {})
+        return account
+
+    def write(self, username, part, fields, if_generation_match=None):
+        ''' Stores a part of an account.
+            fields : Dictionary holding the part's fields.
+            if_generation_match : If given, only store the part if its generation still matches this one.
+        '''
+        preconditions = {}
+        if if_generation_match is not None:
+            preconditions['if_generation_match'] = if_generation_match
+        blob = self.bucket.blob(part_blob_name(username, part))
+        blob.upload_from_string(self.codec.encode(fields),
+                                content_type=self.codec.content_type,
+                                **preconditions)
+
+    def create(self, username, account):
+        ''' Stores every part of a new account.
+            account : Dictionary holding every field of the account.
+        '''
+        for part, fields in ACCOUNT_PARTS.items():
+            self.write(username, part,
+                       {field: account[field] for field in fields})
+
+    def update(self, username, part, change):
+        ''' Changes a part of an account, only accepting the write if nobody else changed the part since it
+            was read, and retrying otherwise. Returns the new fields of the part.
+            change : Function taking the part's fields and changing them in place.
+        '''
+        for attempt in range(self.max_attempts):
+            fields, generation = self._read(username, part)
+            if fields is None:
+                raise NotFound(f'No account named {username}')
+            change(fields)
+            try:
+                self.write(username,
+                           part,
+                           fields,
+                           if_generation_match=generation)
+                return fields
+            except PreconditionFailed:
+                # The part changed since we read it; read it again and retry.
+                continue
+        raise PreconditionFailed(
+            f'Could not update the {part} of {username} after {self.max_attempts} attempts'
+        )
@@ -0,0 +1,123 @@
+from flaskr.backend import Backend, User
+from flaskr.blobstore import Blob, LocalClient, MemoryClient
+from google.api_core.exceptions import NotFound
+from unittest.mock import patch
+import pytest
+import json
+
+
+@pytest.fixture
+def backend():
+    return Backend(storage_client=MemoryClient())
+
+
+def test_sign_in_only_reads_the_credentials(backend):
+    backend.sign_up('user1', 'password')
+    backend.update_bio('user1', 'I like parks')
+
+    with patch.object(Blob,
+                      'download_as_string',
+                      autospec=True,
+                      side_effect=Blob.download_as_string) as mock_download:
+        assert isinstance(backend.sign_in('user1', 'password'), User)
+        assert backend.sign_in('user1', 'wrong password') is None
+
+    assert {call.args[0].name for call in mock_download.call_args_list
+           } == {'user1'}
+    credentials = json.loads(
+        backend.user_bucket.blob('user1').download_as_string())
+    assert 'about_me' not in credentials
+
+
+def test_updates_only_write_their_own_part(backend):
+    backend.sign_up('user1', 'password')
+
+    with patch.object(Blob,
+                      'upload_from_string',
+                      autospec=True,
+                      side_effect=Blob.upload_from_string) as mock_upload:
+        backend.update_bio('user1', 'I like parks')
+        backend.update_wikiupload('user1', 'Park')
+        backend.update_wikihistory('user1', 'Lake')
+
+    assert [call.args[0].name for call in mock_upload.call_args_list] == [
+        '_profile/user1.json', '_uploads/user1.json', '_history/user1.json'
+    ]
+    account = backend.get_user_account('user1')
+    assert account['about_me'] == 'I like parks'
+    assert account['wikis_uploaded'] == ['Park']
+    assert account['wiki_history'] == ['Lake']
+
+
+def test_accounts_from_before_the_split_are_read(backend):
+    legacy_account = {
+        'hashed_password': 'fake',
+        'account_creation': '1111-11-11',
+        'wikis_uploaded': ['Park'],
+        'wiki_history': ['Lake'],
+        'pfp_filename': None,
+        'about_me': 'Old bio'
+    }
+    backend.user_bucket.blob('user1').upload_from_string(
+        json.dumps(legacy_account))
+
+    assert backend.get_user_account('user1') == legacy_account
+
+    # A part written since takes over from the field stored with the credentials.
+    backend.update_bio('user1', 'New bio')
+    account = backend.get_user_account('user1')
+    assert account['about_me'] == 'New bio'
+    assert account['wikis_uploaded'] == ['Park']
+
+
+def test_missing_account(backend):
+    assert backend.get_user_account('nobody') is None
+    with pytest.raises(NotFound):
+        backend.update_bio('nobody', 'bio')
+
+
+def test_loaded_users_are_cached(backend):
+    backend.sign_up('user1', 'password')
+
+    with patch.object(Blob,
+                      'download_as_bytes',
+                      autospec=True,
+                      side_effect=Blob.download_as_bytes) as mock_download:
+        credentials_reads = lambda: [
+            call for call in mock_download.call_args_list
+            if call.args[0].name == 'user1'
+        ]
+        for request in range(3):
+            assert backend.load_user('user1').username == 'user1'
+        assert len(credentials_reads()) == 1
+
+        # Changing the account forgets the cached user.
+        backend.update_bio('user1', 'I like parks')
+        backend.load_user('user1')
+        assert len(credentials_reads()) == 2
+
+    assert backend.load_user('nobody') is None
+
+
+def test_signing_up_forgets_the_missing_user(backend):
+    assert backend.load_user('user1') is None
+    backend.sign_up('user1', 'password')
+    assert backend.load_user('user1').username == 'user1'
+
+
+@pytest.mark.parametrize('storage', ['memory', 'local'])
+@pytest.mark.parametrize(
+    'username',
+    ['_profile', '_history/bob.json', '_pfp/bob/card.jpg', 'bob.jpg'])
+def test_usernames_can_not_name_other_objects(storage, username, tmp_path):
+    client = MemoryClient() if storage == 'memory' else LocalClient(
+        str(tmp_path))
+    backend = Backend(storage_client=client)
+
+    with pytest.raises(ValueError):
+        backend.sign_up(username, 'password')
+    assert backend.sign_in(username, 'password') is None
+
+    # Nothing was stored in the way of other accounts.
+    assert isinstance(backend.sign_up('bob', 'password'), User)
+    assert isinstance(backend.sign_in('bob', 'password'), User)
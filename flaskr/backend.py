@@ -5,12 +5,40 @@ Contains two classes: The User and the Backend class
 which define how the application interacts with the storage system.
 '''
 
-from google.cloud import storage
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from flaskr.accounts import AccountStore, check_username
+from flaskr.blobstore import shared_bucket, shared_client
+from flaskr.cache import BlobCache, TTLCache
+from flaskr.comments import CommentLog
+from flaskr.compression import COMPRESS_MIN_BYTES, compress, compress_file, decompress, is_compressed
+from flaskr.catalog import PageCatalog, summarize
+from flaskr.history import HistoryBuffer, merge_views
+from flaskr.records import decode_record, get_codec
+from flaskr.search import ContentIndex, TitleIndex, count_words
+from flaskr.snapshot import CorpusSnapshot
+from flaskr.sorting import SortIndex
+from flaskr.thumbnails import PICTURE_SIZES, make_thumbnails, variant_blob_name
+from flaskr.votes import VoteAggregator, Voters, copy_votes, decode_votes, encode_votes
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import contextvars
+import functools
 import hashlib
 import base64
+import codecs
 import hashlib
 import json
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# How many bytes of an uploaded file are read, decoded and written at a time. GCS uploads in multiples of 256 KiB.
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+# Page files smaller than this are assembled in memory, larger ones in a temporary file on disk.
+UPLOAD_SPOOL_SIZE = 4 * UPLOAD_CHUNK_SIZE
 
 
 class User:
@@ -22,18 +50,19 @@ class User:
 
     Attributes:
         username = The name, as a str, of the user as it was entered when they signed up.
-        client = An instance of a google cloud storage client.
-        bucket = An instance of the user information GCS bucket storing all our users profile information. 
+        bucket = The bucket storing all our users profile information. It is the 'wiki_login' bucket of the
+            process's default storage, as picked by blobstore.configure_storage, when none is given.
         is_authenticated = States, through a boolean, if the current user has provided valid credentials.
         is_active = States, through a boolean, if the current user is the one holding a session and interacting with the client.
         is_anonymous = States, through a boolean, if the current user's profile information is unknown.
     '''
 
-    def __init__(self, username):
+    def __init__(self, username, bucket=None):
         '''Initializes a User object'''
         self.username = username
-        self.client = storage.Client()
-        self.bucket = self.client.bucket('wiki_login')
+        if bucket is None:
+            bucket = shared_bucket('wiki_login')
+        self.bucket = bucket
         self.is_authenticated = True
         self.is_active = True
         self.is_anonymous = False
@@ -52,16 +81,17 @@ class User:
         return self.username
 
     @staticmethod
-    def get(username):
+    def get(username, bucket=None):
         '''
         This method tries to find a user with the associated username in our users bucket,
         and returns a Username object with its information.
         username: The backend will check if there is a profile under the name of this username.
+        bucket: The users bucket to search in. Defaults to the 'wiki_login' bucket of the default storage.
         '''
-        user = User(username)
+        user = User(username, bucket)
         try:
             user.load()
-            return User(username)
+            return user
         except:
             return None
 
@@ -75,74 +105,339 @@ class Backend:
     reading, and writing from GCS buckets blobs.
 
     Attributes:
-        storage_client = An instance of a google cloud storage client.
+        storage_client = An instance of a google cloud storage client, or of any client from flaskr.blobstore
+            (in-memory or local directory) since they all share the same interface. Defaults to the client of the
+            process's default storage, as picked by blobstore.configure_storage.
         info_bucket_name = Specifies the name of the GCS bucket containing the wiki project's wiki page text files.
         user_bucket_name = Specifies the name of teh GCS bucket containing the login credentials of the wiki project users.
+        catalog = The catalog holding a summary row (name, votes, date, author and size) of every wiki page.
+        content_index = The inverted index used to search the contents of the wiki pages.
+        title_index = The in-memory trigram index used to search the titles of the wiki pages.
+        sort_index = The page names kept sorted alphabetically and by creation date.
+        page_cache = The cache of recently read wiki page files.
+        votes_cache = The cache of recently read vote records , decoded , by name and generation.
+        image_cache = The cache of recently served images.
+        user_cache = The cache of recently verified users, so sessions do not read the users bucket on every request.
+        max_workers = How many wiki pages get_wiki_pages downloads at the same time.
+        snapshot_ttl = Seconds during which the same snapshot of the wiki is shared by every request.
+        votes = The buffer collecting the votes cast on each page until they are written together.
+        comments = The append-only log storing the comments posted on each page.
+        accounts = The store reading and writing each part of the user accounts separately.
+        history = The buffer collecting the pages viewed by each user until they are written to their account.
+        max_upload_bytes = The largest file , in bytes , that can be uploaded as a wiki page.
+        record_codec = The codec writing the page files and the user accounts ; see flaskr.records.
+            Records written by either codec are always readable.
     '''
 
     def __init__(self,
-                 storage_client=storage.Client(),
+                 storage_client=None,
                  info_bucket_name='wiki_info',
-                 user_bucket_name='wiki_login'):
+                 user_bucket_name='wiki_login',
+                 max_workers=8,
+                 snapshot_ttl=5,
+                 vote_flush_interval=0.5,
+                 history_flush_interval=5,
+                 user_cache_ttl=60,
+                 max_upload_bytes=10 * 1024 * 1024,
+                 record_codec='json'):
         '''
         Constructor for the Backend class. It provides its attributes with default values
         for mock injection purposes
         '''
+        # The client is shared by the whole process rather than created here, so its connections are reused.
+        if storage_client is None:
+            storage_client = shared_client()
         self.storage_client = storage_client
         self.info_bucket = self.storage_client.bucket(info_bucket_name)
         self.user_bucket = self.storage_client.bucket(user_bucket_name)
+        self.catalog = PageCatalog(self.info_bucket, self._summarize_all_pages)
+        self.content_index = ContentIndex(self.info_bucket, self._page_contents)
+        self.title_index = TitleIndex(self._list_page_titles)
+        self.sort_index = SortIndex(self.info_bucket, self._page_rows)
+        self.page_cache = BlobCache()
+        self.votes_cache = TTLCache(ttl=60)
+        self.image_cache = BlobCache(max_bytes=16 * 1024 * 1024, ttl=60)
+        self.user_cache = TTLCache(ttl=user_cache_ttl)
+        self.max_workers = max_workers
+        self.snapshot_ttl = snapshot_ttl
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
+        self.votes = VoteAggregator(self._write_votes,
+                                    vote_flush_interval,
+                                    after_flush=self._votes_written)
+        # Vote counts written to the vote records but not to the catalog yet , by page name.
+        self._unsaved_counts = {}
+        self._unsaved_counts_lock = threading.Lock()
+        self.comments = CommentLog(self.info_bucket)
+        self.record_codec = get_codec(record_codec)
+        self.accounts = AccountStore(self.user_bucket, codec=self.record_codec)
+        self.history = HistoryBuffer(self._apply_history,
+                                     history_flush_interval)
+        self.max_upload_bytes = max_upload_bytes
 
     def get_wiki_page(self, name):
         ''' Gets an uploaded page's metadata information from the content bucket as a dictionary.
             name : Name of the wiki page to be found and retrieved.
            '''
-        blob = self.info_bucket.blob(name)
-        name_data = json.loads((blob.download_as_string()), parse_constant=None)
+        name_data = self._get_page_document(name)
 
         # If we don't get anything, the wiki-page does not exist.
         if not name_data:
             return None
 
+        # The votes live in their own small record, so voting never rewrites the page file.
+        votes = self._get_cached_votes(name)
+        name_data.update(votes or decode_votes(name_data))
+
+        # Show the votes that are still waiting to be written, so users see their own vote right away.
+        for username, action_taken in self.votes.pending(name):
+            Backend._apply_vote(name_data, action_taken, username)
+
         return name_data
 
-    def get_all_page_names(self):
-        ''' Gets all the names and the rating of the pages uploaded to the wiki'''
+    def _get_page_document(self, name):
+        ''' Gets a page file as a dictionary, without the votes kept in its vote record.
+            name : Name of the wiki page's file, including the '.txt' extension.
+        '''
+        blob = self.info_bucket.blob(name)
 
-        # To 'display' the name of every wiki page, we will construct a list containing every wiki page's metadata stored in the backend.
-        page_names = []
+        # Popular pages are served from the cache as long as their generation did not change.
+        # Compressed pages are downloaded and cached as they are stored , and only decompressed here.
+        page_json = self.page_cache.read(
+            name, blob,
+            functools.partial(blob.download_as_string, raw_download=True))
+        return decode_record(decompress(page_json))
 
-        pages = self.storage_client.list_blobs(self.info_bucket)
+    @staticmethod
+    def _votes_blob_name(name):
+        ''' Returns the name of a page's vote record.
+            Example : 'Park.txt' -> '_votes/Park.json'
+        '''
+        return '_votes/' + name[:-len('.txt')] + '.json'
 
-        for page in pages:
-            # For each page, we will populate a dictionary containing each wiki page's information.
-            page_information = []
-            extension = page.name.find('.')
+    def _get_cached_votes(self, name):
+        ''' Returns a page's vote record, or None if it has none yet.
+            name : Name of the wiki page's file, including the '.txt' extension.
+        '''
+        votes_name = Backend._votes_blob_name(name)
+        blob = self.info_bucket.blob(votes_name)
+        try:
+            votes_json, generation = self.page_cache.read_with_generation(
+                votes_name, blob, blob.download_as_bytes)
+        except NotFound:
+            # Remember that there is no record, so the next views do not ask for it again.
+            self.page_cache.put(votes_name, b'', 0)
+            return None
+        if not votes_json:
+            return None
 
-            # We only want to retrieve information related to wiki page files, not any other type of file.
-            if page.name.endswith('.txt'):
-                page_metadata = Backend.get_wiki_page(self, page.name)
-                page_information.append(page.name[:extension])
-                page_information.append(page_metadata['upvotes'])
-                page_information.append(page_metadata['downvotes'])
-                page_names.append(page_information)
+        # A popular page's record is only decoded once per generation , and every view gets its own copy.
+        votes = self.votes_cache.get((votes_name, generation))
+        if votes is None:
+            votes = decode_votes(json.loads(votes_json))
+            self.votes_cache.put((votes_name, generation), votes)
+        return copy_votes(votes)
+
+    def _read_votes(self, name):
+        ''' Returns a page's vote record straight from storage, along with its generation.
+            Pages without a record yet get the votes stored in their page file, and generation 0.
+            name : Name of the wiki page's file, including the '.txt' extension.
+        '''
+        blob = self.info_bucket.blob(Backend._votes_blob_name(name))
+        try:
+            return decode_votes(json.loads(
+                blob.download_as_bytes())), blob.generation
+        except NotFound:
+            return decode_votes(self._get_page_document(name)), 0
+
+    def get_wiki_pages(self, names, max_workers=None):
+        ''' Gets the metadata of several uploaded pages at once, downloading them in parallel.
+            Returns a dictionary mapping each name to its metadata, or to None if that page could not be read.
+            Example : {'page1.txt': {...}, 'missing.txt': None}
+
+            Args :
+            names : Names of the wiki pages' files, including the '.txt' extension.
+            max_workers : How many pages are downloaded at the same time; self.max_workers by default.
+        '''
+        names = list(dict.fromkeys(names))
+        max_workers = min(max_workers or self.max_workers, len(names))
+
+        def fetch(name):
+            # A page failing to load must not prevent the others from being returned.
+            try:
+                return self.get_wiki_page(name)
+            except Exception:
+                logger.warning('Could not read wiki page %s',
+                               name,
+                               exc_info=True)
+                return None
+
+        # Nothing to gain from a thread pool when there is at most one page to fetch.
+        if max_workers <= 1:
+            return {name: fetch(name) for name in names}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Each page is fetched in a copy of the caller's context , so its download is counted along with the request asking for it.
+            futures = [
+                executor.submit(contextvars.copy_context().run, fetch, name)
+                for name in names
+            ]
+            return {
+                name: future.result() for name, future in zip(names, futures)
+            }
+
+    def snapshot(self):
+        ''' Returns a snapshot of every wiki page, taken at most snapshot_ttl seconds ago.
+            The listing, sorting, filtering and search methods all read from it, so the catalog is read once
+            and each page downloaded at most once for all of them.
+        '''
+        with self._snapshot_lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.age() >= self.snapshot_ttl:
+                snapshot = CorpusSnapshot(self._page_rows(),
+                                          self.get_wiki_pages)
+                self._snapshot = snapshot
+        return snapshot
+
+    def _page_rows(self):
+        '''Returns the catalog row of every wiki page'''
+
+        # Every wiki page has a summary row in the catalog, so a single read gives us all of them.
+        rows = self.catalog.rows()
+
+        # If the catalog was never built, build it once from the pages themselves.
+        if rows is None:
+            rows = self._summarize_all_pages()
+            self.catalog.save(rows)
+
+        return rows
+
+    def get_all_page_names(self, page_size=None, cursor=None):
+        ''' Gets all the names and the rating of the pages uploaded to the wiki
+            page_size : maximum number of pages to return , all of them by default
+            cursor : name of the last page of the previous results , to get the pages coming after it
+        '''
+        # The catalog rows are sorted by name , so a page of results is a slice of them and no page is read.
+        return self.snapshot().pages(page_size, cursor)
+
+    def _summarize_all_pages(self):
+        ''' Downloads every wiki page and returns its catalog row.
+            This is only needed to build the catalog when it does not exist yet.
+        '''
+        rows = []
+
+        # We only want to retrieve information related to wiki page files, not any other type of file.
+        pages = [
+            page for page in self.storage_client.list_blobs(self.info_bucket)
+            if page.name.endswith('.txt')
+        ]
+        pages_metadata = self.get_wiki_pages(page.name for page in pages)
 
-        return page_names
+        for page in pages:
+            page_metadata = pages_metadata[page.name]
+            if page_metadata:
+                rows.append(
+                    summarize(page.name[:-len('.txt')], page_metadata,
+                              page.size))
+
+        return rows
+
+    def _page_saved(self, name, page_metadata, size):
+        ''' Refreshes the catalog row of a wiki page whose json file was just written.
+            name : Name of the wiki page's file, including the '.txt' extension.
+            page_metadata : The page's metadata dictionary ; its content is not needed.
+            size : Size in bytes of the written file.
+        '''
+        row = summarize(name[:-len('.txt')], page_metadata, size)
+        self.catalog.put(row)
+
+        # The next request sees the change right away , without reading the whole catalog again.
+        snapshot = self._snapshot
+        if snapshot is not None:
+            snapshot.put(row)
+
+    def compress_pages(self):
+        ''' Compresses the page files stored uncompressed before pages were compressed.
+            Returns how many pages were compressed , along with their total size in bytes before and after.
+            A page changed or deleted while it is being compressed is skipped , and left for the next run.
+        '''
+        count, before, after = 0, 0, 0
+        for page in self.storage_client.list_blobs(self.info_bucket):
+            if (not page.name.endswith('.txt') or
+                    page.content_encoding == 'gzip' or
+                    page.size < COMPRESS_MIN_BYTES):
+                continue
+            try:
+                data = page.download_as_bytes(
+                    raw_download=True, if_generation_match=page.generation)
+                if is_compressed(data):
+                    continue
+                stored = compress(data)
+                blob = self.info_bucket.blob(page.name)
+                blob.content_encoding = 'gzip'
+                blob.upload_from_string(stored,
+                                        content_type=page.content_type,
+                                        if_generation_match=page.generation)
+            except (NotFound, PreconditionFailed):
+                continue
+            self.page_cache.invalidate(page.name)
+            self.catalog.update(page.name[:-len('.txt')], size=len(stored))
+            snapshot = self._snapshot
+            if snapshot is not None:
+                snapshot.update(page.name[:-len('.txt')], size=len(stored))
+            count, before, after = count + 1, before + len(data), after + len(
+                stored)
+        return count, before, after
+
+    @staticmethod
+    def _format_size(size):
+        ''' Returns a size in bytes as text , in MB if it is a whole number of them.
+            Example : 10485760 -> '10 MB' , 100000 -> '100,000 bytes'
+        '''
+        megabytes, rest = divmod(size, 1024 * 1024)
+        if megabytes and not rest:
+            return f'{megabytes} MB'
+        return f'{size:,} bytes'
+
+    def _read_upload(self, file):
+        ''' Yields the text of an uploaded file , decoded one chunk at a time.
+            Raises ValueError as soon as more than max_upload_bytes were read , or if the file is not UTF-8 text.
+            file : The uploaded file object.
+        '''
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        total = 0
+        while True:
+            chunk = file.read(UPLOAD_CHUNK_SIZE)
+            total += len(chunk)
+            if total > self.max_upload_bytes:
+                raise ValueError(
+                    f'The file is larger than {Backend._format_size(self.max_upload_bytes)}'
+                )
+            try:
+                # A character cut in two by the end of a chunk is kept by the decoder until the next one.
+                text = decoder.decode(chunk, final=not chunk)
+            except UnicodeDecodeError:
+                raise ValueError('The file is not UTF-8 text')
+            if text:
+                yield text
+            if not chunk:
+                return
 
     def upload(self, file, filename, author_name):
         ''' Adds data to the content bucket 
          file : path of the file 
          filename : name of the file user selected
          username: username of current user
+         Raises ValueError if the file is too large or is not UTF-8 text , in which case nothing is stored.
          '''
-        blob = self.info_bucket.blob(filename)
-
         date = datetime.today().strftime('%Y-%m-%d')
 
-        # Set up a dictionary containing all the wiki-page's metadata, which will then be converted to a JSON file to be stored.
+        # Set up a dictionary containing all the wiki-page's metadata, which will then be encoded to a file to be stored.
+        # The content is left out : it is written to the file as it is read , so it is never held whole in memory.
         metadata = {
             'wiki_page': filename,
             'author': author_name,
-            'content': file.read().decode('utf-8'),
+            'content': '',
             'date_created': date,
             'upvotes': 0,
             'who_upvoted': [],
@@ -150,14 +445,70 @@ class Backend:
             'who_downvoted': [],
             'comments': []
         }
-        metadata_json = json.dumps(metadata)
-        blob.upload_from_string(metadata_json, content_type='application/json')
+        with tempfile.SpooledTemporaryFile(
+                max_size=UPLOAD_SPOOL_SIZE) as document:
+            counts = count_words(
+                self.record_codec.stream(document, metadata, 'content',
+                                         self._read_upload(file)))
+
+            size = document.tell()
+            document.seek(0)
+            blob = self.info_bucket.blob(filename)
+            if size < COMPRESS_MIN_BYTES:
+                Backend._upload_document(blob, document, size,
+                                         self.record_codec.content_type)
+            else:
+                # Pages are mostly prose , so all but the smallest are stored compressed.
+                with compress_file(document, UPLOAD_CHUNK_SIZE,
+                                   UPLOAD_SPOOL_SIZE) as compressed:
+                    size = compressed.tell()
+                    compressed.seek(0)
+                    blob.content_encoding = 'gzip'
+                    Backend._upload_document(blob, compressed, size,
+                                             self.record_codec.content_type)
+
+        self.page_cache.invalidate(filename)
+        self._reset_votes(filename)
+        self._page_saved(filename, metadata, size)
+        self.content_index.add_counts(filename[:-len('.txt')], counts)
+        self.title_index.add(filename[:-len('.txt')])
+        self.sort_index.add(filename[:-len('.txt')], date)
+
+    @staticmethod
+    def _upload_document(blob, document, size, content_type):
+        ''' Uploads a page file assembled in a temporary file , positioned at its beginning.
+            Files kept in memory are sent in a single request. Larger ones were moved to disk , and are sent
+            chunk_size bytes at a time : GCS only sends a file in chunks when its size is not given , and reads
+            all of it into memory otherwise.
+        '''
+        if size <= UPLOAD_SPOOL_SIZE:
+            blob.upload_from_file(document,
+                                  size=size,
+                                  content_type=content_type)
+        else:
+            blob.chunk_size = UPLOAD_SPOOL_SIZE
+            blob.upload_from_file(document, content_type=content_type)
+
+    def _reset_votes(self, name):
+        ''' Deletes a page's vote record , so a page uploaded again starts without votes like its new file.
+            name : Name of the wiki page's file, including the '.txt' extension.
+        '''
+        votes_name = Backend._votes_blob_name(name)
+        try:
+            self.info_bucket.blob(votes_name).delete()
+        except NotFound:
+            pass
+        self.page_cache.invalidate(votes_name)
+        with self._unsaved_counts_lock:
+            self._unsaved_counts.pop(name[:-len('.txt')], None)
 
     def sign_up(self, username, password):
         ''' Adds data to the content bucket 
          username : user created username 
          password : user created password
+         Raises ValueError if the username can not be stored , such as one holding a line break or a '/'.
          '''
+        check_username(username)
 
         # Checks if blob exist with username and raise error if it does
         blob = self.user_bucket.get_blob(username)
@@ -168,9 +519,6 @@ class Backend:
         salted = f"{username}{'gamma'}{password}"
         hashed = hashlib.md5(salted.encode())
 
-        # Creates blob with username
-        blob = self.user_bucket.blob(username)
-
         # Get today's date in YYYY-MM-DD format.
         date = datetime.today().strftime('%Y-%m-%d')
 
@@ -184,29 +532,43 @@ class Backend:
             'about_me': '',
         }
 
-        # Convert it to a JSON file.
-        metadata_json = json.dumps(metadata)
+        # Save each part of the account to the GCS bucket, the credentials under the username.
+        self.accounts.create(username, metadata)
+        self.user_cache.invalidate(username)
+        return User(username, self.user_bucket)
 
-        # Save it to the GCS bucket.
-        blob.upload_from_string(metadata_json, content_type='application/json')
-        return User(username)
+    def load_user(self, username):
+        ''' Returns the User with the given username , or None if there is no such user.
+            Users found are cached for a while , so a session does not cost a read of the users bucket on every request.
+            username : The username stored in the session.
+        '''
+        user = self.user_cache.get(username)
+        if user is None:
+            user = User.get(username, self.user_bucket)
+            if user is not None:
+                self.user_cache.put(username, user)
+        return user
 
     def sign_in(self, username, password):
         '''Checks if the given username and password matches a user in our GCS bucket'''
-        if storage.Blob(bucket=self.user_bucket,
-                        name=username).exists(self.storage_client):
-            blob = self.user_bucket.blob(username)
+        # Names no account can have could be other objects of the users bucket.
+        try:
+            check_username(username)
+        except ValueError:
+            return None
 
+        # Only the credentials are read, not the rest of the account.
+        blob = self.user_bucket.blob(username)
+        if blob.exists(self.storage_client):
             # Get its content as a dictionary using the JSON API and returns none if doesn't exist
-            account_data = json.loads((blob.download_as_string()),
-                                      parse_constant=None)
+            account_data = decode_record(blob.download_as_string())
 
             salted = f"{username}{'gamma'}{password}"
             hashed_password = hashlib.md5(salted.encode()).hexdigest()
 
             # Takes password from GCS JSON
             if hashed_password == account_data['hashed_password']:
-                return User(username)
+                return User(username, self.user_bucket)
         return None
 
     def get_image(self, image_name, bucket_name):  # 2
@@ -223,9 +585,56 @@ class Backend:
             if image_data:
                 base64_image = base64.b64encode(image_data).decode('utf-8')
                 return base64_image
-        except FileNotFoundError:  #handling the not existing file
+        except (FileNotFoundError, NotFound):  #handling the not existing file
+            raise ValueError('Image Name does not exist in the bucket')
+
+    def read_image(self, image_name, bucket_name='wiki_info'):
+        ''' Gets an image's bytes along with its generation , which changes whenever the image is replaced.
+            Images are served from a cache as long as their generation did not change.
+            image_name : name of the image to be get from bucket
+            bucket_name : denotes which bucket to use
+        '''
+        bucket = self.info_bucket if bucket_name == 'wiki_info' else self.user_bucket
+        blob = bucket.blob(image_name)
+        try:
+            return self.image_cache.read_with_generation(
+                f'{bucket_name}/{image_name}', blob, blob.download_as_bytes)
+        except (FileNotFoundError, NotFound):  #handling the not existing file
             raise ValueError('Image Name does not exist in the bucket')
 
+    def open_profile_picture(self, username, size=None):
+        ''' Returns the blob of a user's profile picture , with its generation , size and content type loaded.
+            Raises ValueError if the user has no profile picture.
+            username : The user whose picture is wanted.
+            size : One of the PICTURE_SIZES ; the original picture is returned if it was not resized to it.
+        '''
+        profile = self.accounts.read(username, 'profile')
+        if not profile or not profile['pfp_filename']:
+            raise ValueError(f'{username} has no profile picture')
+        names = [profile['pfp_filename']]
+        if size in PICTURE_SIZES:
+            names.insert(0, variant_blob_name(username, size))
+        for name in names:
+            blob = self.user_bucket.blob(name)
+            try:
+                blob.reload()
+                return blob
+            except NotFound:
+                continue
+        raise ValueError('Image Name does not exist in the bucket')
+
+    @staticmethod
+    def stream_blob(blob, start=0, stop=None, chunk_size=256 * 1024):
+        ''' Yields the bytes of a blob from start (included) to stop (excluded) , chunk_size bytes at a time.
+            Every chunk is read from the blob's generation , so a blob replaced in the meantime is not mixed with the new one.
+            blob : A blob whose properties were loaded , such as one returned by open_profile_picture.
+        '''
+        stop = blob.size if stop is None else stop
+        for offset in range(start, stop, chunk_size):
+            yield blob.download_as_bytes(start=offset,
+                                         end=min(offset + chunk_size, stop) - 1,
+                                         if_generation_match=blob.generation)
+
     def title_content(self):
         ''' return dictionary with the page name , upvote , downvote in tuple as key and it's content in value if exists
             Otherwise , returns an empty dictionary 
@@ -233,20 +642,10 @@ class Backend:
         
             Args : Self
         '''
-        title_content = {}
-        page_info = self.get_all_page_names()
-        for page in page_info:
-            if tuple(page) not in title_content:
-                try:
-                    page_metadata = self.get_wiki_page(page[0] + '.txt')
-                    if page_metadata:
-                        content = page_metadata.get('content')
-                        title_content[tuple(page)] = content
-                except Exception as e:
-                    continue
-        return title_content
+        # The contents are downloaded once per snapshot, not once per call.
+        return self.snapshot().contents()
 
-    def search_by_title(self, query):
+    def search_by_title(self, query, fuzzy=False, limit=None, cursor=None):
         """  Returns list of list with page , upvotes and downvotes  if query found within the pages.
             Otherwise , return empty list
             Example : return Value -> [['page1',0,1]]
@@ -254,29 +653,69 @@ class Backend:
             Args : 
 
             query : text value obtained from search form 
+            fuzzy : if True , also match titles with up to two typos , closest matches first
+            limit : maximum number of pages to return , all of them by default
+            cursor : name of the last page of the previous results , to get the pages coming after it
         """
-        final_results = []
-        pages_info = self.get_all_page_names()
-        for page in pages_info:
-            if query.lower() in page[0].lower():
-                final_results.append(page)
-        return final_results
-
-    def search_by_content(self, query):
-        """  Returns list of  list with page name , upvote and downvote if query found in content
-             Otherwise , returns an empty list 
+        if fuzzy:
+            titles = self.title_index.fuzzy_search(
+                query, limit=limit if cursor is None else None)
+        else:
+            titles = self.title_index.search(query)
+        return self._with_ratings(self._after(titles, cursor)[:limit])
+
+    def _after(self, page_names, cursor):
+        ''' Returns the page names coming after the cursor in a list of results
+            page_names : the results , in order
+            cursor : name of the last page already shown , or None to start from the first result
+        '''
+        if cursor is None:
+            return page_names
+        if cursor not in page_names:
+            return []
+        return page_names[page_names.index(cursor) + 1:]
+
+    def _list_page_titles(self):
+        ''' Returns the title of every wiki page, taken from the names in the bucket listing.
+            Used to build the title index.
+        '''
+        return [
+            page.name[:-len('.txt')]
+            for page in self.storage_client.list_blobs(self.info_bucket)
+            if page.name.endswith('.txt')
+        ]
+
+    def _with_ratings(self, page_names):
+        ''' Returns [page name, upvotes, downvotes] lists for the given pages, in the same order.
+            page_names : Names of wiki pages, e.g. the results of a search.
+        '''
+        if not page_names:
+            return []
+
+        return self.snapshot().ratings(page_names)
+
+    def search_by_content(self, query, limit=None, cursor=None):
+        """  Returns list of  list with page name , upvote and downvote if every word of the query is found in content,
+             best matches first. Otherwise , returns an empty list 
              Example : query found->[['page1',0,1]] else->[]
 
             Args : 
             query : text value obtained from search form 
+            limit : maximum number of pages to return , all of them by default
+            cursor : name of the last page of the previous results , to get the pages coming after it
 
         """
-        final_results = []
-        pages_contents = self.title_content()
-        for page, page_content in pages_contents.items():
-            if query.lower() in page_content.lower():
-                final_results.append(list(page))
-        return final_results
+        # The index only looks at the pages containing the query's words, not at the whole wiki.
+        page_names = self.content_index.search(
+            query, limit if cursor is None else None)
+        return self._with_ratings(self._after(page_names, cursor)[:limit])
+
+    def _page_contents(self):
+        ''' Returns (page name, content) pairs for every wiki page.
+            This downloads every page, so it is only used to build the content index when it does not exist yet.
+        '''
+        return [(page[0], content)
+                for page, content in self.title_content().items()]
 
     def title_date(self):
         ''' Returns dictionary with tuple containing page name , upvote and downvote as key and date_created as value
@@ -286,56 +725,59 @@ class Backend:
             Args:
                 None 
         '''
-        pages_dates_created = {}
-        all_page_names = self.get_all_page_names()
-        for page in all_page_names:
-            if tuple(page) not in pages_dates_created:
-                page_metadata = self.get_wiki_page(page[0] + '.txt')
-                pages_dates_created[tuple(page)] = page_metadata['date_created']
-        return pages_dates_created
+        # The creation dates are part of the catalog rows, so no page has to be downloaded.
+        return self.snapshot().dates()
 
-    def sort_pages(self, user_option):
+    def sort_pages(self, user_option, page_size=None, cursor=None):
         ''' Returns list of list with page name , upvote and downvote  by sorting them according to the user_option 
             Args : 
                 user_option : option choosen by user 
                 possible options : Option 1 -> A TO Z 
                                    Option 2 -> Z TO A 
                                    Option 3 -> Latest To Previous 
+                page_size : maximum number of pages to return , all of them by default
+                cursor : name of the last page of the previous results , to get the pages coming after it
         '''
-        page_date_created = self.title_date()
-        if user_option == 'a_z':
-            sorted_pages = sorted(page_date_created, key=lambda x: x[0])
-        elif user_option == 'z_a':
-            sorted_pages = sorted(page_date_created,
-                                  key=lambda x: x[0],
-                                  reverse=True)
-        elif user_option == 'year':
-            sorted_pages = sorted(page_date_created,
-                                  key=lambda x: page_date_created[x],
-                                  reverse=True)
-        else:
+        orders = {'a_z': 'a_z', 'z_a': 'z_a', 'year': 'latest'}
+        if user_option not in orders:
             return []
-        final_results = []
-        for key in sorted_pages:
-            final_results.append(list(key))
-        return final_results
+
+        # The orderings are kept up to date on upload, so only the requested slice is read.
+        page_names = self.sort_index.page(orders[user_option], page_size,
+                                          cursor)
+        return self._with_ratings(page_names)
 
     def filter_by_year(self, input_date):
-        ''' Returns wiki pages with the proper content,
-            Ex: [[wiki_page1], [wiki_page2]]
+        ''' Returns list of list with page name , upvote and downvote of the pages created during a year ,
+            sorted by name
+            Ex: [['wiki_page1', 0, 1], ['wiki_page2', 2, 0]]
             
             Args:
-                date : date chosen by user
-        '''
-        page_date_created = self.title_date()
-        print(page_date_created)
-        final_results = []
-        for wiki in page_date_created:
-            date = page_date_created[wiki]
-            year = datetime.strptime(date, '%Y-%m-%d').year
-            if str(year) == input_date:
-                final_results.append(wiki)
-        return final_results
+                input_date : year chosen by user , such as '2022'
+        '''
+        return self._with_ratings(self.sort_index.by_year(str(input_date)))
+
+    def filter_by_dates(self, start_date, end_date):
+        ''' Returns list of list with page name , upvote and downvote of the pages created between two dates
+            included , from the latest to the oldest
+            Raises a ValueError if a date is not formatted as YYYY-MM-DD
+
+            Args:
+                start_date : earliest creation date chosen by user
+                end_date : latest creation date chosen by user
+        '''
+        # The index compares the dates as strings, so they must be zero-padded.
+        for date in (start_date, end_date):
+            if datetime.strptime(date, '%Y-%m-%d').strftime('%Y-%m-%d') != date:
+                raise ValueError(f'{date} is not formatted as YYYY-MM-DD')
+        return self._with_ratings(self.sort_index.between(start_date, end_date))
+
+    def year_counts(self):
+        ''' Returns dictionary with the number of pages created each year , from the latest year to the oldest
+            Example : {'2023': 4, '2021': 1}
+        '''
+        # The pages listing shows these along with its results , so they come from the same snapshot.
+        return self.snapshot().year_counts()
 
     def update_metadata_with_comments(self, page_name, current_user,
                                       user_comment):
@@ -349,165 +791,266 @@ class Backend:
         wiki_page_name = page_name + '.txt'
         page_metadata = self.get_wiki_page(wiki_page_name)
 
+        # The comment goes to the page's comment log, so the page file itself is never rewritten.
         if page_metadata:
-            page_metadata['comments'].append({current_user: user_comment})
-            updated_metadata_json = json.dumps(page_metadata)
-            blob = self.info_bucket.blob(wiki_page_name)
-            blob.upload_from_string(updated_metadata_json,
-                                    content_type='application/json')
-
-    def update_page(self, action_taken, username, page_name):
-        ''' Updates a wiki-page's json file in terms of
-            its vote count and comments section.
-            action_taken : The user action that triggered this method. E.g. Upvoted, downvoted,or posted a comment.
-            username : The name of the user that took the action.
-            page_name : The name of the wiki page that will be changed.  
+            self.comments.append(page_name, {current_user: user_comment},
+                                 page_metadata.get('comments', []))
+
+    def get_comments(self, page_name, limit=20, cursor=None, earlier=()):
+        ''' Returns the newest comments of a wiki page, oldest first, along with the cursor of the comments posted before them.
+            The cursor is None when there are no earlier comments.
+
+            Args :
+                page_name : name of the wiki_page , without the '.txt' extension
+                limit : maximum number of comments to return
+                cursor : cursor returned along with the comments shown previously ; the newest comments by default
+                earlier : the comments kept in the page's metadata , from before the page had a comment log
         '''
-        blob = self.info_bucket.blob(page_name)
+        return self.comments.page(page_name, limit, cursor, earlier)
 
-        # Get the current wiki_page's json file as a dictionary.
-        page_metadata = Backend.get_wiki_page(self, page_name)
+    @staticmethod
+    def _apply_vote(page_metadata, action_taken, username):
+        ''' Applies a user's vote to a wiki-page's metadata dictionary.
+            page_metadata : The page's metadata , changed in place.
+            action_taken : Either 'upvote' or 'downvote'.
+            username : The name of the user that voted.
+        '''
+        upvoters = Voters.decode(page_metadata['who_upvoted'])
+        downvoters = Voters.decode(page_metadata['who_downvoted'])
 
-        # If the user just upvoted this page, update the page's vote count in the dictionary.
+        # If the user just upvoted this page, their vote goes to the upvoters, and the other way around.
         if action_taken == 'upvote':
-            # If the user has already upvoted for this page, then remove his vote from the page's vote count.
-            if username in page_metadata['who_upvoted']:
-                page_metadata['upvotes'] -= 1
-                page_metadata['who_upvoted'].remove(username)
-
-            # Every user can only have one vote at a time for any wiki page.
-            elif username in page_metadata['who_downvoted']:
-                page_metadata['downvotes'] -= 1
-                page_metadata['who_downvoted'].remove(username)
-
-            # If it's the user's first time voting for this page, then simply add its
-            # vote to the upvote count of the wiki page.
-            else:
-                page_metadata['upvotes'] += 1
-                page_metadata['who_upvoted'].append(username)
-
-        # Do the same for when the user downvotes the  wiki page.
+            voted, other_side = upvoters, downvoters
         elif action_taken == 'downvote':
-            if username in page_metadata['who_downvoted']:
-                page_metadata['downvotes'] -= 1
-                page_metadata['who_downvoted'].remove(username)
+            voted, other_side = downvoters, upvoters
+        else:
+            return
 
-            elif username in page_metadata['who_upvoted']:
-                page_metadata['upvotes'] -= 1
-                page_metadata['who_upvoted'].remove(username)
+        # If the user has already voted this way, then remove their vote from the page's vote count.
+        if username in voted:
+            voted.discard(username)
 
-            else:
-                page_metadata['downvotes'] += 1
-                page_metadata['who_downvoted'].append(username)
+        # Every user can only have one vote at a time for any wiki page.
+        elif username in other_side:
+            other_side.discard(username)
+
+        # If it's the user's first time voting for this page, then simply add its vote.
+        else:
+            voted.add(username)
 
-        # Once we have changed our wiki page's metadata, overwrite its json file with the updated version.
-        blob.upload_from_string(json.dumps(page_metadata),
-                                content_type='application/json')
+        page_metadata['upvotes'] = len(upvoters)
+        page_metadata['who_upvoted'] = upvoters
+        page_metadata['downvotes'] = len(downvoters)
+        page_metadata['who_downvoted'] = downvoters
+
+    def update_page(self, action_taken, username, page_name):
+        ''' Updates a wiki-page's vote record in terms of its vote count.
+            action_taken : The user action that triggered this method. E.g. Upvoted or downvoted.
+            username : The name of the user that took the action.
+            page_name : The name of the wiki page that will be changed.  
+        '''
+        # Votes cast earlier must be written first, since votes are toggles applied in order.
+        self.votes.flush(page_name)
+        votes = self._apply_votes(page_name, [(username, action_taken)])
 
         # Returning the updated dictionary for testing purposes.
+        page_metadata = Backend.get_wiki_page(self, page_name)
+        page_metadata.update(votes)
         return page_metadata
 
+    def vote(self, action_taken, username, page_name):
+        ''' Records a user's vote on a wiki page. The votes cast on a page within votes.flush_interval seconds
+            are written together , so a popular page is not rewritten on every click.
+            action_taken : Either 'upvote' or 'downvote'.
+            username : The name of the user that voted.
+            page_name : The name of the wiki page's file , including the '.txt' extension.
+        '''
+        self.votes.add(page_name, username, action_taken)
+
+    def _apply_votes(self, page_name, votes):
+        ''' Writes a batch of votes to a wiki page's vote record and its catalog row, and returns the new record.
+            page_name : The name of the wiki page's file , including the '.txt' extension.
+            votes : List of (username , action_taken) tuples , in the order they were cast.
+        '''
+        record = self._write_votes(page_name, votes)
+        self._votes_written({page_name: record})
+        return record
+
+    def _write_votes(self, page_name, votes, max_attempts=5):
+        ''' Writes a batch of votes to a wiki page's vote record in a single update, and returns the new record.
+            The update only succeeds if nobody else changed the record since it was read , and is retried otherwise.
+            page_name : The name of the wiki page's file , including the '.txt' extension.
+            votes : List of (username , action_taken) tuples , in the order they were cast.
+        '''
+        votes_name = Backend._votes_blob_name(page_name)
+        for attempt in range(max_attempts):
+            record, generation = self._read_votes(page_name)
+            for username, action_taken in votes:
+                Backend._apply_vote(record, action_taken, username)
+
+            blob = self.info_bucket.blob(votes_name)
+            record_json = json.dumps(encode_votes(record))
+            try:
+                # Generation 0 means the record must not exist yet.
+                blob.upload_from_string(record_json,
+                                        content_type='application/json',
+                                        if_generation_match=generation)
+            except PreconditionFailed:
+                # The votes changed since we read them; read them again and retry.
+                continue
+
+            self.page_cache.put(votes_name, record_json, blob.generation)
+            self.votes_cache.put((votes_name, blob.generation),
+                                 copy_votes(record))
+            return record
+        raise PreconditionFailed(
+            f'Could not write {len(votes)} votes on {page_name} after {max_attempts} attempts'
+        )
+
+    def _votes_written(self, records):
+        ''' Copies the vote counts of the pages whose vote records were just written to the catalog , in a single write.
+            The vote records are what the pages show , so if the catalog can not be written its rows are only
+            out of date: their counts are kept and written along with the next votes.
+            records : Dictionary mapping the names of the wiki pages' files to their new vote records.
+        '''
+        with self._unsaved_counts_lock:
+            for page_name, record in records.items():
+                self._unsaved_counts[page_name[:-len('.txt')]] = {
+                    'upvotes': record['upvotes'],
+                    'downvotes': record['downvotes']
+                }
+            counts, self._unsaved_counts = self._unsaved_counts, {}
+
+        try:
+            self.catalog.update_many(counts)
+        except PreconditionFailed:
+            logger.warning(
+                'Could not write the votes on %d pages to the catalog , retrying with the next votes',
+                len(counts))
+            with self._unsaved_counts_lock:
+                # Counts written by another flush in the meantime are newer than ours.
+                self._unsaved_counts = {**counts, **self._unsaved_counts}
+
+        # The vote records are already written , so the snapshot shows the new counts even if the catalog is behind.
+        snapshot = self._snapshot
+        if snapshot is not None:
+            for name, page_counts in counts.items():
+                snapshot.update(name, **page_counts)
+
     def get_user_account(self, username):
         ''' Gets a user's account settings
             username: Current user
         '''
 
-        # Find the user's account settings
-        blob = self.user_bucket.blob(username)
+        # Gather every part of the user's account settings
+        account_data = self.accounts.read_all(username)
 
-        # Get its dictionary using JSON API
-        account_data = json.loads((blob.download_as_string()),
-                                  parse_constant=None)
+        # Show the pages viewed lately too, even if they were not written yet.
+        views = self.history.pending(username)
+        if account_data and views:
+            account_data['wiki_history'] = merge_views(
+                account_data['wiki_history'], views)
 
         return account_data
 
     def update_wikiupload(self, username, fileuploaded):
-        ''' Changes and overwrites account json when a user uploads a new wiki.
+        ''' Adds a wiki to the uploads part of a user's account, and returns that part.
             username : Current user that caused action.
             fileuploaded : Filename that user uploaded
         '''
-        blob = self.user_bucket.blob(username)
-
-        # Get the current wiki_page's json file as a dictionary.
-        user_metadata = Backend.get_user_account(self, username)
-        user_metadata['wikis_uploaded'].append(fileuploaded)
+        return self._update_account(
+            username, 'uploads',
+            lambda uploads: uploads['wikis_uploaded'].append(fileuploaded))
 
-        # Overwrite current account metadata
-        blob.upload_from_string(json.dumps(user_metadata),
-                                content_type='application/json')
-        return user_metadata
+    def _update_account(self, username, part, change):
+        ''' Changes a part of a user's account , forgetting the cached user since their account changed.
+            username : Current user that caused action.
+            part : The part of the account to change , such as 'profile'.
+            change : Function taking the part's fields and changing them in place.
+        '''
+        fields = self.accounts.update(username, part, change)
+        self.user_cache.invalidate(username)
+        return fields
 
     def update_wikihistory(self, username, file_viewed):
-        ''' Changes and overwrites account json when a user views a new wiki.
+        ''' Adds a wiki to the history part of a user's account, and returns that part.
             username : Current user that caused action.
             file_viewed : Filename that user viewed
         '''
-        blob = self.user_bucket.blob(username)
+        # Views recorded earlier must be written first, so they stay older than this one.
+        self.history.flush(username)
+        return Backend._apply_history(self, username, [file_viewed])
 
-        max_history = 100
+    def record_view(self, username, file_viewed):
+        ''' Adds a wiki viewed by a user to their history, in the background.
+            The view is written to the user's account at the next flush of the history buffer.
+            username : Current user that caused action.
+            file_viewed : Filename that user viewed
+        '''
+        self.history.add(username, file_viewed)
 
-        # Get the current wiki_page's json file as a dictionary
-        user_metadata = Backend.get_user_account(self, username)
+    def _apply_history(self, username, views):
+        ''' Writes a batch of views to the history part of a user's account in a single update, and returns that part.
+            A wiki viewed again moves to the end of the history rather than being repeated, and the oldest views are dropped past the limit.
+            username : The user who viewed the wikis.
+            views : The wikis viewed , from the oldest view to the most recent.
+        '''
 
-        # Checks if wiki viewed is a dupe, limit hit
-        wiki_history_array = user_metadata['wiki_history']
-        if file_viewed in wiki_history_array:
-            index = wiki_history_array.index(file_viewed)
-            wiki_history_array.pop(index)
-        elif len(wiki_history_array) >= max_history:
-            wiki_history_array.pop(0)
+        def add_views(history):
+            history['wiki_history'] = merge_views(history['wiki_history'],
+                                                  views)
 
-        # Adds new viewed wiki to history
-        user_metadata['wiki_history'].append(file_viewed)
-        # Overwrite current account metadata
-        blob.upload_from_string(json.dumps(user_metadata),
-                                content_type='application/json')
-        return user_metadata
+        # The history is not part of the cached users, so they stay cached.
+        return self.accounts.update(username, 'history', add_views)
 
     def update_bio(self, username, bio):
-        ''' Changes and overwrites account json when a user updates their bio.
+        ''' Changes the profile part of a user's account when they update their bio, and returns that part.
             username : Current user that caused action.
             bio : New Bio
         '''
-        blob = self.user_bucket.blob(username)
-
-        # Get the current wiki_page's json file as a dictionary
-        user_metadata = Backend.get_user_account(self, username)
-
-        user_metadata['about_me'] = bio
-        blob.upload_from_string(json.dumps(user_metadata),
-                                content_type='application/json')
-        return user_metadata
+        return self._update_account(
+            username, 'profile', lambda profile: profile.update(about_me=bio))
 
     def update_pfp(self, username, file):
-        ''' Changes and overwrites account json when a user updates their photo.
+        ''' Uploads a user's new photo and changes the profile part of their account to use it, returning that part.
             username : Current user that caused action.
             file : Profile Photo file
         '''
-        user_blob = self.user_bucket.blob(username)
-
         # Creates Photoname
         photo_name = username + ".jpg"
 
         # Checks if a photo already exists and deletes old photo
-        isExist = storage.Blob(bucket=self.user_bucket,
-                               name=photo_name).exists(self.storage_client)
-        if isExist:
-            existBlob = self.user_bucket.blob(photo_name)
+        existBlob = self.user_bucket.blob(photo_name)
+        replacing = existBlob.exists(self.storage_client)
+        if replacing:
             generation_match_precondition = None
             existBlob.reload()
             existBlob.delete(if_generation_match=generation_match_precondition)
 
         # Uploads photo to GCS
+        data = file.read()
         photo_blob = self.user_bucket.blob(photo_name)
         generation_match_precondition = 0
-        photo_blob.upload_from_file(
-            file, if_generation_match=generation_match_precondition)
-        # Get the current wiki_page's json file as a dictionary
-        user_metadata = Backend.get_user_account(self, username)
-
-        # Add photo to GCS
-        user_metadata['pfp_filename'] = photo_name
-        user_blob.upload_from_string(json.dumps(user_metadata),
-                                     content_type='application/json')
-        return user_metadata
+        photo_blob.upload_from_string(
+            data,
+            content_type='image/jpeg',
+            if_generation_match=generation_match_precondition)
+
+        # Stores the photo resized to each size , and deletes the sizes of the old photo it could not be resized to
+        thumbnails = make_thumbnails(data)
+        for size in PICTURE_SIZES:
+            variant_blob = self.user_bucket.blob(
+                variant_blob_name(username, size))
+            if size in thumbnails:
+                variant_blob.upload_from_string(thumbnails[size],
+                                                content_type='image/jpeg')
+            elif replacing:
+                try:
+                    variant_blob.delete()
+                except NotFound:
+                    pass
+
+        # Add photo to the profile part of the account
+        return self._update_account(
+            username, 'profile',
+            lambda profile: profile.update(pfp_filename=photo_name))
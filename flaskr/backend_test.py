@@ -1,11 +1,19 @@
-from flaskr.backend import Backend, User
+from flaskr.backend import UPLOAD_CHUNK_SIZE, UPLOAD_SPOOL_SIZE, Backend, User
+from flaskr.blobstore import Blob, MemoryClient
+from flaskr.records import BINARY_MAGIC
+from flaskr.search import ContentIndex, TitleIndex
+from flaskr.sorting import SortIndex
+from flaskr.votes import encode_votes
+from google.api_core.exceptions import NotFound
 from unittest.mock import MagicMock, patch
 import unittest
+import threading
 import pytest
 import base64
 import hashlib
 import json
 import io
+import os
 from freezegun import freeze_time
 from datetime import datetime
 
@@ -38,6 +46,13 @@ def backend(bucket, fake_client):
     backend = Backend(storage_client=fake_client)
     backend.info_bucket = bucket
     backend.user_bucket = bucket
+    # The page catalog and the search indexes are tested on their own in catalog_test.py and search_test.py.
+    backend.catalog = MagicMock()
+    backend.content_index = MagicMock()
+    backend.title_index = MagicMock()
+    backend.sort_index = MagicMock()
+    backend.comments.bucket = bucket
+    backend.accounts.bucket = bucket
     return backend
 
 
@@ -58,10 +73,14 @@ def test_get_all_pages(backend, fake_client, fake_blob):
 
         # Setting blob's name property
         fake_blob.name = 'Example Blob.txt'
+        fake_blob.size = 100
 
         # Mocking listing all the blobs of a bucket.
         fake_client.list_blobs.return_value = [fake_blob]
 
+        # The catalog was never built, so the pages have to be listed.
+        backend.catalog.rows.return_value = None
+
         # Calling the actual function with the mock data.
         result = backend.get_all_page_names()
         expected = [['Example Blob', 0, 0]]
@@ -72,6 +91,16 @@ def test_get_all_pages(backend, fake_client, fake_blob):
         # Check whether the backend and list_blobs were actually called.
         backend.storage_client.list_blobs.assert_called_once()
 
+        # The catalog is built so the next listing is a single read.
+        backend.catalog.save.assert_called_once_with([{
+            'name': 'Example Blob',
+            'upvotes': 0,
+            'downvotes': 0,
+            'date_created': '1111-11-11',
+            'author': None,
+            'size': 100
+        }])
+
 
 def test_get_all_pages_with_no_text_files(backend, fake_client, fake_blob):
 
@@ -80,6 +109,7 @@ def test_get_all_pages_with_no_text_files(backend, fake_client, fake_blob):
 
     # Mocking listing all the blobs of a bucket.
     fake_client.list_blobs.return_value = [fake_blob]
+    backend.catalog.rows.return_value = None
 
     # Calling the actual function with the mock data.
     result = backend.get_all_page_names()
@@ -92,11 +122,72 @@ def test_get_all_pages_with_no_text_files(backend, fake_client, fake_blob):
     backend.storage_client.list_blobs.assert_called_once()
 
 
+def test_get_all_pages_from_catalog(backend, fake_client):
+    # Once the catalog exists, the pages themselves are never listed nor downloaded.
+    backend.catalog.rows.return_value = [{
+        'name': 'Page 1',
+        'upvotes': 12,
+        'downvotes': 0,
+        'date_created': '1111-11-11',
+        'author': 'fake_author',
+        'size': 100
+    }]
+
+    result = backend.get_all_page_names()
+
+    assert result == [['Page 1', 12, 0]]
+    fake_client.list_blobs.assert_not_called()
+    backend.info_bucket.blob.assert_not_called()
+
+
+def test_get_all_pages_one_page_at_a_time():
+    backend = Backend(storage_client=MemoryClient())
+    for name in ['Lake', 'Park', 'River', 'Zoo']:
+        backend.upload(io.BytesIO(b'fake content'), name + '.txt',
+                       'fake_author')
+    backend.info_bucket.blob('Park.jpeg').upload_from_string('fake image')
+    backend.update_page('upvote', 'fake_user', 'River.txt')
+
+    first = backend.get_all_page_names(page_size=2)
+    second = backend.get_all_page_names(page_size=2, cursor=first[-1][0])
+
+    # Other files of the bucket are skipped without shortening a page of results.
+    assert first == [['Lake', 0, 0], ['Park', 0, 0]]
+    assert second == [['River', 1, 0], ['Zoo', 0, 0]]
+    assert backend.get_all_page_names(page_size=2, cursor='Zoo') == []
+
+    # The pages are served from the catalog , without listing or reading any of them.
+    backend.snapshot()
+    with patch.object(backend.storage_client,
+                      'list_blobs') as mock_list, patch.object(
+                          Backend, 'get_wiki_page') as mock_get_wiki:
+        assert backend.get_all_page_names(page_size=1,
+                                          cursor='Lake') == [['Park', 0, 0]]
+        mock_list.assert_not_called()
+        mock_get_wiki.assert_not_called()
+
+
+def test_search_with_cursor(backend):
+    backend.title_index.search.return_value = ['Page1', 'Page2', 'Page3']
+    backend.content_index.search.return_value = ['Page3', 'Page1']
+    set_ratings(backend, [['Page1', 0, 0], ['Page2', 1, 0], ['Page3', 0, 1]])
+
+    assert backend.search_by_title('page', limit=1,
+                                   cursor='Page1') == [['Page2', 1, 0]]
+    assert backend.search_by_title('page', cursor='Page3') == []
+    assert backend.search_by_content('page', limit=1,
+                                     cursor='Page3') == [['Page1', 0, 0]]
+    assert backend.search_by_content('page', cursor='Unknown') == []
+
+
 def test_get_wiki_page(backend, fake_blob):
 
     # Mocking the download_as_string
     fake_blob.download_as_string.return_value = '{"wiki_page": "really_fake_page", "content": "really_fake_content", "date_created": "0000-00-00", "upvotes": 0, "who_upvoted": [], "downvotes": 0, "who_downvoted": [], "comments": []}'
 
+    # The page has no vote record yet.
+    fake_blob.download_as_bytes.side_effect = NotFound('')
+
     # Getting the dummy data
     result = backend.get_wiki_page('really_fake_page.txt')
 
@@ -114,7 +205,8 @@ def test_get_wiki_page(backend, fake_blob):
     assert result == expected
 
     # Checking the calls to the backend and fake_blob.
-    backend.info_bucket.blob.assert_called_once_with('really_fake_page.txt')
+    assert [call.args[0] for call in backend.info_bucket.blob.call_args_list
+           ] == ['really_fake_page.txt', '_votes/really_fake_page.json']
     fake_blob.download_as_string.assert_called_once()
 
 
@@ -138,8 +230,10 @@ def test_get_wiki_page_failure(backend, fake_blob):
 def test_upload(backend, fake_blob):
     # Mocking the datetime.today() with freeze_time.
     with freeze_time('1111-11-11'):
-        # Mocking the upload_from_string method.
-        fake_blob.upload_from_string.return_value = None
+        # Mocking the upload_from_file method, keeping what it was given to read.
+        uploaded = []
+        fake_blob.upload_from_file.side_effect = lambda document, size, **kwargs: uploaded.append(
+            document.read(size))
 
         # Mocking a file object.
         file_contents = b'fake page content'
@@ -149,12 +243,95 @@ def test_upload(backend, fake_blob):
         # Calling the upload method by mocking the file path
         backend.upload(file, 'uploaded_fake_page.txt', "fake_author")
 
-        # Checking the calls to the backend and fake_blob
-        backend.info_bucket.blob.assert_called_once_with(
-            'uploaded_fake_page.txt')
-        fake_blob.upload_from_string.assert_called_once_with(
-            '{"wiki_page": "uploaded_fake_page.txt", "author": "fake_author", "content": "fake page content", "date_created": "1111-11-11", "upvotes": 0, "who_upvoted": [], "downvotes": 0, "who_downvoted": [], "comments": []}',
-            content_type='application/json')
+        # Checking the calls to the backend and fake_blob ; the page starts without votes.
+        assert [
+            call.args[0] for call in backend.info_bucket.blob.call_args_list
+        ] == ['uploaded_fake_page.txt', '_votes/uploaded_fake_page.json']
+        fake_blob.delete.assert_called_once_with()
+        fake_blob.upload_from_file.assert_called_once()
+        assert fake_blob.upload_from_file.call_args.kwargs == {
+            'size': 212,
+            'content_type': 'application/json'
+        }
+        assert uploaded == [
+            b'{"wiki_page": "uploaded_fake_page.txt", "author": "fake_author", "content": "fake page content", "date_created": "1111-11-11", "upvotes": 0, "who_upvoted": [], "downvotes": 0, "who_downvoted": [], "comments": []}'
+        ]
+
+        # The new page gets its row in the catalog.
+        backend.catalog.put.assert_called_once_with({
+            'name': 'uploaded_fake_page',
+            'upvotes': 0,
+            'downvotes': 0,
+            'date_created': '1111-11-11',
+            'author': 'fake_author',
+            'size': 212
+        })
+
+        # The new page can be searched right away.
+        backend.content_index.add_counts.assert_called_once_with(
+            'uploaded_fake_page', {
+                'fake': 1,
+                'page': 1,
+                'content': 1
+            })
+        backend.title_index.add.assert_called_once_with('uploaded_fake_page')
+        backend.sort_index.add.assert_called_once_with('uploaded_fake_page',
+                                                       '1111-11-11')
+
+
+def test_upload_is_streamed():
+    backend = Backend(storage_client=MemoryClient())
+    # Characters cut in two and words cut in two by the chunks are kept whole.
+    content = ('Park ' * 100000 + 'caf\u00e9 \u2603 "quoted"\n') * 2
+
+    with patch('flaskr.backend.UPLOAD_CHUNK_SIZE', 1001):
+        backend.upload(io.BytesIO(content.encode('utf-8')), 'Park.txt',
+                       'fake_author')
+
+    page = backend.get_wiki_page('Park.txt')
+    assert page['content'] == content
+    assert page['author'] == 'fake_author'
+    assert backend.catalog.rows()[0]['size'] == backend.info_bucket.get_blob(
+        'Park.txt').size
+    assert backend.search_by_content('caf\u00e9') == [['Park', 0, 0]]
+
+
+def test_large_upload_is_sent_in_chunks():
+    backend = Backend(storage_client=MemoryClient())
+    small = b'A lovely park'
+    # Random text compresses too little to fit in memory once compressed.
+    large = base64.b64encode(os.urandom(UPLOAD_SPOOL_SIZE))
+
+    with patch.object(Blob,
+                      'upload_from_file',
+                      autospec=True,
+                      side_effect=Blob.upload_from_file) as mock_upload:
+        backend.upload(io.BytesIO(small), 'Small.txt', 'fake_author')
+        backend.upload(io.BytesIO(large), 'Large.txt', 'fake_author')
+
+    # The size of a file is only given to GCS when it can be sent in a single request.
+    small_call, large_call = mock_upload.call_args_list
+    assert 'size' in small_call.kwargs
+    assert 'size' not in large_call.kwargs
+    assert large_call.args[0].chunk_size == UPLOAD_SPOOL_SIZE
+    assert backend.get_wiki_page('Large.txt')['content'] == large.decode()
+
+
+def test_upload_size_limit():
+    backend = Backend(storage_client=MemoryClient(), max_upload_bytes=1000)
+    file = io.BytesIO(b'x' * (UPLOAD_CHUNK_SIZE * 10))
+
+    with pytest.raises(ValueError, match='larger than 1,000 bytes'):
+        backend.upload(file, 'Huge.txt', 'fake_author')
+
+    # The file was turned down after its first chunk, and nothing was stored.
+    assert file.tell() == UPLOAD_CHUNK_SIZE
+    assert backend.info_bucket.get_blob('Huge.txt') is None
+
+    with pytest.raises(ValueError):
+        backend.upload(io.BytesIO(b'\xff\xfe not text'), 'Binary.txt',
+                       'fake_author')
+    assert backend.info_bucket.get_blob('Binary.txt') is None
 
 
 def test_get_image_upload(backend, fake_blob):
@@ -234,16 +411,21 @@ def test_successful_sign_up(backend, fake_blob):
             mock_hashlib.return_value.hexdigest.return_value = "fake"
             result = backend.sign_up(fake_username, fake_password)
 
-            # don't need to patch, because we imported json library
-            fake_blob.upload_from_string.assert_called_once_with(
-                '{"hashed_password": "fake", "account_creation": "1111-11-11", "wikis_uploaded": [], "wiki_history": [], "pfp_filename": null, "about_me": ""}',
-                content_type='application/json')
-
-            # make sure we are calling the fake_blob
-            backend.user_bucket.blob.assert_called_once()
-
-            # make sure we are calling the fake_blob with the approiate username
-            backend.user_bucket.blob.assert_called_once_with(fake_username)
+            # each part of the account is stored on its own , the credentials under the username
+            assert [
+                call.args[0] for call in backend.user_bucket.blob.call_args_list
+            ] == [
+                fake_username, '_uploads/fake username.json',
+                '_history/fake username.json', '_profile/fake username.json'
+            ]
+            assert [
+                call.args[0]
+                for call in fake_blob.upload_from_string.call_args_list
+            ] == [
+                b'{"hashed_password": "fake", "account_creation": "1111-11-11"}',
+                b'{"wikis_uploaded": []}', b'{"wiki_history": []}',
+                b'{"pfp_filename": null, "about_me": ""}'
+            ]
 
             #checks if user is returned
             assert isinstance(result, User)
@@ -265,6 +447,14 @@ def test_failed_sign_up(backend, fake_blob):
     backend.user_bucket.get_blob.assert_called_once_with(fake_username)
 
 
+def test_sign_up_rejects_control_characters(backend, fake_blob):
+    with pytest.raises(ValueError):
+        backend.sign_up('bot0\nbot1', 'fake password')
+
+    backend.user_bucket.get_blob.assert_not_called()
+    fake_blob.upload_from_string.assert_not_called()
+
+
 def test_sign_in_user_exist(backend, fake_blob):
     # creating the fake username and password , salted , hashed passsword
     fake_username = 'fake username'
@@ -273,25 +463,25 @@ def test_sign_in_user_exist(backend, fake_blob):
     fake_hashed_password = hashlib.md5(fake_salted.encode()).hexdigest()
 
     # checking username blob exits in the bucket or not
-    with patch('google.cloud.storage.Blob.exists') as mock_exists:
-        # mocks hashlib
-        with patch('hashlib.md5') as mock_hashlib:
-            # sets download as string to our return value
-            fake_blob.download_as_string.return_value = (
-                '{"hashed_password": "fake", "account_creation": "1111-11-11", "wikis_uploaded": [], "wiki_history": [], "pfp_filename": null, "about_me": ""}'
-            )
-            # sets haslib password to fix
-            mock_hashlib.return_value.hexdigest.return_value = "fake"
+    mock_exists = fake_blob.exists
+    # mocks hashlib
+    with patch('hashlib.md5') as mock_hashlib:
+        # sets download as string to our return value
+        fake_blob.download_as_string.return_value = (
+            '{"hashed_password": "fake", "account_creation": "1111-11-11", "wikis_uploaded": [], "wiki_history": [], "pfp_filename": null, "about_me": ""}'
+        )
+        # sets haslib password to fix
+        mock_hashlib.return_value.hexdigest.return_value = "fake"
+
+        # forces the return value of the if to be true
+        mock_exists.return_value = True
 
-            # forces the return value of the if to be true
-            mock_exists.return_value = True
+        # calling the backend method sign_in
+        result = backend.sign_in(fake_username, fake_password)
 
-            # calling the backend method sign_in
-            result = backend.sign_in(fake_username, fake_password)
-
-            # checking instance of User class
-            assert isinstance(result, User)
-            assert result.username == fake_username
+        # checking instance of User class
+        assert isinstance(result, User)
+        assert result.username == fake_username
 
     #checking the calls to the backend and blob
     backend.user_bucket.blob.assert_called_once_with(fake_username)
@@ -307,28 +497,104 @@ def test_sign_in_user_doesnot_exists(backend, fake_blob):
     fake_hashed_password = hashlib.md5(fake_salted.encode()).hexdigest()
 
     # checking  blob exits in the bucket or not #
-    with patch('google.cloud.storage.Blob.exists') as mock_exists:
-        mock_exists.return_value = False  # if blob doesnot exist
+    mock_exists = fake_blob.exists
+    mock_exists.return_value = False  # if blob doesnot exist
 
-        # calling the backend method sign_in
-        result = backend.sign_in(fake_username, fake_password)
+    # calling the backend method sign_in
+    result = backend.sign_in(fake_username, fake_password)
 
-        # checking the result
-        assert result == None
+    # checking the result
+    assert result == None
 
     # checking exists was called
     mock_exists.assert_called_once()
 
 
-def test_title_content_non_empty(backend):
+def test_get_wiki_pages(backend):
+    pages = {
+        'page1.txt': {
+            'content': 'fake page1 content'
+        },
+        'page2.txt': {
+            'content': 'fake page2 content'
+        }
+    }
+
+    def fake_get_wiki_page(name):
+        if name not in pages:
+            raise ValueError('fake download error')
+        return pages[name]
+
+    backend.get_wiki_page = MagicMock(side_effect=fake_get_wiki_page)
+
+    # A page failing to load does not prevent the others from being returned.
+    result = backend.get_wiki_pages(
+        ['page1.txt', 'broken.txt', 'page2.txt', 'page1.txt'], max_workers=3)
+    assert result == {
+        'page1.txt': pages['page1.txt'],
+        'broken.txt': None,
+        'page2.txt': pages['page2.txt']
+    }
+
+    # Each page is only downloaded once.
+    assert backend.get_wiki_page.call_count == 3
+    assert backend.get_wiki_pages([]) == {}
+
+
+def test_get_wiki_pages_in_parallel(backend):
+    started = threading.Barrier(4, timeout=5)
+
+    def fake_get_wiki_page(name):
+        # Only returns once all four pages are being fetched at the same time.
+        started.wait()
+        return {'wiki_page': name}
+
+    backend.get_wiki_page = MagicMock(side_effect=fake_get_wiki_page)
+    names = [f'page{i}.txt' for i in range(4)]
+
+    result = backend.get_wiki_pages(names, max_workers=4)
+
+    assert list(result) == names
+    assert result['page3.txt'] == {'wiki_page': 'page3.txt'}
+
+
+def set_ratings(backend, pages):
+    ''' gives the mocked catalog a row for each [page name, upvotes, downvotes] list '''
+
+    backend.catalog.rows.return_value = [{
+        'name': name,
+        'upvotes': upvotes,
+        'downvotes': downvotes,
+        'date_created': '2000-01-01',
+        'author': 'fake_user',
+        'size': 100
+    } for name, upvotes, downvotes in sorted(pages)]
+
+
+@pytest.fixture
+def page1_row():
+    ''' the catalog row of a single page , as stored by the catalog '''
+
+    return {
+        'name': 'page1',
+        'upvotes': 0,
+        'downvotes': 1,
+        'date_created': '1999-10-12',
+        'author': 'fake_user',
+        'size': 100
+    }
+
+
+def test_title_content_non_empty(backend, page1_row):
     ''' testing title_content method for valid title and content stored in dictionary 
 
         Args : 
             backend : mocked backend class 
+            page1_row : catalog row of the page
 
         MagicMock : a subclass of Mock with all the magic methods pre-created and ready to use
     '''
-    backend.get_all_page_names = MagicMock(return_value=[['page1', 0, 1]])
+    backend.catalog.rows.return_value = [page1_row]
     backend.get_wiki_page = MagicMock(
         return_value={
             "wiki_page": "page1.txt",
@@ -337,7 +603,7 @@ def test_title_content_non_empty(backend):
             "date_created": "1999-10-12",
             "upvotes": 0,
             "who_upvoted": [],
-            "downvotes": 0,
+            "downvotes": 1,
             "who_downvoted": [],
             "comments": []
         })
@@ -345,7 +611,7 @@ def test_title_content_non_empty(backend):
     expected = {("page1", 0, 1): "fake page1 content"}
     assert result == expected
 
-    backend.get_all_page_names.assert_called_once()
+    backend.catalog.rows.assert_called_once()
     backend.get_wiki_page.assert_called_once_with('page1.txt')
 
 
@@ -357,7 +623,7 @@ def test_title_content_empty(backend):
             
         MagicMock : a subclass of Mock with all the magic methods pre-created and ready to use
     '''
-    backend.get_all_page_names = MagicMock(return_value=[])
+    backend.catalog.rows.return_value = []
     backend.get_wiki_page = MagicMock(return_value={})
 
     result = backend.title_content()
@@ -365,38 +631,44 @@ def test_title_content_empty(backend):
 
     assert result == expected
 
-    backend.get_all_page_names.assert_called_once()
+    backend.catalog.rows.assert_called_once()
+    backend.get_wiki_page.assert_not_called()
+
+
+def test_title_content_skips_unreadable_pages(backend, page1_row):
+    broken_row = dict(page1_row, name='broken')
+    backend.catalog.rows.return_value = [broken_row, page1_row]
+    backend.get_wiki_pages = MagicMock(return_value={
+        'broken.txt': None,
+        'page1.txt': {
+            'content': 'fake page1 content'
+        }
+    })
 
+    assert backend.title_content() == {('page1', 0, 1): 'fake page1 content'}
+    backend.get_wiki_pages.assert_called_once()
 
-def test_title_date_non_empty(backend):
+
+def test_title_date_non_empty(backend, page1_row):
     ''' testing title_date method for valid [list of title ,upvote and downvote] and date_creted stored in dictionary 
 
         Args : 
             backend : mocked backend class 
+            page1_row : catalog row of the page
             
         MagicMock : a subclass of Mock with all the magic methods pre-created and ready to use
     '''
-    backend.get_all_page_names = MagicMock(return_value=[['page1', 0, 1]])
-    backend.get_wiki_page = MagicMock(
-        return_value={
-            "wiki_page": "page1.txt",
-            "author": "fake_user",
-            "content": "fake page1 content",
-            "date_created": "1999-10-12",
-            "upvotes": 0,
-            "who_upvoted": [],
-            "downvotes": 0,
-            "who_downvoted": [],
-            "comments": []
-        })
+    backend.catalog.rows.return_value = [page1_row]
+    backend.get_wiki_page = MagicMock()
 
     result = backend.title_date()
     expected = {('page1', 0, 1): '1999-10-12'}
 
     assert result == expected
 
-    backend.get_all_page_names.assert_called_once()
-    backend.get_wiki_page.assert_called_once_with('page1.txt')
+    # The dates come from the catalog , so no page is downloaded.
+    backend.catalog.rows.assert_called_once()
+    backend.get_wiki_page.assert_not_called()
 
 
 def test_title_date_empty(backend):
@@ -407,15 +679,57 @@ def test_title_date_empty(backend):
             
         MagicMock : a subclass of Mock with all the magic methods pre-created and ready to use
     '''
-    backend.get_all_page_names = MagicMock(return_value=[])
-    backend.get_wiki_page = MagicMock(return_value={})
+    backend.catalog.rows.return_value = []
 
     result = backend.title_date()
     expected = {}
 
     assert result == expected
 
-    backend.get_all_page_names.assert_called_once()
+    backend.catalog.rows.assert_called_once()
+
+
+def test_snapshot_is_shared(backend, page1_row):
+    backend.catalog.rows.return_value = [page1_row]
+    backend.get_wiki_page = MagicMock(return_value={'content': 'fake content'})
+    backend.sort_index.page.return_value = ['page1']
+
+    # Listing, sorting and searching the wiki read the catalog and each page only once.
+    backend.get_all_page_names()
+    backend.sort_pages('year')
+    backend.filter_by_year('1999')
+    backend.title_content()
+    backend.title_content()
+    backend.catalog.rows.assert_called_once()
+    backend.get_wiki_page.assert_called_once_with('page1.txt')
+
+    # Saved pages and written votes are applied to the snapshot instead of reading the catalog again ,
+    # and only the saved page is read again.
+    backend._page_saved('page1.txt', {
+        'upvotes': 0,
+        'downvotes': 0,
+        'date_created': '1999-10-12'
+    }, 64)
+    backend._page_saved('page0.txt', {
+        'upvotes': 0,
+        'downvotes': 0,
+        'date_created': '2001-01-01'
+    }, 32)
+    backend._votes_written({'page1.txt': {'upvotes': 2, 'downvotes': 1}})
+    assert backend.get_all_page_names() == [['page0', 0, 0], ['page1', 2, 1]]
+    assert backend.year_counts() == {'2001': 1, '1999': 1}
+    backend.title_content()
+    backend.catalog.rows.assert_called_once()
+    assert backend.get_wiki_page.call_count == 3
+
+
+def test_snapshot_expires(backend, page1_row):
+    backend.catalog.rows.return_value = [page1_row]
+    backend.snapshot_ttl = 0
+
+    backend.get_all_page_names()
+    backend.get_all_page_names()
+    assert backend.catalog.rows.call_count == 2
 
 
 @pytest.fixture
@@ -429,44 +743,92 @@ def mock_title_content():
         yield mock_title_content
 
 
-def test_search_by_title_query_in_title(backend):
+@pytest.fixture
+def title_index(backend, fake_client):
+    '''  giving the backend a real title index built from a mocked bucket listing
+    '''
+
+    fake_blobs = []
+    for name in ['Page1.txt', 'Page 2.txt', 'picture.jpeg']:
+        fake_blob = MagicMock()
+        fake_blob.name = name
+        fake_blobs.append(fake_blob)
+    fake_client.list_blobs.return_value = fake_blobs
+
+    backend.title_index = TitleIndex(backend._list_page_titles)
+    return backend.title_index
+
+
+def test_search_by_title_query_in_title(backend, title_index):
     '''  testing search by title with query which is in page title
          
         Args : 
             backend : mocked backend class
+            title_index : title index built from the mocked listing
 
     '''
     fake_page = [['Page1', 0, 1], ['Page 2', 1, 1]]
-    backend.get_all_page_names = MagicMock(return_value=fake_page)
+    set_ratings(backend, fake_page)
     result = backend.search_by_title('2')
     expected = [['Page 2', 1, 1]]
 
     assert result == expected
-    backend.get_all_page_names.assert_called_once()
+    backend.catalog.rows.assert_called_once()
 
 
-def test_search_by_title_no_query_in_title(backend):
+def test_search_by_title_no_query_in_title(backend, title_index):
     '''  testing search by title with query which is not  in page title
 
          Args : 
             backend : mocked backend class
+            title_index : title index built from the mocked listing
 
     '''
     fake_page = [['Page1', 0, 1], ['Page 2', 1, 1]]
-    backend.get_all_page_names = MagicMock(return_value=fake_page)
+    set_ratings(backend, fake_page)
     result = backend.search_by_title('3')
     expected = []
 
     assert result == expected
-    backend.get_all_page_names.assert_called_once()
 
 
-def test_search_by_content_query_in_content(backend, mock_title_content):
+def test_search_by_title_with_typo(backend, title_index):
+    '''  testing fuzzy search by title with query which has a typo
+
+         Args : 
+            backend : mocked backend class
+            title_index : title index built from the mocked listing
+
+    '''
+    fake_page = [['Page1', 0, 1], ['Page 2', 1, 1]]
+    set_ratings(backend, fake_page)
+
+    assert backend.search_by_title('pgae 2') == []
+    assert backend.search_by_title('pgae 2', fuzzy=True) == [['Page 2', 1, 1]]
+
+    # The bucket is only listed once , to build the index.
+    backend.storage_client.list_blobs.assert_called_once()
+
+
+@pytest.fixture
+def content_index(backend):
+    '''  giving the backend a real content index stored in memory , built from the mocked title_content
+    '''
+
+    backend.content_index = ContentIndex(MemoryClient().bucket('wiki_info'),
+                                         backend._page_contents)
+    set_ratings(backend, [['Page1', 0, 1]])
+    return backend.content_index
+
+
+def test_search_by_content_query_in_content(backend, mock_title_content,
+                                            content_index):
     '''  testing search by content with query which is in content of the page 
 
         Args : 
             backend : mocked backend class
             mock_title_content : mocked title_content method 
+            content_index : in-memory content index
 
     '''
     result = backend.search_by_content('page')
@@ -474,15 +836,19 @@ def test_search_by_content_query_in_content(backend, mock_title_content):
 
     assert result == expected
 
+    # The contents are only downloaded once , to build the index.
+    backend.search_by_content('content')
     mock_title_content.assert_called_once()
 
 
-def test_search_by_content_query_not_in_content(backend, mock_title_content):
+def test_search_by_content_query_not_in_content(backend, mock_title_content,
+                                                content_index):
     '''  testing search by title with query which is not in content of the page
 
          Args : 
             backend : mocked backend class
             mock_title_content : mocked title_content method 
+            content_index : in-memory content index
 
     '''
     result = backend.search_by_content('gamma')
@@ -494,40 +860,75 @@ def test_search_by_content_query_not_in_content(backend, mock_title_content):
 
 
 @pytest.fixture
-def mock_title_date():
-    '''  mocking title date method of the backend to inject in sort pages method
+def sort_index(backend):
+    '''  giving the backend a real sort index stored in memory , built from mocked catalog rows
 
         Args:
-            None
+            backend : mocked backend class
     '''
-
-    with patch('flaskr.backend.Backend.title_date',
-               return_value={
-                   ('Page1', 0, 1): '2022-02-01',
-                   ('Title', 1, 0): '2021-01-01'
-               },
-               autospec=True) as mock_title_date:
-        yield mock_title_date
+    rows = [{
+        'name': name,
+        'date_created': date
+    } for name, date in [('Page1',
+                          '2022-02-01'), ('Title',
+                                          '2021-01-01'), ('Older',
+                                                          '2021-01-01')]]
+    backend.sort_index = SortIndex(MemoryClient().bucket('wiki_info'),
+                                   rebuild=MagicMock(return_value=rows))
+    set_ratings(backend, [['Older', 2, 2], ['Page1', 0, 1], ['Title', 1, 0]])
+    return backend.sort_index
 
 
 @pytest.mark.parametrize('option,expected', [
-    ('a_z', [['Page1', 0, 1], ['Title', 1, 0]]),
-    ('z_a', [['Title', 1, 0], ['Page1', 0, 1]]),
-    ('year', [['Page1', 0, 1], ['Title', 1, 0]]),
+    ('a_z', [['Older', 2, 2], ['Page1', 0, 1], ['Title', 1, 0]]),
+    ('z_a', [['Title', 1, 0], ['Page1', 0, 1], ['Older', 2, 2]]),
+    ('year', [['Page1', 0, 1], ['Older', 2, 2], ['Title', 1, 0]]),
+    ('unknown', []),
 ])
-def test_sort_pages(backend, option, expected, mock_title_date):
+def test_sort_pages(backend, option, expected, sort_index):
     ''' Testing sort pages method 
 
         Args: 
             backend : mocked backend class
             option : possible option user can choose define in parametrize 
             expected : expected value for that option 
-            mock_title_date: mocked title_date method 
+            sort_index : in-memory sort index
     '''
 
     result = backend.sort_pages(option)
     assert result == expected
-    mock_title_date.assert_called_once()
+
+
+@pytest.mark.parametrize('option', ['a_z', 'z_a', 'year'])
+def test_sort_pages_with_cursor(backend, option, sort_index):
+    ''' Testing that walking through the sorted pages two at a time gives every page once , in order
+
+        Args: 
+            backend : mocked backend class
+            option : possible option user can choose define in parametrize 
+            sort_index : in-memory sort index
+    '''
+    first = backend.sort_pages(option, page_size=2)
+    rest = backend.sort_pages(option, page_size=2, cursor=first[-1][0])
+
+    assert len(first) == 2
+    assert first + rest == backend.sort_pages(option)
+    assert backend.sort_pages(option, page_size=2, cursor=rest[-1][0]) == []
+
+
+def test_sort_index_add(sort_index):
+    sort_index.add('Lake', '2023-05-05')
+    sort_index.add('Title', '2024-01-01')
+
+    assert sort_index.page('a_z') == ['Lake', 'Older', 'Page1', 'Title']
+    assert sort_index.page('latest') == ['Title', 'Lake', 'Page1', 'Older']
+    assert sort_index.page('z_a', page_size=2,
+                           cursor='Page1') == ['Older', 'Lake']
+
+    # The orderings are stored , so another process does not build them again.
+    other = SortIndex(sort_index.bucket, rebuild=MagicMock())
+    assert other.page('latest') == ['Title', 'Lake', 'Page1', 'Older']
+    other.rebuild.assert_not_called()
 
 
 def test_update_metadata_with_comments(backend, fake_blob):
@@ -557,26 +958,18 @@ def test_update_metadata_with_comments(backend, fake_blob):
     result = backend.update_metadata_with_comments(fake_page, fake_user,
                                                    fake_comment)
 
-    expected = {
-        "wiki_page": "fake_page.txt",
-        "author": "fake_author",
-        "content": "fake page content",
-        "date_created": "1999-10-12",
-        "upvotes": 0,
-        "who_upvoted": [],
-        "downvotes": 0,
-        "who_downvoted": [],
-        "comments": [{
-            "fake_user": "fake_user looks good"
-        }]
-    }
-
     assert result == None
 
+    # The page has no comment log yet, so the comment starts its first segment.
     backend.get_wiki_page.assert_called_once_with("fake_page.txt")
-    backend.info_bucket.blob.assert_called_once_with("fake_page.txt")
+    backend.info_bucket.blob.assert_called_once_with(
+        "_comments/fake_page/99999999.json")
     fake_blob.upload_from_string.assert_called_once_with(
-        json.dumps(expected), content_type='application/json')
+        json.dumps([{
+            "fake_user": "fake_user looks good"
+        }]),
+        content_type='application/json',
+        if_generation_match=0)
 
 
 def test_update_metadata_with_comments_same_user(backend, fake_blob):
@@ -599,6 +992,13 @@ def test_update_metadata_with_comments_same_user(backend, fake_blob):
             "fake_user": "fake_user looks good"
         }]
     }
+    # The earlier comment is already in the page's comment log.
+    segment = MagicMock()
+    segment.name = "_comments/fake_page/99999999.json"
+    backend.info_bucket.list_blobs.return_value = [segment]
+    fake_blob.download_as_bytes.return_value = json.dumps(
+        fake_page_metadata["comments"])
+    fake_blob.generation = 7
     backend.get_wiki_page = MagicMock(return_value=fake_page_metadata)
 
     fake_page = 'fake_page'
@@ -608,33 +1008,22 @@ def test_update_metadata_with_comments_same_user(backend, fake_blob):
     result = backend.update_metadata_with_comments(fake_page, fake_user,
                                                    fake_comment1)
 
-    expected = {
-        "wiki_page":
-            "fake_page.txt",
-        "author":
-            "fake_author",
-        "content":
-            "fake page content",
-        "date_created":
-            "1999-10-12",
-        "upvotes":
-            0,
-        "who_upvoted": [],
-        "downvotes":
-            0,
-        "who_downvoted": [],
-        "comments": [{
-            "fake_user": "fake_user looks good"
-        }, {
-            "fake_user": "fake_user looks good11"
-        }]
-    }
-
     assert result == None
+
+    # Only the newest segment of the comment log is rewritten , not the page.
     backend.get_wiki_page.assert_called_once_with("fake_page.txt")
-    backend.info_bucket.blob.assert_called_once_with("fake_page.txt")
+    backend.info_bucket.list_blobs.assert_called_once_with(
+        prefix="_comments/fake_page/", max_results=1)
+    backend.info_bucket.blob.assert_called_with(
+        "_comments/fake_page/99999999.json")
     fake_blob.upload_from_string.assert_called_once_with(
-        json.dumps(expected), content_type='application/json')
+        json.dumps([{
+            "fake_user": "fake_user looks good"
+        }, {
+            "fake_user": "fake_user looks good11"
+        }]),
+        content_type='application/json',
+        if_generation_match=7)
 
 
 def test_update_metadata_with_multiple_comments(backend, fake_blob):
@@ -657,6 +1046,13 @@ def test_update_metadata_with_multiple_comments(backend, fake_blob):
             "fake_user": "fake_user looks good"
         }]
     }
+    # The earlier comment is already in the page's comment log.
+    segment = MagicMock()
+    segment.name = "_comments/fake_page/99999999.json"
+    backend.info_bucket.list_blobs.return_value = [segment]
+    fake_blob.download_as_bytes.return_value = json.dumps(
+        fake_page_metadata["comments"])
+    fake_blob.generation = 7
     backend.get_wiki_page = MagicMock(return_value=fake_page_metadata)
 
     fake_page1 = 'fake_page'
@@ -666,34 +1062,22 @@ def test_update_metadata_with_multiple_comments(backend, fake_blob):
     result = backend.update_metadata_with_comments(fake_page1, fake_user1,
                                                    fake_comment1)
 
-    expected = {
-        "wiki_page":
-            "fake_page.txt",
-        "author":
-            "fake_author",
-        "content":
-            "fake page content",
-        "date_created":
-            "1999-10-12",
-        "upvotes":
-            0,
-        "who_upvoted": [],
-        "downvotes":
-            0,
-        "who_downvoted": [],
-        "comments": [{
-            "fake_user": "fake_user looks good"
-        }, {
-            "fake_user1": "fake_user1 looks good"
-        }]
-    }
-
     assert result == None
 
+    # Only the newest segment of the comment log is rewritten , not the page.
     backend.get_wiki_page.assert_called_once_with("fake_page.txt")
-    backend.info_bucket.blob.assert_called_once_with("fake_page.txt")
+    backend.info_bucket.list_blobs.assert_called_once_with(
+        prefix="_comments/fake_page/", max_results=1)
+    backend.info_bucket.blob.assert_called_with(
+        "_comments/fake_page/99999999.json")
     fake_blob.upload_from_string.assert_called_once_with(
-        json.dumps(expected), content_type='application/json')
+        json.dumps([{
+            "fake_user": "fake_user looks good"
+        }, {
+            "fake_user1": "fake_user1 looks good"
+        }]),
+        content_type='application/json',
+        if_generation_match=7)
 
 
 def test_update_page_first_upvote(backend, fake_blob):
@@ -713,6 +1097,11 @@ def test_update_page_first_upvote(backend, fake_blob):
             "comments": []
         }
 
+        # The votes themselves are read from the page's vote record.
+        fake_blob.download_as_bytes.return_value = json.dumps(
+            encode_votes(mock_get_wiki.return_value))
+        fake_blob.generation = 3
+
         # Patching json's API to be able to execute blob.upload_from_string with a fake json file.
         with patch('json.dumps') as mock_json_dump:
 
@@ -735,10 +1124,19 @@ def test_update_page_first_upvote(backend, fake_blob):
 
             # Checking the calls to the backend and the fake blob.
             assert expected == result
-            backend.info_bucket.blob.assert_called_once_with(
-                'fake_wiki_page.txt')
+            backend.info_bucket.blob.assert_called_with(
+                '_votes/fake_wiki_page.json')
+            # Only the vote record is written, and only if nobody changed it since it was read.
             fake_blob.upload_from_string.assert_called_once_with(
-                'fake_metadata_json_file', content_type='application/json')
+                'fake_metadata_json_file',
+                content_type='application/json',
+                if_generation_match=3)
+            backend.catalog.update_many.assert_called_once_with({
+                'fake_wiki_page': {
+                    'upvotes': expected['upvotes'],
+                    'downvotes': expected['downvotes']
+                }
+            })
 
 
 def test_update_page_second_upvote(backend, fake_blob):
@@ -758,6 +1156,11 @@ def test_update_page_second_upvote(backend, fake_blob):
             "comments": []
         }
 
+        # The votes themselves are read from the page's vote record.
+        fake_blob.download_as_bytes.return_value = json.dumps(
+            encode_votes(mock_get_wiki.return_value))
+        fake_blob.generation = 3
+
         # Patching json's API to be able to execute blob.upload_from_string with a fake json file.
         with patch('json.dumps') as mock_json_dump:
 
@@ -780,10 +1183,19 @@ def test_update_page_second_upvote(backend, fake_blob):
 
             # Checking the calls to the backend and the fake blob.
             assert expected == result
-            backend.info_bucket.blob.assert_called_once_with(
-                'fake_wiki_page.txt')
+            backend.info_bucket.blob.assert_called_with(
+                '_votes/fake_wiki_page.json')
+            # Only the vote record is written, and only if nobody changed it since it was read.
             fake_blob.upload_from_string.assert_called_once_with(
-                'fake_metadata_json_file', content_type='application/json')
+                'fake_metadata_json_file',
+                content_type='application/json',
+                if_generation_match=3)
+            backend.catalog.update_many.assert_called_once_with({
+                'fake_wiki_page': {
+                    'upvotes': expected['upvotes'],
+                    'downvotes': expected['downvotes']
+                }
+            })
 
 
 def test_update_page_upvote_with_existing_downvote(backend, fake_blob):
@@ -803,6 +1215,11 @@ def test_update_page_upvote_with_existing_downvote(backend, fake_blob):
             "comments": []
         }
 
+        # The votes themselves are read from the page's vote record.
+        fake_blob.download_as_bytes.return_value = json.dumps(
+            encode_votes(mock_get_wiki.return_value))
+        fake_blob.generation = 3
+
         # Patching json's API to be able to execute blob.upload_from_string with a fake json file.
         with patch('json.dumps') as mock_json_dump:
 
@@ -825,10 +1242,19 @@ def test_update_page_upvote_with_existing_downvote(backend, fake_blob):
 
             # Checking the calls to the backend and the fake blob.
             assert expected == result
-            backend.info_bucket.blob.assert_called_once_with(
-                'fake_wiki_page.txt')
+            backend.info_bucket.blob.assert_called_with(
+                '_votes/fake_wiki_page.json')
+            # Only the vote record is written, and only if nobody changed it since it was read.
             fake_blob.upload_from_string.assert_called_once_with(
-                'fake_metadata_json_file', content_type='application/json')
+                'fake_metadata_json_file',
+                content_type='application/json',
+                if_generation_match=3)
+            backend.catalog.update_many.assert_called_once_with({
+                'fake_wiki_page': {
+                    'upvotes': expected['upvotes'],
+                    'downvotes': expected['downvotes']
+                }
+            })
 
 
 def test_update_page_downvote_with_two_existing_downvote(backend, fake_blob):
@@ -848,6 +1274,11 @@ def test_update_page_downvote_with_two_existing_downvote(backend, fake_blob):
             "comments": []
         }
 
+        # The votes themselves are read from the page's vote record.
+        fake_blob.download_as_bytes.return_value = json.dumps(
+            encode_votes(mock_get_wiki.return_value))
+        fake_blob.generation = 3
+
         # Patching json's API to be able to execute blob.upload_from_string with a fake json file.
         with patch('json.dumps') as mock_json_dump:
 
@@ -872,10 +1303,19 @@ def test_update_page_downvote_with_two_existing_downvote(backend, fake_blob):
 
             # Checking the calls to the backend and the fake blob.
             assert expected == result
-            backend.info_bucket.blob.assert_called_once_with(
-                'fake_wiki_page.txt')
+            backend.info_bucket.blob.assert_called_with(
+                '_votes/fake_wiki_page.json')
+            # Only the vote record is written, and only if nobody changed it since it was read.
             fake_blob.upload_from_string.assert_called_once_with(
-                'fake_metadata_json_file', content_type='application/json')
+                'fake_metadata_json_file',
+                content_type='application/json',
+                if_generation_match=3)
+            backend.catalog.update_many.assert_called_once_with({
+                'fake_wiki_page': {
+                    'upvotes': expected['upvotes'],
+                    'downvotes': expected['downvotes']
+                }
+            })
 
 
 def test_update_page_one_upvote_one_downvote_with_two_different_users(
@@ -896,6 +1336,11 @@ def test_update_page_one_upvote_one_downvote_with_two_different_users(
             "comments": []
         }
 
+        # The votes themselves are read from the page's vote record.
+        fake_blob.download_as_bytes.return_value = json.dumps(
+            encode_votes(mock_get_wiki.return_value))
+        fake_blob.generation = 3
+
         # Patching json's API to be able to execute blob.upload_from_string with a fake json file.
         with patch('json.dumps') as mock_json_dump:
 
@@ -918,10 +1363,19 @@ def test_update_page_one_upvote_one_downvote_with_two_different_users(
 
             # Checking the calls to the backend and the fake blob.
             assert expected == result
-            backend.info_bucket.blob.assert_called_once_with(
-                'fake_wiki_page.txt')
+            backend.info_bucket.blob.assert_called_with(
+                '_votes/fake_wiki_page.json')
+            # Only the vote record is written, and only if nobody changed it since it was read.
             fake_blob.upload_from_string.assert_called_once_with(
-                'fake_metadata_json_file', content_type='application/json')
+                'fake_metadata_json_file',
+                content_type='application/json',
+                if_generation_match=3)
+            backend.catalog.update_many.assert_called_once_with({
+                'fake_wiki_page': {
+                    'upvotes': expected['upvotes'],
+                    'downvotes': expected['downvotes']
+                }
+            })
 
 
 def test_get_user_account_success(backend, fake_blob):
@@ -948,8 +1402,14 @@ def test_get_user_account_success(backend, fake_blob):
 
     assert isinstance(result, dict)
     assert result == expected_dict
-    backend.user_bucket.blob.assert_called_with(fake_username)
-    fake_blob.download_as_string.assert_called_once()
+
+    # every part of the account is read
+    assert [call.args[0] for call in backend.user_bucket.blob.call_args_list
+           ] == [
+               fake_username, '_uploads/fake username.json',
+               '_history/fake username.json', '_profile/fake username.json'
+           ]
+    assert fake_blob.download_as_string.call_count == 4
 
 
 def test_user_get_account_failure(backend, fake_blob):
@@ -973,41 +1433,25 @@ def test_update_wikihistory_add_one(backend, fake_blob):
     fake_username = 'fake username'
     file_viewed = 'filename'
 
-    # creates return value from get_user_account method
-    getter = {
-        "hashed_password": "fake",
-        "account_creation": "1111-11-11",
-        "wikis_uploaded": [],
-        "wiki_history": [],
-        "pfp_filename": None,
-        "about_me": ""
-    }
+    # the history part of the account
+    fake_blob.download_as_string.return_value = '{"wiki_history": []}'
+    fake_blob.generation = 4
 
-    # injects return value into get_user_account
-    with patch.object(Backend, 'get_user_account',
-                      return_value=getter) as mock_method:
-        # expected dictionary of what it should be when you view a wiki
-        expected_dict = {
-            "hashed_password": "fake",
-            "account_creation": "1111-11-11",
-            "wikis_uploaded": [],
-            "wiki_history": ["filename"],
-            "pfp_filename": None,
-            "about_me": ""
-        }
-        # calls to backend
-        result = backend.update_wikihistory(fake_username, file_viewed)
+    # calls to backend
+    result = backend.update_wikihistory(fake_username, file_viewed)
 
-        # checks if result matches and is of type dictionary
-        assert isinstance(result, dict)
-        assert result == expected_dict
+    # checks if result matches and is of type dictionary
+    expected_dict = {"wiki_history": ["filename"]}
+    assert isinstance(result, dict)
+    assert result == expected_dict
 
-        # checks that blob is called
-        backend.user_bucket.blob.assert_called_with(fake_username)
-        mock_method.assert_called_once()
-        fake_blob.upload_from_string.assert_called_once()
-        fake_blob.upload_from_string.assert_called_once_with(
-            json.dumps(expected_dict), content_type='application/json')
+    # only the history part is read and written
+    backend.user_bucket.blob.assert_called_with('_history/fake username.json')
+    fake_blob.download_as_string.assert_called_once()
+    fake_blob.upload_from_string.assert_called_once_with(
+        json.dumps(expected_dict).encode('utf-8'),
+        content_type='application/json',
+        if_generation_match=4)
 
 
 def test_update_wikihistory_autoadjust(backend, fake_blob):
@@ -1025,283 +1469,375 @@ def test_update_wikihistory_autoadjust(backend, fake_blob):
         final_array.append(name)
     final_array.append("filename11")
 
-    # creates return value from get_user_account method
-    getter = {
-        "hashed_password": "fake",
-        "account_creation": "1111-11-11",
-        "wikis_uploaded": [],
-        "wiki_history": big_array,
-        "pfp_filename": None,
-        "about_me": ""
-    }
-    # injects return value into get_user_account
-    with patch.object(Backend, 'get_user_account',
-                      return_value=getter) as mock_method:
-        # expected dictionary of what it should be when you view a wiki
+    # the history part of the account
+    fake_blob.download_as_string.return_value = json.dumps(
+        {"wiki_history": big_array})
+    fake_blob.generation = 4
 
-        expected_dict = {
-            "hashed_password": "fake",
-            "account_creation": "1111-11-11",
-            "wikis_uploaded": [],
-            "wiki_history": final_array,
-            "pfp_filename": None,
-            "about_me": ""
-        }
-        # calls to backend
-        result = backend.update_wikihistory(fake_username, file_viewed)
+    # calls to backend
+    result = backend.update_wikihistory(fake_username, file_viewed)
 
-        # checks if result matches and is of type dictionary
-        assert isinstance(result, dict)
-        assert result == expected_dict
+    # checks if result matches and is of type dictionary
+    expected_dict = {"wiki_history": final_array}
+    assert isinstance(result, dict)
+    assert result == expected_dict
 
-        # checks that blob is called
-        backend.user_bucket.blob.assert_called_with(fake_username)
-        mock_method.assert_called_once()
-        fake_blob.upload_from_string.assert_called_once()
-        fake_blob.upload_from_string.assert_called_once_with(
-            json.dumps(expected_dict), content_type='application/json')
+    # only the history part is written
+    backend.user_bucket.blob.assert_called_with('_history/fake username.json')
+    fake_blob.upload_from_string.assert_called_once_with(
+        json.dumps(expected_dict).encode('utf-8'),
+        content_type='application/json',
+        if_generation_match=4)
 
 
 def test_update_wikihistory_same_view(backend, fake_blob):
     fake_username = 'fake username'
     file_viewed = 'filename2'
 
-    # creates return value from get_user_account method
-    getter = {
-        "hashed_password": "fake",
-        "account_creation": "1111-11-11",
-        "wikis_uploaded": [],
-        "wiki_history": ["filename1", "filename2", "filename3"],
-        "pfp_filename": None,
-        "about_me": ""
-    }
+    # the history part of the account
+    fake_blob.download_as_string.return_value = json.dumps(
+        {"wiki_history": ["filename1", "filename2", "filename3"]})
+    fake_blob.generation = 4
 
-    # injects return value into get_user_account
-    with patch.object(Backend, 'get_user_account',
-                      return_value=getter) as mock_method:
-        # expected dictionary of what it should be when you view a wiki
-        expected_dict = {
-            "hashed_password": "fake",
-            "account_creation": "1111-11-11",
-            "wikis_uploaded": [],
-            "wiki_history": ["filename1", "filename3", "filename2"],
-            "pfp_filename": None,
-            "about_me": ""
-        }
-        # calls to backend
-        result = backend.update_wikihistory(fake_username, file_viewed)
+    # calls to backend
+    result = backend.update_wikihistory(fake_username, file_viewed)
 
-        # checks if result matches and is of type dictionary
-        assert isinstance(result, dict)
-        assert result == expected_dict
+    # checks if result matches and is of type dictionary
+    expected_dict = {"wiki_history": ["filename1", "filename3", "filename2"]}
+    assert isinstance(result, dict)
+    assert result == expected_dict
 
-        # checks that blob is called
-        backend.user_bucket.blob.assert_called_with(fake_username)
-        mock_method.assert_called_once()
-        fake_blob.upload_from_string.assert_called_once()
-        fake_blob.upload_from_string.assert_called_once_with(
-            json.dumps(expected_dict), content_type='application/json')
+    # only the history part is written
+    backend.user_bucket.blob.assert_called_with('_history/fake username.json')
+    fake_blob.upload_from_string.assert_called_once_with(
+        json.dumps(expected_dict).encode('utf-8'),
+        content_type='application/json',
+        if_generation_match=4)
 
 
-def test_update_wikiupload(backend, fake_blob):
+def test_update_wikihistory_of_account_from_before_the_split(
+        backend, fake_blob):
     fake_username = 'fake username'
-    file_uploaded = 'filename'
 
-    # creates return value from get_user_account method
-    getter = {
+    # the account has no history part yet , only the single object it used to be
+    legacy_account = json.dumps({
         "hashed_password": "fake",
         "account_creation": "1111-11-11",
         "wikis_uploaded": [],
-        "wiki_history": [],
+        "wiki_history": ["filename1"],
         "pfp_filename": None,
         "about_me": ""
-    }
+    })
+    fake_blob.download_as_string.side_effect = [NotFound(''), legacy_account]
 
-    with patch.object(Backend, 'get_user_account',
-                      return_value=getter) as mock_method:
-        # expected dictionary of what it should be when you view a wiki
-        expected_dict = {
-            "hashed_password": "fake",
-            "account_creation": "1111-11-11",
-            "wikis_uploaded": ["filename"],
-            "wiki_history": [],
-            "pfp_filename": None,
-            "about_me": ""
-        }
+    result = backend.update_wikihistory(fake_username, 'filename2')
 
-        # calls to backend
-        result = backend.update_wikiupload(fake_username, file_uploaded)
+    # the history part is created from the history stored with the credentials
+    assert result == {"wiki_history": ["filename1", "filename2"]}
+    fake_blob.upload_from_string.assert_called_once_with(
+        json.dumps(result).encode('utf-8'),
+        content_type='application/json',
+        if_generation_match=0)
 
-        # checks if result matches and is of type dictionary
-        assert isinstance(result, dict)
-        assert result == expected_dict
 
-        # asserts
-        backend.user_bucket.blob.assert_called_with(fake_username)
-        mock_method.assert_called_once()
-        fake_blob.upload_from_string.assert_called_once()
-        fake_blob.upload_from_string.assert_called_once_with(
-            json.dumps(expected_dict), content_type='application/json')
+def test_update_wikiupload(backend, fake_blob):
+    fake_username = 'fake username'
+    file_uploaded = 'filename'
+
+    # the uploads part of the account
+    fake_blob.download_as_string.return_value = '{"wikis_uploaded": []}'
+    fake_blob.generation = 4
+
+    # calls to backend
+    result = backend.update_wikiupload(fake_username, file_uploaded)
+
+    # checks if result matches and is of type dictionary
+    expected_dict = {"wikis_uploaded": ["filename"]}
+    assert isinstance(result, dict)
+    assert result == expected_dict
+
+    # only the uploads part is read and written
+    backend.user_bucket.blob.assert_called_with('_uploads/fake username.json')
+    fake_blob.download_as_string.assert_called_once()
+    fake_blob.upload_from_string.assert_called_once_with(
+        json.dumps(expected_dict).encode('utf-8'),
+        content_type='application/json',
+        if_generation_match=4)
 
 
 def test_update_bio(backend, fake_blob):
     fake_username = 'fake username'
 
-    getter = {
-        "hashed_password": "fake",
-        "account_creation": "1111-11-11",
-        "wikis_uploaded": [],
-        "wiki_history": [],
-        "pfp_filename": None,
-        "about_me": ""
-    }
+    # the profile part of the account
+    fake_blob.download_as_string.return_value = '{"pfp_filename": null, "about_me": ""}'
+    fake_blob.generation = 4
 
-    with patch.object(Backend, 'get_user_account',
-                      return_value=getter) as mock_method:
-        # expected dictionary of what it should be when you view a wiki
-        expected_dict = {
-            "hashed_password": "fake",
-            "account_creation": "1111-11-11",
-            "wikis_uploaded": [],
-            "wiki_history": [],
-            "pfp_filename": None,
-            "about_me": "This is my fake bio"
-        }
-        bio = "This is my fake bio"
-        result = backend.update_bio(fake_username, bio)
+    bio = "This is my fake bio"
+    result = backend.update_bio(fake_username, bio)
 
-        # assert that the blob exists
-        backend.user_bucket.blob.assert_called_with(fake_username)
-
-        # checks if result matches and is of type dictionary
-        assert isinstance(result, dict)
-        assert result == expected_dict
+    # checks if result matches and is of type dictionary
+    expected_dict = {"pfp_filename": None, "about_me": "This is my fake bio"}
+    assert isinstance(result, dict)
+    assert result == expected_dict
 
-        # further assertions
-        mock_method.assert_called_once()
-        fake_blob.upload_from_string.assert_called_once()
-        fake_blob.upload_from_string.assert_called_once_with(
-            json.dumps(expected_dict), content_type='application/json')
+    # only the profile part is read and written
+    backend.user_bucket.blob.assert_called_with('_profile/fake username.json')
+    fake_blob.download_as_string.assert_called_once()
+    fake_blob.upload_from_string.assert_called_once_with(
+        json.dumps(expected_dict).encode('utf-8'),
+        content_type='application/json',
+        if_generation_match=4)
 
 
 # how am I checking the photo contents in the end
 def test_update_pfp_no_existence(backend, fake_blob):
     fake_username = "fake username"
     photo_name = fake_username + ".jpg"
-    file = b'Fake_Image_Data'
+    file = io.BytesIO(b'Fake_Image_Data')
 
-    getter = {
-        "hashed_password": "fake",
-        "account_creation": "1111-11-11",
-        "wikis_uploaded": [],
-        "wiki_history": [],
-        "pfp_filename": None,
-        "about_me": ""
-    }
+    # the profile part of the account
+    fake_blob.download_as_string.return_value = '{"pfp_filename": null, "about_me": ""}'
+    fake_blob.generation = 4
 
     # checking user photo blob exits in the bucket or not
-    with patch('google.cloud.storage.Blob.exists') as mock_exists:
+    with patch.object(fake_blob, 'exists') as mock_exists, patch(
+            'flaskr.backend.make_thumbnails') as mock_thumbnails:
         mock_exists.return_value = False
-        with patch.object(Backend, 'get_user_account',
-                          return_value=getter) as mock_method:
-            # expected dictionary of what it should be when you view a wiki
-            expected_dict = {
-                "hashed_password": "fake",
-                "account_creation": "1111-11-11",
-                "wikis_uploaded": [],
-                "wiki_history": [],
-                "pfp_filename": photo_name,
-                "about_me": ""
-            }
-            # fake_blob.upload_from_file.return_value = file
-            result = backend.update_pfp(fake_username, file)
-
-            # checks if result matches and is of type dictionary
-            assert isinstance(result, dict)
-            assert result == expected_dict
-
-            # assert that the blob is called from buckets
-            backend.user_bucket.blob.assert_called_with(photo_name)
-
-            # assert that your get_accounts is being called
-            mock_method.assert_called_once()
-
-            # checks that upload from file is getting called with parameters
-            fake_blob.upload_from_file.assert_called_once()
-            fake_blob.upload_from_file.assert_called_once_with(
-                b'Fake_Image_Data', if_generation_match=0)
+        mock_thumbnails.return_value = {'avatar': b'avatar', 'card': b'card'}
+        # expected dictionary of what it should be when you view a wiki
+        expected_dict = {"pfp_filename": photo_name, "about_me": ""}
+        result = backend.update_pfp(fake_username, file)
 
-            # checks if upload from string is getting called with parameters
-            fake_blob.upload_from_string.assert_called_once()
-            fake_blob.upload_from_string.assert_called_once_with(
-                json.dumps(expected_dict), content_type='application/json')
+        # checks if result matches and is of type dictionary
+        assert isinstance(result, dict)
+        assert result == expected_dict
+        mock_thumbnails.assert_called_once_with(b'Fake_Image_Data')
+
+        # assert that the photo, its sizes and then the profile part are written
+        assert [
+            call.args[0] for call in backend.user_bucket.blob.call_args_list
+        ] == [
+            photo_name, photo_name, '_pfp/fake username/avatar.jpg',
+            '_pfp/fake username/card.jpg', '_pfp/fake username/full.jpg',
+            '_profile/fake username.json', '_profile/fake username.json'
+        ]
+
+        # checks that upload from string is getting called with parameters
+        assert fake_blob.upload_from_string.call_args_list == [
+            ((b'Fake_Image_Data',), {
+                'content_type': 'image/jpeg',
+                'if_generation_match': 0
+            }),
+            ((b'avatar',), {
+                'content_type': 'image/jpeg'
+            }),
+            ((b'card',), {
+                'content_type': 'image/jpeg'
+            }),
+            ((json.dumps(expected_dict).encode('utf-8'),), {
+                'content_type': 'application/json',
+                'if_generation_match': 4
+            }),
+        ]
+
+        # there was no old photo whose sizes could be left behind
+        fake_blob.delete.assert_not_called()
 
 
 def test_update_pfp_with_existence(backend, fake_blob):
     fake_username = "fake username"
     photo_name = fake_username + ".jpg"
-    file = b'Fake_Image_Data'
+    file = io.BytesIO(b'Fake_Image_Data')
 
-    getter = {
-        "hashed_password": "fake",
-        "account_creation": "1111-11-11",
-        "wikis_uploaded": [],
-        "wiki_history": [],
-        "pfp_filename": "we_exist_alr_bro!!",
-        "about_me": ""
-    }
+    # the profile part of the account
+    fake_blob.download_as_string.return_value = '{"pfp_filename": "we_exist_alr_bro!!", "about_me": ""}'
+    fake_blob.generation = 4
 
     # checking user photo blob exits in the bucket or not
-    with patch('google.cloud.storage.Blob.exists') as mock_exists:
+    with patch.object(fake_blob, 'exists') as mock_exists, patch(
+            'flaskr.backend.make_thumbnails') as mock_thumbnails:
         mock_exists.return_value = True
-        with patch.object(Backend, 'get_user_account',
-                          return_value=getter) as mock_method:
-            # expected dictionary of what it should be when you view a wiki
-            expected_dict = {
-                "hashed_password": "fake",
-                "account_creation": "1111-11-11",
-                "wikis_uploaded": [],
-                "wiki_history": [],
-                "pfp_filename": photo_name,
-                "about_me": ""
-            }
-
-            # fake_blob.upload_from_file.return_value = file
-            result = backend.update_pfp(fake_username, file)
+        # the new photo could not be resized
+        mock_thumbnails.return_value = {}
+        # expected dictionary of what it should be when you view a wiki
+        expected_dict = {"pfp_filename": photo_name, "about_me": ""}
 
-            # assert that the blob is called from buckets
-            backend.user_bucket.blob.assert_called_with(photo_name)
+        result = backend.update_pfp(fake_username, file)
 
-            # checks if result matches and is of type dictionary
-            assert isinstance(result, dict)
-            assert result == expected_dict
+        # checks if result matches and is of type dictionary
+        assert isinstance(result, dict)
+        assert result == expected_dict
 
-            # assert that your get_accounts is being called
-            mock_method.assert_called_once()
+        # the old photo and its three sizes are deleted
+        assert fake_blob.delete.call_count == 4
 
-            # checks that upload from file is getting called with parameters
-            fake_blob.upload_from_file.assert_called_once()
-            fake_blob.upload_from_file.assert_called_once_with(
-                b'Fake_Image_Data', if_generation_match=0)
+        # checks if upload from string is getting called with parameters
+        assert fake_blob.upload_from_string.call_args_list == [
+            ((b'Fake_Image_Data',), {
+                'content_type': 'image/jpeg',
+                'if_generation_match': 0
+            }),
+            ((json.dumps(expected_dict).encode('utf-8'),), {
+                'content_type': 'application/json',
+                'if_generation_match': 4
+            }),
+        ]
 
-            # checks if upload from string is getting called with parameters
-            fake_blob.upload_from_string.assert_called_once()
-            fake_blob.upload_from_string.assert_called_once_with(
-                json.dumps(expected_dict), content_type='application/json')
 
+def test_filter_by_year(backend, sort_index):
+    result = backend.filter_by_year('2021')
+    expected = [['Older', 2, 2], ['Title', 1, 0]]
 
-def test_filter_by_year(backend, fake_blob):
-    with patch('flaskr.backend.Backend.title_date') as mock_title_date:
-        mock_title_date.return_value = {
-            ('wikipage1', 0, 1): '2022-01-03',
-            ('wikipage2', 0, 1): '2023-01-04',
-            ('wikipage3', 0, 1): '2024-01-05',
-            ('wikipage4', 0, 1): '2024-01-08'
+    assert result == expected
+    assert backend.filter_by_year('1999') == []
+
+
+def test_filter_by_dates(backend, sort_index):
+    assert backend.filter_by_dates('2021-01-01',
+                                   '2022-02-01') == [['Page1', 0, 1],
+                                                     ['Older', 2, 2],
+                                                     ['Title', 1, 0]]
+    assert backend.filter_by_dates('2021-01-02',
+                                   '2022-12-31') == [['Page1', 0, 1]]
+    assert backend.filter_by_dates('2022-02-02', '2022-12-31') == []
+
+    # The dates must be zero-padded to be compared.
+    with pytest.raises(ValueError):
+        backend.filter_by_dates('2021-1-1', '2022-12-31')
+
+
+def test_year_counts(backend, page1_row):
+    backend.catalog.rows.return_value = [
+        dict(page1_row, name=name, date_created=date)
+        for name, date in [('Older', '2021-01-01'), (
+            'Page1', '2022-02-01'), ('Title', '2021-01-01')]
+    ]
+    assert backend.year_counts() == {'2022': 1, '2021': 2}
+
+    # The counts come from the snapshot the listing reads , not from the sort index.
+    backend.catalog.rows.return_value = []
+    assert backend.year_counts() == {'2022': 1, '2021': 2}
+
+    # A saved page is counted right away , without reading the catalog again.
+    backend._page_saved('Title.txt', {
+        'upvotes': 1,
+        'downvotes': 0,
+        'date_created': '2023-03-03'
+    }, 64)
+    assert backend.year_counts() == {'2023': 1, '2022': 1, '2021': 1}
+    backend.catalog.rows.assert_called_once()
+
+
+def test_profile_picture_is_streamed_in_chunks():
+    backend = Backend(storage_client=MemoryClient())
+    backend.sign_up('user1', 'password')
+    with pytest.raises(ValueError):
+        backend.open_profile_picture('user1')
+
+    backend.update_pfp('user1', io.BytesIO(b'Fake_Image_Data'))
+    blob = backend.open_profile_picture('user1')
+    assert (blob.name, blob.size) == ('user1.jpg', 15)
+
+    # Without resized variants, every size is the original picture.
+    assert backend.open_profile_picture('user1', 'avatar').name == 'user1.jpg'
+
+    chunks = list(backend.stream_blob(blob, chunk_size=4))
+    assert chunks == [b'Fake', b'_Ima', b'ge_D', b'ata']
+    assert list(backend.stream_blob(blob, 5, 10,
+                                    chunk_size=4)) == [b'Imag', b'e']
+
+    with pytest.raises(ValueError):
+        backend.open_profile_picture('nobody')
+
+
+def test_profile_picture_sizes():
+    backend = Backend(storage_client=MemoryClient())
+    backend.sign_up('user1', 'password')
+    with patch('flaskr.backend.make_thumbnails') as mock_thumbnails:
+        mock_thumbnails.return_value = {
+            'avatar': b'avatar',
+            'card': b'card',
+            'full': b'full'
         }
-
-        given_year = "2024"
-        expected = [('wikipage3', 0, 1), ('wikipage4', 0, 1)]
-        result = backend.filter_by_year(given_year)
-
-        assert result == expected
-        backend.title_date.assert_called_once()
+        backend.update_pfp('user1', io.BytesIO(b'Fake_Image_Data'))
+
+    assert backend.open_profile_picture(
+        'user1', 'avatar').name == '_pfp/user1/avatar.jpg'
+    assert backend.open_profile_picture('user1').name == 'user1.jpg'
+    assert backend.open_profile_picture('user1', 'huge').name == 'user1.jpg'
+
+    # A new photo that could not be resized does not leave the sizes of the old one behind.
+    with patch('flaskr.backend.make_thumbnails') as mock_thumbnails:
+        mock_thumbnails.return_value = {}
+        backend.update_pfp('user1', io.BytesIO(b'New_Image_Data'))
+    assert backend.open_profile_picture('user1', 'avatar').name == 'user1.jpg'
+
+
+def test_large_pages_are_stored_compressed():
+    backend = Backend(storage_client=MemoryClient())
+    content = 'A lovely park by the river. ' * 1000
+    backend.upload(io.BytesIO(content.encode('utf-8')), 'Park.txt',
+                   'fake_author')
+    backend.upload(io.BytesIO(b'A lovely lake'), 'Lake.txt', 'fake_author')
+
+    park = backend.info_bucket.get_blob('Park.txt')
+    assert park.content_encoding == 'gzip'
+    assert park.size < len(content) // 10
+    assert backend.catalog.rows()[1]['size'] == park.size
+
+    # Small pages are not worth compressing.
+    assert backend.info_bucket.get_blob('Lake.txt').content_encoding is None
+
+    # Both are read the same way, from storage and from the cache.
+    for attempt in range(2):
+        assert backend.get_wiki_page('Park.txt')['content'] == content
+        assert backend.get_wiki_page('Lake.txt')['content'] == 'A lovely lake'
+
+
+def test_compress_pages():
+    backend = Backend(storage_client=MemoryClient())
+    content = 'A lovely park by the river. ' * 1000
+    backend.upload(io.BytesIO(content.encode('utf-8')), 'Park.txt',
+                   'fake_author')
+    backend.upload(io.BytesIO(b'A lovely lake'), 'Lake.txt', 'fake_author')
+
+    # A page stored before pages were compressed.
+    page = backend.get_wiki_page('Park.txt')
+    legacy = json.dumps(page).encode('utf-8')
+    backend.info_bucket.blob('Park.txt').upload_from_string(
+        legacy, content_type='application/json')
+    assert backend.get_wiki_page('Park.txt')['content'] == content
+
+    count, before, after = backend.compress_pages()
+
+    assert (count, before) == (1, len(legacy))
+    park = backend.info_bucket.get_blob('Park.txt')
+    assert (park.content_encoding, park.size) == ('gzip', after)
+    assert backend.get_wiki_page('Park.txt') == page
+    assert backend.catalog.rows()[1]['size'] == after
+
+    # Compressed and small pages are left alone.
+    assert backend.compress_pages() == (0, 0, 0)
+
+
+def test_binary_records():
+    storage_client = MemoryClient()
+    backend = Backend(storage_client=storage_client)
+    backend.sign_up('user1', 'password')
+    backend.upload(io.BytesIO(b'A lovely lake'), 'Lake.txt', 'user1')
+
+    # Switching codecs does not make what was stored before unreadable.
+    backend = Backend(storage_client=storage_client, record_codec='binary')
+    content = 'A lovely park by the river. ' * 1000
+    backend.upload(io.BytesIO(content.encode('utf-8')), 'Park.txt', 'user1')
+    backend.upload(io.BytesIO(b'A small pond'), 'Pond.txt', 'user1')
+    backend.update_bio('user1', 'Likes parks')
+
+    pond = backend.info_bucket.blob('Pond.txt').download_as_bytes()
+    assert pond.startswith(BINARY_MAGIC)
+    assert backend.get_wiki_page('Pond.txt')['content'] == 'A small pond'
+    assert backend.get_wiki_page('Park.txt')['content'] == content
+    assert backend.get_wiki_page('Lake.txt')['content'] == 'A lovely lake'
+
+    assert backend.sign_in('user1', 'password') is not None
+    assert backend.get_user_account('user1')['about_me'] == 'Likes parks'
@@ -0,0 +1,572 @@
+'''
+Storage clients that can stand in for google cloud storage.
+
+The Backend only ever talks to a client, the buckets it hands out and the blobs inside
+those buckets. Every class here mirrors the subset of the google.cloud.storage API that
+the wiki uses (same method names, same keyword arguments and the same NotFound and
+PreconditionFailed errors), so the Backend works unchanged on top of any of them.
+
+Contains two storage implementations besides GCS itself:
+MemoryClient keeps every blob in a dictionary, which is handy for tests and benchmarks.
+LocalClient keeps every blob as a file under a root directory, so a wiki can be served from local disk.
+
+Also contains the process-wide registry of clients and buckets returned by shared_client and shared_bucket,
+so every part of the wiki reuses the same client, and with it the same pool of HTTP connections. The storage
+they use when not given one is picked with configure_storage.
+'''
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from google.cloud import storage
+import abc
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+import time
+
+_generation_lock = threading.Lock()
+_last_generation = 0
+
+# The clients and buckets shared by the whole process, and the process they were created in.
+_registry_lock = threading.Lock()
+_shared_clients = {}
+_shared_buckets = {}
+_registry_pid = None
+
+# The (kind, root) of the storage used when none is given, as picked by configure_storage.
+_default_storage = ('gcs', None)
+
+
+def _next_generation():
+    ''' Returns a new, strictly increasing generation number.
+        Like GCS, generations are microsecond timestamps, so they stay unique across restarts.
+    '''
+    global _last_generation
+    with _generation_lock:
+        _last_generation = max(_last_generation + 1, time.time_ns() // 1000)
+        return _last_generation
+
+
+class Blob:
+    '''
+    A named object stored inside a MemoryBucket or a LocalBucket.
+
+    Just like a google cloud storage blob, creating one does not touch storage. Its properties are only
+    filled in after a download, an upload, a reload or when it is returned by list_blobs.
+
+    Attributes:
+        name = The name of the object inside its bucket.
+        bucket = The bucket this blob belongs to.
+        generation = Version number of the object's data; it changes on every write.
+        size = Size of the object's data in bytes.
+        content_type = The MIME type the object was uploaded with.
+        content_encoding = The encoding the object was uploaded with, if any.
+        etag = Hash of the object's data.
+        updated = Time of the last write, as seconds since the epoch.
+        chunk_size = Size of the parts GCS uploads a file in; ignored here since the data is stored at once.
+    '''
+
+    def __init__(self, name, bucket):
+        '''Initializes a Blob object'''
+        self.name = name
+        self.bucket = bucket
+        self.chunk_size = None
+        self.content_type = None
+        self.content_encoding = None
+        self._set_properties({})
+
+    def _set_properties(self, properties):
+        '''Copies the stored properties of the object onto the blob'''
+        self.generation = properties.get('generation')
+        self.size = properties.get('size')
+        self.etag = properties.get('etag')
+        self.updated = properties.get('updated')
+        self.content_type = properties.get('content_type', self.content_type)
+        self.content_encoding = properties.get('content_encoding',
+                                               self.content_encoding)
+
+    def exists(self, client=None):
+        ''' Returns True if the object is currently stored in the bucket.
+            client : Ignored; kept to match the GCS signature.
+        '''
+        try:
+            self.bucket._load(self.name, data=False)
+        except NotFound:
+            return False
+        return True
+
+    def reload(self, client=None):
+        ''' Refreshes the blob's properties without downloading its data.
+            Raises NotFound if the object does not exist.
+        '''
+        _, properties = self.bucket._load(self.name, data=False)
+        self._set_properties(properties)
+
+    def download_as_bytes(self,
+                          client=None,
+                          start=None,
+                          end=None,
+                          raw_download=False,
+                          if_generation_match=None):
+        ''' Returns the object's data as bytes.
+            start, end : Optional inclusive byte range to download, as in GCS.
+            raw_download : Ignored; the data is always returned as it was stored, as GCS does when it is True.
+            if_generation_match : Only download if the stored generation matches this one.
+        '''
+        data, properties = self.bucket._load(self.name)
+        _check_generation(self.name, properties, if_generation_match)
+        self._set_properties(properties)
+        if start is not None or end is not None:
+            start = start or 0
+            end = len(data) if end is None else end + 1
+            data = data[start:end]
+        return data
+
+    def download_as_string(self,
+                           client=None,
+                           start=None,
+                           end=None,
+                           raw_download=False):
+        '''Deprecated GCS alias of download_as_bytes, still used by the wiki'''
+        return self.download_as_bytes(client=client,
+                                      start=start,
+                                      end=end,
+                                      raw_download=raw_download)
+
+    def download_as_text(self, client=None, encoding='utf-8'):
+        '''Returns the object's data decoded as text'''
+        return self.download_as_bytes(client=client).decode(encoding)
+
+    def upload_from_string(self,
+                           data,
+                           content_type='text/plain',
+                           client=None,
+                           if_generation_match=None):
+        ''' Stores data as the object's new contents.
+            data : The str or bytes to be stored. Strings are encoded as UTF-8.
+            content_type : The MIME type to store along with the data.
+            if_generation_match : Only write if the stored generation matches this one (0 means the object must not exist).
+        '''
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._upload(data, content_type, if_generation_match)
+
+    def upload_from_file(self,
+                         file_obj,
+                         rewind=False,
+                         size=None,
+                         content_type=None,
+                         client=None,
+                         if_generation_match=None):
+        ''' Stores everything read from a file object as the object's new contents.
+            file_obj : An open file object, read from its current position.
+            rewind : If True, seek to the beginning of the file before reading.
+            size : Number of bytes to read; reads until the end of the file by default.
+        '''
+        if rewind:
+            file_obj.seek(0)
+        data = file_obj.read() if size is None else file_obj.read(size)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._upload(
+            data, content_type or self.content_type or
+            'application/octet-stream', if_generation_match)
+
+    def _upload(self, data, content_type, if_generation_match):
+        '''Writes data to the bucket, honoring the generation precondition'''
+        properties = {
+            'content_type': content_type,
+            'content_encoding': self.content_encoding,
+            'size': len(data),
+            'etag': hashlib.md5(data).hexdigest(),
+            'updated': time.time(),
+        }
+        with self.bucket._lock:
+            _check_generation(self.name, self.bucket._current(self.name),
+                              if_generation_match)
+            properties['generation'] = _next_generation()
+            self.bucket._store(self.name, data, properties)
+        self._set_properties(properties)
+
+    def delete(self, client=None, if_generation_match=None):
+        ''' Removes the object from the bucket.
+            Raises NotFound if the object does not exist.
+        '''
+        with self.bucket._lock:
+            properties = self.bucket._current(self.name)
+            if properties is None:
+                raise NotFound(
+                    f'No such object: {self.bucket.name}/{self.name}')
+            _check_generation(self.name, properties, if_generation_match)
+            self.bucket._remove(self.name)
+
+
+def _check_generation(name, properties, if_generation_match):
+    ''' Raises PreconditionFailed if the stored generation differs from the expected one.
+        properties : Stored properties of the object, or None if it does not exist.
+    '''
+    if if_generation_match is None:
+        return
+    current = properties['generation'] if properties else 0
+    if current != if_generation_match:
+        raise PreconditionFailed(
+            f'Generation {if_generation_match} does not match {current} for {name}'
+        )
+
+
+class Bucket(abc.ABC):
+    '''
+    Base class for the buckets handed out by MemoryClient and LocalClient.
+
+    Subclasses only need to know how to load, store, remove and list raw objects; the
+    blob-level behaviour (preconditions, generations, ranges) is shared. A subclass that leaves any
+    of them out can not be created.
+
+    Attributes:
+        name = The name of the bucket.
+        client = The client that created this bucket.
+    '''
+
+    def __init__(self, client, name):
+        '''Initializes a Bucket object'''
+        self.client = client
+        self.name = name
+        self._lock = threading.RLock()
+
+    def blob(self, blob_name):
+        '''Returns a Blob object for the given name without touching storage'''
+        return Blob(blob_name, self)
+
+    def get_blob(self, blob_name):
+        '''Returns the Blob with its properties loaded, or None if it does not exist'''
+        blob = self.blob(blob_name)
+        try:
+            blob.reload()
+        except NotFound:
+            return None
+        return blob
+
+    def list_blobs(self,
+                   max_results=None,
+                   prefix=None,
+                   start_offset=None,
+                   end_offset=None):
+        '''Lists the blobs in this bucket; see Client.list_blobs'''
+        return self.client.list_blobs(self,
+                                      max_results=max_results,
+                                      prefix=prefix,
+                                      start_offset=start_offset,
+                                      end_offset=end_offset)
+
+    def _current(self, name):
+        '''Returns the stored properties of an object, or None if it does not exist'''
+        try:
+            return self._load(name, data=False)[1]
+        except NotFound:
+            return None
+
+    @abc.abstractmethod
+    def _load(self, name, data=True):
+        ''' Returns a (data, properties) tuple for a stored object, raising NotFound if missing.
+            data : If False, only the properties are loaded and None is returned in place of the data.
+        '''
+
+    @abc.abstractmethod
+    def _store(self, name, data, properties):
+        '''Stores the data and properties of an object, replacing any previous version'''
+
+    @abc.abstractmethod
+    def _remove(self, name):
+        '''Removes a stored object'''
+
+    @abc.abstractmethod
+    def _names(self, prefix):
+        '''Returns the names of all the stored objects starting with prefix'''
+
+
+class MemoryBucket(Bucket):
+    '''A bucket that keeps its objects in a dictionary for the lifetime of the process.'''
+
+    def __init__(self, client, name):
+        '''Initializes a MemoryBucket object'''
+        super().__init__(client, name)
+        self._objects = {}
+
+    def _load(self, name, data=True):
+        try:
+            stored_data, properties = self._objects[name]
+        except KeyError:
+            raise NotFound(f'No such object: {self.name}/{name}')
+        return (stored_data if data else None), dict(properties)
+
+    def _store(self, name, data, properties):
+        self._objects[name] = (bytes(data), dict(properties))
+
+    def _remove(self, name):
+        del self._objects[name]
+
+    def _names(self, prefix):
+        return [name for name in self._objects if name.startswith(prefix)]
+
+
+class LocalBucket(Bucket):
+    '''
+    A bucket stored as a directory on the local filesystem.
+
+    Every object is a plain file at <root>/<bucket name>/<object name>, so existing files can be
+    copied in by hand. Properties such as the generation and content type live in a sidecar
+    JSON file under <root>/.meta/<bucket name>/ and are derived from the file itself when missing.
+    '''
+
+    def __init__(self, client, name):
+        '''Initializes a LocalBucket object'''
+        super().__init__(client, name)
+        self.directory = os.path.join(client.root, name)
+        self.meta_directory = os.path.join(client.root, '.meta', name)
+
+    def _path(self, directory, name, suffix=''):
+        '''Returns the file path of an object, refusing names that escape the bucket'''
+        parts = name.split('/')
+        if not name or name.startswith('/') or '..' in parts:
+            raise ValueError(f'Invalid object name: {name!r}')
+        return os.path.join(directory, *parts) + suffix
+
+    def _load(self, name, data=True):
+        path = self._path(self.directory, name)
+        try:
+            with open(self._path(self.meta_directory, name, '.json')) as meta:
+                properties = json.load(meta)
+        except (FileNotFoundError, ValueError):
+            properties = None
+        try:
+            if data:
+                with open(path, 'rb') as file:
+                    stored_data = file.read()
+            stat = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            raise NotFound(f'No such object: {self.name}/{name}')
+
+        # Files copied in by hand have no sidecar, so describe them from the filesystem.
+        if properties is None:
+            properties = {
+                'generation':
+                    stat.st_mtime_ns // 1000,
+                'size':
+                    stat.st_size,
+                'updated':
+                    stat.st_mtime,
+                'content_type':
+                    mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            }
+        return (stored_data if data else None), properties
+
+    def _store(self, name, data, properties):
+        path = self._path(self.directory, name)
+        meta_path = self._path(self.meta_directory, name, '.json')
+        _write_atomically(path, data)
+        _write_atomically(meta_path, json.dumps(properties).encode('utf-8'))
+
+    def _remove(self, name):
+        os.remove(self._path(self.directory, name))
+        try:
+            os.remove(self._path(self.meta_directory, name, '.json'))
+        except FileNotFoundError:
+            pass
+
+    def _names(self, prefix):
+        names = []
+        for directory, _, files in os.walk(self.directory):
+            relative = os.path.relpath(directory, self.directory)
+            for file in files:
+                if file.startswith('.tmp-'):
+                    continue
+                name = file if relative == '.' else '/'.join(
+                    relative.split(os.sep) + [file])
+                if name.startswith(prefix):
+                    names.append(name)
+        return names
+
+
+def _write_atomically(path, data):
+    '''Writes data to path through a temporary file so readers never see a partial write'''
+    directory, file = os.path.split(path)
+    os.makedirs(directory, exist_ok=True)
+    temporary_path = os.path.join(directory,
+                                  f'.tmp-{file}-{threading.get_ident()}')
+    with open(temporary_path, 'wb') as temporary_file:
+        temporary_file.write(data)
+    os.replace(temporary_path, path)
+
+
+class Client(abc.ABC):
+    '''
+    Base class for the storage clients, mirroring google.cloud.storage.Client.
+
+    Buckets are created on first use and the same bucket object is returned on every call.
+    Subclasses set bucket_class to the Bucket subclass they hand out.
+    '''
+
+    @property
+    @abc.abstractmethod
+    def bucket_class(self):
+        '''The Bucket subclass of the buckets this client hands out'''
+
+    def __init__(self):
+        '''Initializes a Client object'''
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, bucket_name):
+        '''Returns the bucket with the given name'''
+        with self._lock:
+            if bucket_name not in self._buckets:
+                self._buckets[bucket_name] = self.bucket_class(
+                    self, bucket_name)
+            return self._buckets[bucket_name]
+
+    def get_bucket(self, bucket_name):
+        '''Same as bucket; kept to match the GCS client'''
+        return self.bucket(bucket_name)
+
+    def list_blobs(self,
+                   bucket_or_name,
+                   max_results=None,
+                   prefix=None,
+                   start_offset=None,
+                   end_offset=None):
+        ''' Returns the blobs of a bucket sorted by name, with their properties loaded.
+            bucket_or_name : A bucket created by this client, or the name of one.
+            max_results : Maximum number of blobs to return; all of them by default.
+            prefix : Only list the objects whose names start with this string.
+            start_offset : Only list the objects whose names are equal to or after this string.
+            end_offset : Only list the objects whose names are before this string.
+        '''
+        bucket = bucket_or_name
+        if isinstance(bucket_or_name, str):
+            bucket = self.bucket(bucket_or_name)
+
+        blobs = []
+        for name in sorted(bucket._names(prefix or '')):
+            if start_offset is not None and name < start_offset:
+                continue
+            if end_offset is not None and name >= end_offset:
+                break
+            if max_results is not None and len(blobs) >= max_results:
+                break
+            blob = bucket.blob(name)
+            try:
+                blob.reload()
+            except NotFound:
+                # The object was deleted while we were listing.
+                continue
+            blobs.append(blob)
+        return blobs
+
+
+class MemoryClient(Client):
+    '''A storage client whose buckets only live in memory.'''
+
+    bucket_class = MemoryBucket
+
+
+class LocalClient(Client):
+    '''
+    A storage client whose buckets are directories on the local filesystem.
+
+    Attributes:
+        root = The directory holding one subdirectory per bucket.
+    '''
+
+    bucket_class = LocalBucket
+
+    def __init__(self, root):
+        '''Initializes a LocalClient object'''
+        super().__init__()
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+
+def make_client(kind='gcs', root=None):
+    ''' Creates the storage client the wiki should use.
+        kind : 'gcs' for google cloud storage, 'local' for a directory on disk or 'memory'.
+        root : The directory used by the 'local' client.
+    '''
+    if kind == 'gcs':
+        return storage.Client()
+    if kind == 'local':
+        if not root:
+            raise ValueError('A root directory is required for local storage')
+        return LocalClient(root)
+    if kind == 'memory':
+        return MemoryClient()
+    raise ValueError(f'Unknown storage backend: {kind}')
+
+
+def _shared_registry():
+    ''' Returns the dictionaries of shared clients and buckets; the caller must hold the registry lock.
+        A forked process starts with empty ones, since sharing the HTTP connections of its parent is not safe.
+    '''
+    global _registry_pid
+    if _registry_pid != os.getpid():
+        _shared_clients.clear()
+        _shared_buckets.clear()
+        _registry_pid = os.getpid()
+    return _shared_clients, _shared_buckets
+
+
+def configure_storage(kind='gcs', root=None):
+    ''' Picks the storage used by shared_client and shared_bucket when they are not given one, such as the
+        storage the app was configured with. Picking memory storage starts a new, empty wiki.
+        kind : 'gcs' for google cloud storage, 'local' for a directory on disk or 'memory'.
+        root : The directory used by the 'local' client.
+    '''
+    global _default_storage
+    with _registry_lock:
+        clients, buckets = _shared_registry()
+        _default_storage = (kind, root)
+        # Forget the clients and buckets handed out for the previous default storage.
+        clients.pop(None, None)
+        for key in [key for key in buckets if key[0] is None]:
+            del buckets[key]
+
+
+def shared_client(kind=None, root=None):
+    ''' Returns the client of this process for the given storage, creating it on first use.
+        Memory clients are not shared: each of them is a separate wiki, except for the default one.
+        kind : 'gcs' for google cloud storage, 'local' for a directory on disk or 'memory'; the storage
+            picked with configure_storage by default.
+        root : The directory used by the 'local' client.
+    '''
+    if kind is None:
+        kind, root = _default_storage
+        if kind == 'memory':
+            with _registry_lock:
+                clients, _ = _shared_registry()
+                if None not in clients:
+                    clients[None] = make_client(kind, root)
+                return clients[None]
+    if kind == 'memory':
+        return make_client(kind, root)
+    with _registry_lock:
+        clients, _ = _shared_registry()
+        key = (kind, root)
+        if key not in clients:
+            clients[key] = make_client(kind, root)
+        return clients[key]
+
+
+def shared_bucket(bucket_name, kind=None, root=None):
+    ''' Returns the bucket with the given name from the client of this process for the given storage.
+        bucket_name : Name of the bucket, such as 'wiki_login'.
+        kind : 'gcs' for google cloud storage or 'local' for a directory on disk; the storage picked with
+            configure_storage by default.
+        root : The directory used by the 'local' client.
+    '''
+    client = shared_client(kind, root)
+    with _registry_lock:
+        _, buckets = _shared_registry()
+        key = (kind, root, bucket_name)
+        if key not in buckets:
+            buckets[key] = client.bucket(bucket_name)
+        return buckets[key]
@@ -0,0 +1,234 @@
+from flaskr.blobstore import Bucket, Client, LocalClient, MemoryClient, configure_storage, make_client, shared_bucket, shared_client
+from flaskr.backend import Backend, User
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from unittest.mock import patch
+import pytest
+import io
+import os
+
+
+@pytest.fixture(params=['memory', 'local'])
+def client(request, tmp_path):
+    ''' Every test using this fixture runs once against each storage implementation '''
+
+    if request.param == 'memory':
+        return MemoryClient()
+    return LocalClient(str(tmp_path))
+
+
+@pytest.fixture
+def bucket(client):
+    return client.bucket('wiki_info')
+
+
+def test_upload_and_download(bucket):
+    blob = bucket.blob('page.txt')
+    blob.upload_from_string('{"content": "hello"}',
+                            content_type='application/json')
+
+    # A fresh blob object should read back what was stored.
+    stored = bucket.blob('page.txt')
+    assert stored.download_as_string() == b'{"content": "hello"}'
+    assert stored.content_type == 'application/json'
+    assert stored.size == 20
+    assert stored.generation == blob.generation
+
+
+def test_download_missing_blob(bucket):
+    with pytest.raises(NotFound):
+        bucket.blob('missing.txt').download_as_bytes()
+
+    assert bucket.blob('missing.txt').exists() == False
+    assert bucket.get_blob('missing.txt') is None
+
+
+def test_download_range(bucket):
+    bucket.blob('image.jpg').upload_from_string(b'0123456789')
+
+    # Like GCS, the end of the range is inclusive.
+    assert bucket.blob('image.jpg').download_as_bytes(start=2, end=4) == b'234'
+    assert bucket.blob('image.jpg').download_as_bytes(start=8) == b'89'
+
+
+def test_upload_from_file(bucket):
+    bucket.blob('photo.jpg').upload_from_file(io.BytesIO(b'Fake_Image_Data'),
+                                              if_generation_match=0)
+
+    assert bucket.blob('photo.jpg').download_as_bytes() == b'Fake_Image_Data'
+
+
+def test_generation_preconditions(bucket):
+    blob = bucket.blob('page.txt')
+    blob.upload_from_string('first', if_generation_match=0)
+    first_generation = blob.generation
+
+    # 0 means the object must not exist yet.
+    with pytest.raises(PreconditionFailed):
+        bucket.blob('page.txt').upload_from_string('again',
+                                                   if_generation_match=0)
+
+    blob.upload_from_string('second', if_generation_match=first_generation)
+    assert blob.generation > first_generation
+
+    # A stale generation is rejected and the data is left untouched.
+    with pytest.raises(PreconditionFailed):
+        blob.upload_from_string('third', if_generation_match=first_generation)
+    assert bucket.blob('page.txt').download_as_bytes() == b'second'
+
+
+def test_delete(bucket):
+    bucket.blob('photo.jpg').upload_from_string(b'data')
+    bucket.blob('photo.jpg').delete()
+
+    assert bucket.blob('photo.jpg').exists() == False
+    with pytest.raises(NotFound):
+        bucket.blob('photo.jpg').delete()
+
+
+def test_list_blobs(client, bucket):
+    for name in ['b.txt', 'a.txt', 'images/c.jpg']:
+        bucket.blob(name).upload_from_string(name)
+
+    # Blobs come back sorted by name, with their properties loaded.
+    blobs = client.list_blobs(bucket)
+    assert [blob.name for blob in blobs] == ['a.txt', 'b.txt', 'images/c.jpg']
+    assert blobs[0].size == 5
+
+    assert [
+        blob.name for blob in client.list_blobs('wiki_info', prefix='images/')
+    ] == ['images/c.jpg']
+
+    # A listing can start and stop at given names, and be cut short.
+    assert [
+        blob.name for blob in client.list_blobs(
+            bucket, start_offset='b.txt', max_results=1)
+    ] == ['b.txt']
+    assert [
+        blob.name for blob in client.list_blobs(bucket, end_offset='b.txt')
+    ] == ['a.txt']
+
+    # Buckets do not share objects.
+    assert client.list_blobs('wiki_login') == []
+
+
+def test_local_client_persists_between_clients(tmp_path):
+    LocalClient(str(tmp_path)).bucket('wiki_info').blob(
+        'page.txt').upload_from_string('kept on disk')
+
+    reopened = LocalClient(str(tmp_path)).bucket('wiki_info')
+    assert reopened.blob('page.txt').download_as_text() == 'kept on disk'
+
+
+def test_local_client_reads_files_copied_in(tmp_path):
+    # Files dropped into a bucket directory by hand are served as blobs too.
+    os.makedirs(tmp_path / 'wiki_info')
+    (tmp_path / 'wiki_info' / 'manish.jpeg').write_bytes(b'Fake_Image_Data')
+
+    bucket = LocalClient(str(tmp_path)).bucket('wiki_info')
+    blob = bucket.get_blob('manish.jpeg')
+    assert blob.content_type == 'image/jpeg'
+    assert blob.download_as_bytes() == b'Fake_Image_Data'
+
+
+def test_local_client_rejects_escaping_names(tmp_path):
+    bucket = LocalClient(str(tmp_path)).bucket('wiki_info')
+
+    with pytest.raises(ValueError):
+        bucket.blob('../wiki_login/someone').upload_from_string('nope')
+
+
+def test_make_client(tmp_path):
+    assert isinstance(make_client('memory'), MemoryClient)
+    assert isinstance(make_client('local', str(tmp_path)), LocalClient)
+
+    with pytest.raises(ValueError):
+        make_client('local')
+    with pytest.raises(ValueError):
+        make_client('floppy')
+
+
+def test_backend_on_storage_implementations(client):
+    ''' Runs a few Backend methods end to end without mocks '''
+
+    backend = Backend(storage_client=client)
+
+    backend.upload(io.BytesIO(b'A lovely park'), 'Park.txt', 'fake_author')
+    assert backend.get_wiki_page('Park.txt')['content'] == 'A lovely park'
+    assert backend.get_all_page_names() == [['Park', 0, 0]]
+
+    backend.update_page('upvote', 'fake_user', 'Park.txt')
+    assert backend.get_all_page_names() == [['Park', 1, 0]]
+
+    user = backend.sign_up('fake_user', 'fake_password')
+    assert isinstance(user, User)
+    assert backend.sign_up('fake_user', 'fake_password') is None
+    assert backend.sign_in('fake_user', 'fake_password').username == 'fake_user'
+    assert backend.sign_in('fake_user', 'wrong_password') is None
+    assert User.get('fake_user', backend.user_bucket).username == 'fake_user'
+    assert User.get('nobody', backend.user_bucket) is None
+
+    backend.update_pfp('fake_user', io.BytesIO(b'Fake_Image_Data'))
+    backend.update_pfp('fake_user', io.BytesIO(b'New_Image_Data'))
+    assert backend.get_user_account(
+        'fake_user')['pfp_filename'] == 'fake_user.jpg'
+
+
+def test_shared_client_is_reused(tmp_path):
+    root = str(tmp_path)
+    client = shared_client('local', root)
+    assert shared_client('local', root) is client
+    assert shared_bucket('wiki_info', 'local', root) is shared_bucket(
+        'wiki_info', 'local', root)
+    assert shared_bucket('wiki_info', 'local', root).client is client
+
+    # Every memory client is a wiki of its own.
+    assert shared_client('memory') is not shared_client('memory')
+
+
+def test_shared_client_is_not_inherited_by_forked_processes(tmp_path):
+    root = str(tmp_path)
+    client = shared_client('local', root)
+    with patch('os.getpid', return_value=os.getpid() + 1):
+        assert shared_client('local', root) is not client
+
+
+def test_incomplete_storage_classes_can_not_be_created():
+
+    class NoRemoveBucket(Bucket):
+
+        def _load(self, name, data=True):
+            return None, {}
+
+        def _store(self, name, data, properties):
+            pass
+
+        def _names(self, prefix):
+            return []
+
+    class NoBucketClient(Client):
+        pass
+
+    with pytest.raises(TypeError):
+        NoRemoveBucket(MemoryClient(), 'wiki_info')
+    with pytest.raises(TypeError):
+        NoBucketClient()
+
+
+def test_default_storage_is_configurable(tmp_path):
+    root = str(tmp_path)
+    try:
+        configure_storage('local', root)
+        assert shared_client() is shared_client('local', root)
+        assert shared_bucket('wiki_login').client is shared_client(
+            'local', root)
+        assert User('user1').bucket is shared_bucket('wiki_login')
+
+        # The default memory storage is one wiki shared by everything using it , until it is picked again.
+        configure_storage('memory')
+        client = shared_client()
+        assert shared_client() is client
+        assert shared_bucket('wiki_login').client is client
+        configure_storage('memory')
+        assert shared_client() is not client
+    finally:
+        configure_storage()
@@ -0,0 +1,162 @@
+'''
+In-process caches sitting in front of the storage buckets.
+
+Contains the BlobCache class, a bounded least-recently-used cache of blob contents. Cached copies are
+trusted for a short time, then checked against the object's generation so an unchanged object is never
+downloaded twice. Also contains the TTLCache class, a bounded cache of values that expire after a while.
+'''
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class _Entry:
+    '''A cached copy of a blob's data and the generation it was read at'''
+
+    def __init__(self, data, generation):
+        self.data = data
+        self.generation = generation
+        self.checked_at = time.monotonic()
+
+
+class BlobCache:
+    '''
+    Keeps the contents of recently read blobs in memory, up to a total size in bytes.
+
+    A cached copy is served without any storage call for ttl seconds after it was read or last checked.
+    After that, the blob's metadata is reloaded and the copy is only downloaded again if the blob's
+    generation changed. Writers should call put (or invalidate) so their own changes are seen right away.
+
+    Attributes:
+        max_bytes = Maximum total size of the cached data. The least recently used entries are dropped first.
+        ttl = Seconds during which a cached copy is served without checking its generation.
+    '''
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl=10):
+        '''Initializes a BlobCache object'''
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, key, data, generation):
+        ''' Caches the data of a blob.
+            key : Name identifying the blob in this cache.
+            data : The blob's contents, as bytes or str.
+            generation : The generation the data belongs to. Data without a generation is not cached.
+        '''
+        with self._lock:
+            self._discard(key)
+            if generation is None or len(data) > self.max_bytes:
+                return
+            self._entries[key] = _Entry(data, generation)
+            self._size += len(data)
+
+            # Drop the least recently used entries until everything fits.
+            while self._size > self.max_bytes:
+                _, entry = self._entries.popitem(last=False)
+                self._size -= len(entry.data)
+
+    def invalidate(self, key):
+        '''Forgets the cached copy of a blob, if any'''
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        '''Forgets every cached copy'''
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _discard(self, key):
+        '''Removes an entry; the caller must hold the lock'''
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry.data)
+
+    def read(self, key, blob, download):
+        ''' Returns the data of a blob, from the cache when the cached copy is still current.
+            key : Name identifying the blob in this cache.
+            blob : The blob to check and download from.
+            download : Function downloading the blob's data, such as blob.download_as_bytes.
+        '''
+        return self.read_with_generation(key, blob, download)[0]
+
+    def read_with_generation(self, key, blob, download):
+        '''Same as read, but returns a (data, generation) tuple'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is not None:
+            if time.monotonic() - entry.checked_at < self.ttl:
+                return entry.data, entry.generation
+
+            # The copy is getting old: a metadata request tells us whether it is still current.
+            try:
+                blob.reload()
+            except Exception:
+                self.invalidate(key)
+                raise
+            if blob.generation == entry.generation:
+                entry.checked_at = time.monotonic()
+                return entry.data, entry.generation
+
+        data = download()
+        self.put(key, data, blob.generation)
+        return data, blob.generation
+
+
+class TTLCache:
+    '''
+    Keeps values in memory for a limited time, up to a number of entries.
+
+    A value is served for ttl seconds after it was put, and then forgotten. Writers should call invalidate
+    when the stored data a value was built from changes.
+
+    Attributes:
+        max_entries = Maximum number of cached values. The least recently used ones are dropped first.
+        ttl = Seconds during which a cached value is served.
+    '''
+
+    def __init__(self, max_entries=1024, ttl=60):
+        '''Initializes a TTLCache object'''
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''Returns the value cached under the key, or None if there is none or it expired'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        '''Caches a value under the key for the next ttl seconds'''
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        '''Forgets the value cached under the key, if any'''
+        with self._lock:
+            self._entries.pop(key, None)
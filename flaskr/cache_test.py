@@ -0,0 +1,150 @@
+from flaskr.backend import Backend
+from flaskr.blobstore import Blob, MemoryClient
+from flaskr.cache import BlobCache, TTLCache
+from freezegun import freeze_time
+from google.api_core.exceptions import NotFound
+from unittest.mock import MagicMock, patch
+import pytest
+import io
+
+
+@pytest.fixture
+def fake_blob():
+    ''' a blob mock at generation 1 whose data is b'page' '''
+
+    fake_blob = MagicMock()
+    fake_blob.generation = 1
+    fake_blob.download_as_bytes.return_value = b'page'
+    return fake_blob
+
+
+def test_read_downloads_once(fake_blob):
+    cache = BlobCache()
+
+    assert cache.read('page.txt', fake_blob,
+                      fake_blob.download_as_bytes) == b'page'
+    assert cache.read('page.txt', fake_blob,
+                      fake_blob.download_as_bytes) == b'page'
+
+    # The second read is served from memory without any storage call.
+    fake_blob.download_as_bytes.assert_called_once()
+    fake_blob.reload.assert_not_called()
+
+
+def test_read_revalidates_after_ttl(fake_blob):
+    cache = BlobCache(ttl=0)
+    cache.read('page.txt', fake_blob, fake_blob.download_as_bytes)
+
+    # Same generation: only the metadata is fetched.
+    assert cache.read('page.txt', fake_blob,
+                      fake_blob.download_as_bytes) == b'page'
+    fake_blob.reload.assert_called_once()
+    fake_blob.download_as_bytes.assert_called_once()
+
+    # New generation: the data is downloaded again.
+    fake_blob.generation = 2
+    fake_blob.download_as_bytes.return_value = b'new page'
+    assert cache.read('page.txt', fake_blob,
+                      fake_blob.download_as_bytes) == b'new page'
+    assert fake_blob.download_as_bytes.call_count == 2
+
+
+def test_read_forgets_deleted_blobs(fake_blob):
+    cache = BlobCache(ttl=0)
+    cache.read('page.txt', fake_blob, fake_blob.download_as_bytes)
+
+    fake_blob.reload.side_effect = NotFound('gone')
+    with pytest.raises(NotFound):
+        cache.read('page.txt', fake_blob, fake_blob.download_as_bytes)
+    assert len(cache) == 0
+
+
+def test_put_and_invalidate(fake_blob):
+    cache = BlobCache()
+    cache.put('page.txt', b'written', 5)
+    assert cache.read('page.txt', fake_blob,
+                      fake_blob.download_as_bytes) == b'written'
+
+    cache.invalidate('page.txt')
+    assert cache.read('page.txt', fake_blob,
+                      fake_blob.download_as_bytes) == b'page'
+
+
+def test_put_evicts_least_recently_used():
+    cache = BlobCache(max_bytes=10)
+    cache.put('a', b'aaaa', 1)
+    cache.put('b', b'bbbb', 1)
+
+    # Reading 'a' makes 'b' the least recently used entry.
+    cache.read('a', MagicMock(), MagicMock())
+    cache.put('c', b'cccc', 1)
+
+    assert sorted(cache._entries) == ['a', 'c']
+
+    # Entries bigger than the whole cache and entries without a generation are not kept.
+    cache.put('huge', b'x' * 11, 1)
+    cache.put('unknown', b'x', None)
+    assert sorted(cache._entries) == ['a', 'c']
+
+
+def test_backend_get_wiki_page_is_cached():
+    backend = Backend(storage_client=MemoryClient())
+    backend.upload(io.BytesIO(b'A lovely park'), 'Park.txt', 'fake_author')
+    backend.page_cache.clear()
+
+    with patch.object(Blob,
+                      'download_as_string',
+                      autospec=True,
+                      side_effect=Blob.download_as_string) as mock_download:
+        for view in range(3):
+            assert backend.get_wiki_page(
+                'Park.txt')['content'] == 'A lovely park'
+        assert mock_download.call_count == 1
+
+        # A vote only writes the page's vote record, so the cached page stays valid.
+        backend.update_page('upvote', 'fake_user', 'Park.txt')
+        assert backend.get_wiki_page('Park.txt')['upvotes'] == 1
+        assert mock_download.call_count == 1
+
+
+def test_ttl_cache_expires_values():
+    cache = TTLCache(ttl=10)
+    with freeze_time('2022-01-01 00:00:00') as frozen:
+        cache.put('user1', 'value')
+        assert cache.get('user1') == 'value'
+
+        frozen.tick(11)
+        assert cache.get('user1') is None
+        assert len(cache) == 0
+
+
+def test_ttl_cache_drops_least_recently_used():
+    cache = TTLCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+
+    cache.invalidate('a')
+    assert cache.get('a') is None
+
+
+def test_backend_read_image_is_cached():
+    backend = Backend(storage_client=MemoryClient())
+    blob = backend.info_bucket.blob('manish.jpeg')
+    blob.upload_from_string(b'Fake_Image_Data')
+
+    with patch.object(Blob,
+                      'download_as_bytes',
+                      autospec=True,
+                      side_effect=Blob.download_as_bytes) as mock_download:
+        for request in range(3):
+            assert backend.read_image('manish.jpeg') == (b'Fake_Image_Data',
+                                                         blob.generation)
+        assert mock_download.call_count == 1
+
+    with pytest.raises(ValueError):
+        backend.read_image('nobody.jpeg')
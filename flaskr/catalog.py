@@ -0,0 +1,137 @@
+'''
+Keeps a catalog of every wiki page inside a single object of the content bucket.
+
+The catalog holds one small summary row per page (its name, votes, creation date, author and size),
+so listing the wiki costs one read instead of downloading every page document.
+It is kept up to date by the Backend whenever a page is written.
+'''
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+import json
+
+CATALOG_BLOB_NAME = '_catalog.json'
+
+
+def summarize(page_name, page_metadata, size):
+    ''' Builds the catalog row of a wiki page.
+        page_name : Name of the wiki page, without the '.txt' extension.
+        page_metadata : The page's metadata dictionary, as returned by Backend.get_wiki_page.
+        size : Size in bytes of the page's stored document.
+    '''
+    return {
+        'name': page_name,
+        'upvotes': page_metadata['upvotes'],
+        'downvotes': page_metadata['downvotes'],
+        'date_created': page_metadata['date_created'],
+        'author': page_metadata.get('author'),
+        'size': size,
+    }
+
+
+class PageCatalog:
+    '''
+    Reads and writes the catalog object of the content bucket.
+
+    Concurrent writers never overwrite each other: every change is a read-modify-write that is only
+    accepted if the catalog's generation did not change in between, and is retried otherwise.
+
+    Attributes:
+        bucket = The content bucket storing both the pages and the catalog.
+        rebuild = Function returning the rows of every page, used when the catalog does not exist yet.
+        blob_name = Name of the catalog object inside the bucket.
+        max_attempts = How many times a conflicting write is retried before giving up.
+    '''
+
+    def __init__(self,
+                 bucket,
+                 rebuild,
+                 blob_name=CATALOG_BLOB_NAME,
+                 max_attempts=5):
+        '''Initializes a PageCatalog object'''
+        self.bucket = bucket
+        self.rebuild = rebuild
+        self.blob_name = blob_name
+        self.max_attempts = max_attempts
+
+    def _read(self):
+        ''' Returns the stored rows as a dictionary keyed by page name, along with the catalog's generation.
+            If there is no catalog yet, returns (None, 0) since 0 is the generation of a missing object.
+        '''
+        blob = self.bucket.blob(self.blob_name)
+        try:
+            catalog = json.loads(blob.download_as_bytes())
+        except NotFound:
+            return None, 0
+        return catalog['pages'], blob.generation
+
+    def _write(self, rows, if_generation_match=None):
+        '''Stores the rows as the new catalog'''
+        blob = self.bucket.blob(self.blob_name)
+        blob.upload_from_string(json.dumps({'pages': rows}),
+                                content_type='application/json',
+                                if_generation_match=if_generation_match)
+
+    def rows(self):
+        '''Returns every row of the catalog sorted by page name, or None if there is no catalog yet'''
+        rows, _ = self._read()
+        if rows is None:
+            return None
+        return [rows[name] for name in sorted(rows)]
+
+    def save(self, rows):
+        ''' Replaces the whole catalog.
+            rows : A list with the row of every page.
+        '''
+        self._write({row['name']: row for row in rows})
+
+    def put(self, row):
+        ''' Adds the row of a page to the catalog, replacing its previous row if any.
+            row : A row as built by the summarize function.
+        '''
+
+        def replace_row(rows):
+            rows[row['name']] = row
+
+        self._modify(replace_row)
+
+    def update(self, page_name, **fields):
+        ''' Changes some fields of a page's row, such as its vote counts. Does nothing if the page has no row.
+            page_name : Name of the wiki page, without the '.txt' extension.
+            fields : The new values, e.g. upvotes=3.
+        '''
+        self.update_many({page_name: fields})
+
+    def update_many(self, changes):
+        ''' Changes some fields of several pages' rows in a single write. Pages without a row are left out.
+            changes : Dictionary mapping page names, without the '.txt' extension, to their new values,
+                e.g. {'Park': {'upvotes': 3}}.
+        '''
+
+        def update_rows(rows):
+            for page_name, fields in changes.items():
+                if page_name in rows:
+                    rows[page_name].update(fields)
+
+        self._modify(update_rows)
+
+    def _modify(self, change):
+        ''' Applies a change to the stored rows as a read-modify-write, retried if another writer got there first.
+            change : Function changing the rows dictionary, keyed by page name, in place.
+        '''
+        for attempt in range(self.max_attempts):
+            rows, generation = self._read()
+
+            # Without a catalog, start from the current state of the bucket so no page is left out.
+            if rows is None:
+                rows = {page['name']: page for page in self.rebuild()}
+            change(rows)
+
+            try:
+                self._write(rows, if_generation_match=generation)
+                return
+            except PreconditionFailed:
+                # Somebody else changed the catalog since we read it; read it again and retry.
+                continue
+        raise PreconditionFailed(
+            f'Could not update {self.blob_name} after {self.max_attempts} attempts'
+        )
@@ -0,0 +1,147 @@
+from flaskr.backend import Backend
+from flaskr.blobstore import MemoryClient
+from flaskr.catalog import PageCatalog, summarize
+from google.api_core.exceptions import PreconditionFailed
+from unittest.mock import MagicMock, patch
+from freezegun import freeze_time
+import pytest
+import io
+
+
+@pytest.fixture
+def bucket():
+    return MemoryClient().bucket('wiki_info')
+
+
+def fake_row(name, upvotes=0):
+    return {
+        'name': name,
+        'upvotes': upvotes,
+        'downvotes': 0,
+        'date_created': '1111-11-11',
+        'author': 'fake_author',
+        'size': 10
+    }
+
+
+def test_summarize():
+    page_metadata = {
+        "wiki_page": "Park.txt",
+        "author": "fake_author",
+        "content": "fake page content",
+        "date_created": "1111-11-11",
+        "upvotes": 3,
+        "who_upvoted": [],
+        "downvotes": 1,
+        "who_downvoted": [],
+        "comments": []
+    }
+
+    assert summarize('Park', page_metadata, 42) == {
+        'name': 'Park',
+        'upvotes': 3,
+        'downvotes': 1,
+        'date_created': '1111-11-11',
+        'author': 'fake_author',
+        'size': 42
+    }
+
+
+def test_rows_without_catalog(bucket):
+    catalog = PageCatalog(bucket, rebuild=MagicMock())
+
+    assert catalog.rows() is None
+    catalog.rebuild.assert_not_called()
+
+
+def test_save_and_rows(bucket):
+    catalog = PageCatalog(bucket, rebuild=MagicMock())
+    catalog.save([fake_row('b'), fake_row('a')])
+
+    # Rows are returned sorted by page name.
+    assert catalog.rows() == [fake_row('a'), fake_row('b')]
+
+
+def test_put_builds_missing_catalog(bucket):
+    # The first put must not lose the pages written before the catalog existed.
+    catalog = PageCatalog(bucket,
+                          rebuild=MagicMock(return_value=[fake_row('a')]))
+    catalog.put(fake_row('b'))
+
+    assert catalog.rows() == [fake_row('a'), fake_row('b')]
+    catalog.rebuild.assert_called_once()
+
+    # Putting an existing page replaces its row.
+    catalog.put(fake_row('a', upvotes=5))
+    assert catalog.rows() == [fake_row('a', upvotes=5), fake_row('b')]
+    catalog.rebuild.assert_called_once()
+
+
+def test_put_retries_on_conflict(bucket):
+    catalog = PageCatalog(bucket, rebuild=MagicMock())
+    catalog.save([fake_row('a')])
+    other_writer = PageCatalog(bucket, rebuild=MagicMock())
+    original_read = catalog._read
+    reads = []
+
+    def read_then_conflict():
+        # Another process writes the catalog right after our first read.
+        result = original_read()
+        reads.append(result)
+        if len(reads) == 1:
+            other_writer.put(fake_row('c'))
+        return result
+
+    with patch.object(catalog, '_read', side_effect=read_then_conflict):
+        catalog.put(fake_row('b'))
+
+    # Neither write was lost.
+    assert len(reads) == 2
+    assert catalog.rows() == [fake_row('a'), fake_row('b'), fake_row('c')]
+
+
+def test_put_gives_up_after_max_attempts(bucket):
+    catalog = PageCatalog(bucket, rebuild=MagicMock(), max_attempts=2)
+    catalog.save([fake_row('a')])
+
+    with patch.object(catalog, '_write',
+                      side_effect=PreconditionFailed('')) as mock_write:
+        with pytest.raises(PreconditionFailed):
+            catalog.put(fake_row('b'))
+        assert mock_write.call_count == 2
+
+
+def test_backend_keeps_catalog_up_to_date():
+    backend = Backend(storage_client=MemoryClient())
+
+    with freeze_time('1111-11-11'):
+        backend.upload(io.BytesIO(b'A lovely park'), 'Park.txt', 'fake_author')
+        backend.upload(io.BytesIO(b'A lovely lake'), 'Lake.txt', 'fake_author')
+    backend.update_page('downvote', 'fake_user', 'Lake.txt')
+    backend.update_metadata_with_comments('Park', 'fake_user', 'Nice!')
+
+    rows = backend.catalog.rows()
+    assert [row['name'] for row in rows] == ['Lake', 'Park']
+    assert rows[0]['downvotes'] == 1
+    assert rows[1]['author'] == 'fake_author'
+    assert rows[1]['date_created'] == '1111-11-11'
+
+    # The stored size follows the page document.
+    assert rows[1]['size'] == backend.info_bucket.get_blob('Park.txt').size
+
+    # Listing the wiki does not download a single page.
+    with patch.object(Backend, 'get_wiki_page') as mock_get_wiki:
+        assert backend.get_all_page_names() == [['Lake', 0, 1], ['Park', 0, 0]]
+        mock_get_wiki.assert_not_called()
+
+
+def test_backend_builds_catalog_for_existing_pages():
+    # Every listing reads the catalog again instead of sharing a snapshot.
+    backend = Backend(storage_client=MemoryClient(), snapshot_ttl=0)
+    backend.upload(io.BytesIO(b'A lovely park'), 'Park.txt', 'fake_author')
+
+    # Pretend the pages were uploaded before the catalog existed.
+    backend.info_bucket.blob('_catalog.json').delete()
+
+    assert backend.get_all_page_names() == [['Park', 0, 0]]
+    assert backend.catalog.rows()[0]['name'] == 'Park'
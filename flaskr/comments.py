@@ -0,0 +1,167 @@
+'''
+Append-only storage of the comments posted on wiki pages.
+
+Contains the CommentLog class, which keeps the comments of each page in small numbered segment objects
+instead of inside the page document, so posting a comment never rewrites the page and showing the
+newest comments never downloads the older ones.
+'''
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+import json
+
+COMMENTS_PREFIX = '_comments/'
+
+# Segment numbers are stored as LAST_SEGMENT - number, so listing a page's segments returns the newest first.
+LAST_SEGMENT = 99999999
+
+
+class CommentLog:
+    '''
+    Stores the comments of every wiki page as an append-only log of segments.
+
+    A page's comments live in '_comments/<page name>/<segment>.json' objects, each holding a JSON list of
+    at most segment_size {username: comment} dictionaries in the order they were posted. Only the newest
+    segment is ever written to: a comment is appended to it until it is full, and then starts the next
+    one, so older segments never change. Writes are generation-preconditioned and retried on conflict.
+
+    Pages that were commented on before the log existed keep their comments in their page document. They
+    are copied into the first segments by the first comment posted on the page afterwards.
+
+    Attributes:
+        bucket = The content bucket storing the pages and their comments.
+        segment_size = Maximum number of comments per segment.
+        max_attempts = How many times a conflicting write is retried before giving up.
+    '''
+
+    def __init__(self, bucket, segment_size=50, max_attempts=5):
+        '''Initializes a CommentLog object'''
+        self.bucket = bucket
+        self.segment_size = segment_size
+        self.max_attempts = max_attempts
+
+    @staticmethod
+    def _blob_name(page_name, segment):
+        ''' Returns the name of one of a page's segments.
+            Example : ('Park', 2) -> '_comments/Park/99999997.json'
+        '''
+        return f'{COMMENTS_PREFIX}{page_name}/{LAST_SEGMENT - segment:08d}.json'
+
+    def _newest_segment(self, page_name):
+        '''Returns the number of a page's newest segment, or None if nobody commented on the page yet'''
+        prefix = f'{COMMENTS_PREFIX}{page_name}/'
+        for blob in self.bucket.list_blobs(prefix=prefix, max_results=1):
+            return LAST_SEGMENT - int(blob.name[len(prefix):-len('.json')])
+        return None
+
+    def _read(self, page_name, segment):
+        '''Returns the comments of a segment, along with its generation (0 if it does not exist)'''
+        blob = self.bucket.blob(CommentLog._blob_name(page_name, segment))
+        try:
+            return json.loads(blob.download_as_bytes()), blob.generation
+        except NotFound:
+            return [], 0
+
+    def _write(self, page_name, segment, comments, if_generation_match):
+        '''Stores the comments of a segment'''
+        blob = self.bucket.blob(CommentLog._blob_name(page_name, segment))
+        blob.upload_from_string(json.dumps(comments),
+                                content_type='application/json',
+                                if_generation_match=if_generation_match)
+
+    def _copy(self, page_name, comments):
+        '''Stores the comments of a page document as the first segments of its log'''
+        for start in range(0, len(comments), self.segment_size):
+            try:
+                self._write(page_name,
+                            start // self.segment_size,
+                            comments[start:start + self.segment_size],
+                            if_generation_match=0)
+            except PreconditionFailed:
+                # Someone else is copying them at the same time.
+                return
+
+    def append(self, page_name, comment, earlier=()):
+        ''' Adds a comment after the newest comment of a page.
+            page_name : Name of the wiki page, without the '.txt' extension.
+            comment : The {username: comment} dictionary to add.
+            earlier : The comments stored in the page document, added first if the page has no segment yet.
+        '''
+        for attempt in range(self.max_attempts):
+            segment = self._newest_segment(page_name)
+            if segment is None and earlier:
+                self._copy(page_name, list(earlier))
+                earlier = ()
+                segment = self._newest_segment(page_name)
+
+            if segment is None:
+                segment, comments, generation = 0, [], 0
+            else:
+                comments, generation = self._read(page_name, segment)
+                # A full segment is never written again; the comment starts the next one.
+                if len(comments) >= self.segment_size:
+                    segment, comments, generation = segment + 1, [], 0
+            comments.append(comment)
+
+            try:
+                self._write(page_name,
+                            segment,
+                            comments,
+                            if_generation_match=generation)
+                return
+            except PreconditionFailed:
+                # Someone else commented since we read the segment; read it again and retry.
+                continue
+        raise PreconditionFailed(
+            f'Could not add a comment to {page_name} after {self.max_attempts} attempts'
+        )
+
+    def page(self, page_name, limit, cursor=None, earlier=()):
+        ''' Returns at most limit comments of a page, oldest first, along with the cursor of the comments
+            posted before them (None if there are none).
+            page_name : Name of the wiki page, without the '.txt' extension.
+            limit : Maximum number of comments to return.
+            cursor : Cursor returned along with the previous comments; the newest comments by default. A cursor
+                pointing past the newest comment returns no comment.
+            earlier : The comments stored in the page document, used if the page has no segment yet.
+        '''
+        if cursor is None:
+            segment, end = self._newest_segment(page_name), None
+            # Segment -1 stands for the comments of the page document.
+            if segment is None:
+                segment = -1
+        else:
+            segment, end = CommentLog.parse_cursor(cursor)
+
+        comments = []
+        while segment is not None and len(comments) < limit:
+            if segment < 0:
+                stored = list(earlier)
+            else:
+                stored, generation = self._read(page_name, segment)
+                # Segments are never deleted, so a missing one means the cursor was made up; stop right there.
+                if not generation:
+                    segment = None
+                    break
+            stored = stored[:end]
+            taken = stored[max(len(stored) - (limit - len(comments)), 0):]
+            comments = taken + comments
+            end = len(stored) - len(taken)
+            if end == 0:
+                # This segment is done; carry on with the one before it, if any.
+                segment, end = (segment - 1 if segment > 0 else None), None
+
+        if segment is None:
+            return comments, None
+        return comments, f'{segment}' if end is None else f'{segment}:{end}'
+
+    @staticmethod
+    def parse_cursor(cursor):
+        ''' Returns the (segment, end) pair of a cursor, end being None for a whole segment.
+            Raises ValueError for a cursor that was not returned by CommentLog.page.
+            Example : '3:12' -> (3, 12)
+        '''
+        segment, _, end = cursor.partition(':')
+        segment, end = int(segment), int(end) if end else None
+        if segment < -1 or (end is not None and end <= 0):
+            raise ValueError(f'Invalid comment cursor {cursor!r}')
+        return segment, end
@@ -0,0 +1,129 @@
+from flaskr.blobstore import Blob, MemoryClient
+from flaskr.comments import CommentLog
+from unittest.mock import patch
+import pytest
+import json
+
+
+@pytest.fixture
+def log():
+    return CommentLog(MemoryClient().bucket('wiki_info'), segment_size=3)
+
+
+def comment(number):
+    return {f'user{number}': f'comment {number}'}
+
+
+def stored_segments(log, page_name):
+    return {
+        blob.name: json.loads(blob.download_as_bytes())
+        for blob in log.bucket.list_blobs(prefix=f'_comments/{page_name}/')
+    }
+
+
+def test_comments_fill_segments_in_order(log):
+    for number in range(7):
+        log.append('Park', comment(number))
+
+    # Full segments are left alone and the newest one is listed first.
+    assert stored_segments(log, 'Park') == {
+        '_comments/Park/99999997.json': [comment(6)],
+        '_comments/Park/99999998.json': [comment(3),
+                                         comment(4),
+                                         comment(5)],
+        '_comments/Park/99999999.json': [comment(0),
+                                         comment(1),
+                                         comment(2)],
+    }
+
+
+def test_newest_comments_come_first_with_a_cursor(log):
+    for number in range(7):
+        log.append('Park', comment(number))
+
+    comments, cursor = log.page('Park', 4)
+    assert comments == [comment(3), comment(4), comment(5), comment(6)]
+
+    comments, cursor = log.page('Park', 2, cursor)
+    assert comments == [comment(1), comment(2)]
+
+    comments, cursor = log.page('Park', 2, cursor)
+    assert comments == [comment(0)]
+    assert cursor is None
+
+
+def test_newest_comments_only_read_the_newest_segments(log):
+    for number in range(30):
+        log.append('Park', comment(number))
+
+    with patch.object(Blob,
+                      'download_as_bytes',
+                      autospec=True,
+                      side_effect=Blob.download_as_bytes) as mock_download:
+        comments, cursor = log.page('Park', 3)
+
+    assert comments == [comment(27), comment(28), comment(29)]
+    assert mock_download.call_count == 1
+    assert cursor == '8'
+
+
+def test_page_document_comments_are_used_until_the_log_starts(log):
+    earlier = [comment(0), comment(1), comment(2), comment(3)]
+    assert log.page('Park', 3,
+                    earlier=earlier) == ([comment(1),
+                                          comment(2),
+                                          comment(3)], '-1:1')
+    assert log.page('Park', 3, '-1:1', earlier=earlier) == ([comment(0)], None)
+
+    # The first new comment copies them into the log.
+    log.append('Park', comment(4), earlier)
+    comments, cursor = log.page('Park', 10, earlier=earlier)
+    assert comments == [comment(number) for number in range(5)]
+    assert cursor is None
+
+
+def test_page_without_comments(log):
+    assert log.page('Park', 10) == ([], None)
+
+
+def test_conflicting_comments_are_both_kept(log):
+    log.append('Park', comment(0))
+    other_process = CommentLog(log.bucket, segment_size=3)
+
+    original_download = Blob.download_as_bytes
+    downloads = []
+
+    def download_then_comment(blob, *args, **kwargs):
+        # Someone comments from another process right after our first read.
+        data = original_download(blob, *args, **kwargs)
+        downloads.append(blob.name)
+        if len(downloads) == 1:
+            other_process.append('Park', comment(1))
+        return data
+
+    with patch.object(Blob,
+                      'download_as_bytes',
+                      autospec=True,
+                      side_effect=download_then_comment):
+        log.append('Park', comment(2))
+
+    assert log.page('Park', 10) == ([comment(0), comment(1), comment(2)], None)
+
+
+def test_invalid_cursor(log):
+    with pytest.raises(ValueError):
+        log.page('Park', 10, 'not a cursor')
+
+
+def test_cursor_past_the_newest_segment(log):
+    for number in range(4):
+        log.append('Park', comment(number))
+
+    with patch.object(Blob,
+                      'download_as_bytes',
+                      autospec=True,
+                      side_effect=Blob.download_as_bytes) as mock_download:
+        assert log.page('Park', 10, '50000') == ([], None)
+
+    # The made up segment is the only one looked for.
+    assert mock_download.call_count == 1
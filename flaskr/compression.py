@@ -0,0 +1,58 @@
+'''
+Compression of the stored wiki page files.
+
+Page files are JSON documents made mostly of prose, which gzip shrinks to a fraction of their size.
+Files of at least COMPRESS_MIN_BYTES are stored gzip-compressed with a 'gzip' content encoding; smaller
+ones are stored as they are, since compressing them saves next to nothing. Both kinds are read with
+decompress, which recognizes compressed data by its first bytes, so files stored before compression
+existed keep working.
+'''
+
+import gzip
+import shutil
+import tempfile
+
+# The first two bytes of any gzip data. A JSON document never starts with them.
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Files smaller than this are not worth compressing.
+COMPRESS_MIN_BYTES = 1024
+
+# Compression level of the stored files; higher levels take much longer for little gain on prose.
+COMPRESS_LEVEL = 6
+
+
+def is_compressed(data):
+    '''Returns True if the data, or its beginning, is gzip-compressed'''
+    return data[:len(GZIP_MAGIC)] == GZIP_MAGIC
+
+
+def compress(data):
+    ''' Returns the data gzip-compressed.
+        The output does not depend on the time it was compressed at, so the same page compresses to the same bytes.
+    '''
+    return gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+
+def decompress(data):
+    ''' Returns the data decompressed if it is gzip-compressed, or as it is otherwise.
+        Example : compress(b'{}') -> b'{}', b'{}' -> b'{}'
+    '''
+    if is_compressed(data):
+        return gzip.decompress(data)
+    return data
+
+
+def compress_file(source, chunk_size, spool_size):
+    ''' Returns a temporary file holding the gzip-compressed contents of a file, read chunk_size bytes at a time.
+        The temporary file is kept in memory up to spool_size bytes and moved to disk past that. It is
+        positioned at its end, so its size is its tell(); the caller closes it.
+        source : A file object positioned at the beginning of the data to compress.
+    '''
+    target = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    with gzip.GzipFile(fileobj=target,
+                       mode='wb',
+                       compresslevel=COMPRESS_LEVEL,
+                       mtime=0) as compressed:
+        shutil.copyfileobj(source, compressed, chunk_size)
+    return target
@@ -0,0 +1,33 @@
+from flaskr.compression import compress, compress_file, decompress, is_compressed
+import gzip
+import io
+
+
+def test_compress_round_trip():
+    data = b'{"content": "' + b'A lovely park by the river. ' * 100 + b'"}'
+    compressed = compress(data)
+
+    assert is_compressed(compressed)
+    assert len(compressed) < len(data) // 10
+    assert decompress(compressed) == data
+
+    # The same data always compresses to the same bytes.
+    assert compress(data) == compressed
+
+
+def test_uncompressed_data_is_read_as_it_is():
+    assert not is_compressed(b'{"content": ""}')
+    assert decompress(b'{"content": ""}') == b'{"content": ""}'
+    assert decompress(b'') == b''
+
+
+def test_compress_file():
+    data = b'A lovely park by the river. ' * 1000
+    with compress_file(io.BytesIO(data), chunk_size=100,
+                       spool_size=1000) as compressed:
+        size = compressed.tell()
+        compressed.seek(0)
+        stored = compressed.read()
+
+    assert size == len(stored)
+    assert gzip.decompress(stored) == data
@@ -0,0 +1,106 @@
+'''
+Buffering of the wiki pages viewed by each user.
+
+Contains the HistoryBuffer class, which collects the pages each user views and writes them to their
+account in the background, so viewing a page never waits for a write to the user bucket, and the
+merge_views function, which adds views to a history.
+'''
+
+from collections import OrderedDict
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# How many of the pages they viewed last are kept in a user's history.
+MAX_HISTORY = 100
+
+
+def merge_views(history, views, max_history=MAX_HISTORY):
+    ''' Returns a history with the views added as the most recent ones.
+        A page viewed again is moved to the end rather than repeated, and the oldest views are dropped
+        past max_history.
+        history : The pages viewed so far, from the oldest to the most recent.
+        views : The pages viewed since, from the oldest to the most recent.
+        Example : (['Park', 'Lake'], ['Park']) -> ['Lake', 'Park']
+    '''
+    recent = OrderedDict.fromkeys(history)
+    for view in views:
+        recent[view] = None
+        recent.move_to_end(view)
+    while len(recent) > max_history:
+        recent.popitem(last=False)
+    return list(recent)
+
+
+class HistoryBuffer:
+    '''
+    Collects the pages viewed by each user and flushes them together.
+
+    The views of a user are kept in an ordered dictionary used as an LRU: viewing a page again moves it
+    to the end, and only the max_history most recent views are kept. The first view recorded starts a
+    timer; when it fires, the views of every user are passed to the apply function, one user at a time,
+    which is expected to write them to the user's account as a single update.
+
+    Attributes:
+        apply = Function taking a username and a list of page names, from the oldest view to the most
+            recent, and writing them.
+        flush_interval = Seconds during which views are collected before being written.
+            With 0, every view is written right away.
+        max_history = How many views are kept per user.
+    '''
+
+    def __init__(self, apply, flush_interval=5, max_history=MAX_HISTORY):
+        '''Initializes a HistoryBuffer object'''
+        self.apply = apply
+        self.flush_interval = flush_interval
+        self.max_history = max_history
+        self._pending = OrderedDict()
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, username, page_name):
+        ''' Records a page view, to be written at the next flush.
+            username : The user who viewed the page.
+            page_name : Name of the wiki page, without the '.txt' extension.
+        '''
+        with self._lock:
+            views = self._pending.setdefault(username, OrderedDict())
+            self._pending.move_to_end(username)
+            views[page_name] = None
+            views.move_to_end(page_name)
+            if len(views) > self.max_history:
+                views.popitem(last=False)
+            if self.flush_interval and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if not self.flush_interval:
+            self.flush(username)
+
+    def pending(self, username):
+        '''Returns the pages viewed by a user that were not written yet, from the oldest view to the most recent'''
+        with self._lock:
+            return list(self._pending.get(username, ()))
+
+    def flush(self, username=None):
+        ''' Writes the pending views of a user, or of every user if no name is given.
+            A batch that can not be written is logged and dropped, so it does not block the next ones.
+        '''
+        with self._lock:
+            if username is None:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                batches = list(self._pending.items())
+                self._pending.clear()
+            else:
+                views = self._pending.pop(username, None)
+                batches = [(username, views)] if views else []
+
+        for name, views in batches:
+            try:
+                self.apply(name, list(views))
+            except Exception:
+                logger.exception('Could not write %d views of %s', len(views),
+                                 name)
@@ -0,0 +1,85 @@
+from flaskr.backend import Backend
+from flaskr.blobstore import Blob, MemoryClient
+from flaskr.history import HistoryBuffer, merge_views
+from unittest.mock import MagicMock, patch
+import threading
+
+
+def test_merge_views_moves_repeated_views_to_the_end():
+    assert merge_views(['Park', 'Lake', 'Zoo'], ['Park', 'Museum', 'Lake']) == [
+        'Zoo', 'Park', 'Museum', 'Lake'
+    ]
+
+
+def test_merge_views_drops_the_oldest_views():
+    assert merge_views(['a', 'b', 'c'], ['d', 'e'],
+                       max_history=3) == ['c', 'd', 'e']
+
+
+def test_views_are_merged_per_user():
+    history = HistoryBuffer(apply=MagicMock(), flush_interval=60)
+    history.add('user1', 'Park')
+    history.add('user1', 'Lake')
+    history.add('user2', 'Zoo')
+    history.add('user1', 'Park')
+
+    assert history.pending('user1') == ['Lake', 'Park']
+    history.apply.assert_not_called()
+
+    history.flush()
+    history.apply.assert_any_call('user1', ['Lake', 'Park'])
+    history.apply.assert_any_call('user2', ['Zoo'])
+    assert history.apply.call_count == 2
+    assert history.pending('user1') == []
+
+
+def test_only_the_latest_views_are_buffered():
+    history = HistoryBuffer(apply=MagicMock(), flush_interval=60, max_history=2)
+    for page_name in ['a', 'b', 'c']:
+        history.add('user1', page_name)
+
+    assert history.pending('user1') == ['b', 'c']
+
+
+def test_views_are_flushed_after_interval():
+    flushed = threading.Event()
+    history = HistoryBuffer(
+        apply=MagicMock(side_effect=lambda *args: flushed.set()),
+        flush_interval=0.01)
+    history.add('user1', 'Park')
+
+    assert flushed.wait(timeout=5)
+    history.apply.assert_called_once_with('user1', ['Park'])
+
+
+def test_failed_flush_does_not_raise():
+    history = HistoryBuffer(apply=MagicMock(side_effect=ValueError()),
+                            flush_interval=60)
+    history.add('user1', 'Park')
+
+    history.flush('user1')
+    assert history.pending('user1') == []
+
+
+def test_backend_views_cost_no_writes_until_flushed():
+    backend = Backend(storage_client=MemoryClient(), history_flush_interval=60)
+    backend.sign_up('user1', 'password')
+
+    with patch.object(Blob,
+                      'upload_from_string',
+                      autospec=True,
+                      side_effect=Blob.upload_from_string) as mock_upload:
+        for page_name in ['Park', 'Lake', 'Park']:
+            backend.record_view('user1', page_name)
+
+        # Nothing is written yet, but the views already show on the account.
+        mock_upload.assert_not_called()
+        assert backend.get_user_account('user1')['wiki_history'] == [
+            'Lake', 'Park'
+        ]
+
+        backend.history.flush()
+        assert [call.args[0].name for call in mock_upload.call_args_list
+               ] == ['_history/user1.json']
+
+    assert backend.get_user_account('user1')['wiki_history'] == ['Lake', 'Park']
@@ -0,0 +1,247 @@
+'''
+Counting of the storage operations made while serving each request.
+
+Contains the StorageStats class, which counts the storage operations of a request and the bytes they
+moved, the InstrumentedClient class, which wraps a storage client so every operation made through it is
+counted, and the init_app function, which gives every Flask request its own StorageStats as
+flask.g.storage_stats and logs it once the request is done.
+
+Operations are counted towards the StorageStats of the context they are made in. Work done in the
+background, such as flushing votes, is not made in any request's context and is not counted.
+'''
+
+from flask import g, request
+from collections import Counter
+import contextlib
+import contextvars
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# The StorageStats of the request being served, if any.
+_current_stats = contextvars.ContextVar('storage_stats', default=None)
+
+# The blob methods that make a storage operation, mapped to the name they are counted under.
+_DOWNLOADS = {
+    'download_as_bytes': 'download',
+    'download_as_string': 'download',
+    'download_as_text': 'download',
+}
+_UPLOADS = {
+    'upload_from_string': 'upload',
+    'upload_from_file': 'upload',
+}
+_OTHERS = {
+    'reload': 'reload',
+    'exists': 'exists',
+    'delete': 'delete',
+}
+
+
+class StorageStats:
+    '''
+    The storage operations made while serving a request, and how many bytes they moved.
+
+    Attributes:
+        operations = Counter of the operations made, by name: download, upload, reload, exists, delete and list.
+        bytes_read = Bytes downloaded.
+        bytes_written = Bytes uploaded.
+    '''
+
+    def __init__(self):
+        '''Initializes a StorageStats object'''
+        self.operations = Counter()
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+
+    @property
+    def total(self):
+        '''The number of operations made'''
+        return sum(self.operations.values())
+
+    def record(self, operation, bytes_read=0, bytes_written=0):
+        ''' Counts an operation.
+            Operations may be recorded from several threads at once, such as when pages are downloaded in parallel.
+        '''
+        with self._lock:
+            self.operations[operation] += 1
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    def __str__(self):
+        operations = ', '.join(
+            f'{count} {operation}'
+            for operation, count in sorted(self.operations.items()))
+        return (
+            f'{self.total} storage operations ({operations or "none"}), '
+            f'{self.bytes_read} bytes read, {self.bytes_written} bytes written')
+
+
+@contextlib.contextmanager
+def counting(stats):
+    ''' Counts the storage operations made inside the with block, including by the threads it hands work to
+        through a copy of its context, towards the given StorageStats.
+    '''
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+def record(operation, bytes_read=0, bytes_written=0):
+    '''Counts an operation towards the StorageStats of the current request, if there is one'''
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.record(operation, bytes_read, bytes_written)
+
+
+def _unwrap(value):
+    '''Returns the wrapped client, bucket or blob, so it can be handed to the storage library itself'''
+    return value._wrapped if isinstance(value, _Instrumented) else value
+
+
+class _Instrumented:
+    '''
+    Forwards every attribute to a wrapped storage object, counting the calls that make a storage operation.
+
+    Attributes set on the wrapper, such as a blob's content_encoding before an upload, are set on the
+    wrapped object.
+    '''
+
+    def __init__(self, wrapped):
+        object.__setattr__(self, '_wrapped', wrapped)
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._wrapped, name, value)
+
+    def __eq__(self, other):
+        return self._wrapped == _unwrap(other)
+
+    def __hash__(self):
+        return hash(self._wrapped)
+
+    def _list_blobs(self, list_blobs, *args, **kwargs):
+        '''Lists blobs, counting one operation, and wraps the listed blobs'''
+        blobs = list(list_blobs(*[_unwrap(arg) for arg in args], **kwargs))
+        record('list')
+        return [InstrumentedBlob(blob) for blob in blobs]
+
+
+class InstrumentedBlob(_Instrumented):
+    '''A blob whose downloads, uploads and other requests are counted'''
+
+    def __getattr__(self, name):
+        attribute = getattr(self._wrapped, name)
+        if name in _DOWNLOADS:
+            return self._download(attribute, _DOWNLOADS[name])
+        if name in _UPLOADS:
+            return self._upload(attribute, _UPLOADS[name])
+        if name in _OTHERS:
+            return self._call(attribute, _OTHERS[name])
+        return attribute
+
+    def _download(self, method, operation):
+        '''Wraps a download method'''
+
+        def download(*args, **kwargs):
+            # A failed request, such as one for a missing object, is a round-trip all the same.
+            data = b''
+            try:
+                data = method(*args, **kwargs)
+                return data
+            finally:
+                record(operation, bytes_read=len(data))
+
+        return download
+
+    def _upload(self, method, operation):
+        '''Wraps an upload method'''
+
+        def upload(*args, **kwargs):
+            written = 0
+            try:
+                result = method(*[_unwrap(arg) for arg in args], **kwargs)
+                written = self._wrapped.size or 0
+                return result
+            finally:
+                record(operation, bytes_written=written)
+
+        return upload
+
+    def _call(self, method, operation):
+        '''Wraps a method making any other request'''
+
+        def call(*args, **kwargs):
+            try:
+                return method(*[_unwrap(arg) for arg in args], **kwargs)
+            finally:
+                record(operation)
+
+        return call
+
+
+class InstrumentedBucket(_Instrumented):
+    '''A bucket whose blobs are instrumented'''
+
+    def blob(self, blob_name, *args, **kwargs):
+        '''Returns an instrumented blob, without touching storage'''
+        return InstrumentedBlob(self._wrapped.blob(blob_name, *args, **kwargs))
+
+    def get_blob(self, blob_name, *args, **kwargs):
+        '''Returns the instrumented blob with its properties loaded, or None if it does not exist'''
+        try:
+            blob = self._wrapped.get_blob(blob_name, *args, **kwargs)
+        finally:
+            record('reload')
+        return None if blob is None else InstrumentedBlob(blob)
+
+    def list_blobs(self, *args, **kwargs):
+        '''Lists the bucket's blobs; see the client's list_blobs'''
+        return self._list_blobs(self._wrapped.list_blobs, *args, **kwargs)
+
+
+class InstrumentedClient(_Instrumented):
+    '''
+    A storage client counting every storage operation made through it, or through its buckets and their blobs.
+
+    It can wrap a google cloud storage client or any client from flaskr.blobstore.
+    '''
+
+    def bucket(self, bucket_name, *args, **kwargs):
+        '''Returns an instrumented bucket, without touching storage'''
+        return InstrumentedBucket(
+            self._wrapped.bucket(bucket_name, *args, **kwargs))
+
+    def list_blobs(self, *args, **kwargs):
+        '''Lists the blobs of a bucket; see the wrapped client's list_blobs'''
+        return self._list_blobs(self._wrapped.list_blobs, *args, **kwargs)
+
+
+def init_app(app):
+    ''' Counts the storage operations of every request the app serves.
+        The StorageStats of a request is flask.g.storage_stats, and is logged once the request is done.
+    '''
+
+    @app.before_request
+    def start_counting():
+        g.storage_stats = StorageStats()
+        _current_stats.set(g.storage_stats)
+
+    @app.after_request
+    def log_storage_stats(response):
+        stats = g.get('storage_stats')
+        if stats is not None:
+            logger.info('%s %s %s: %s', request.method, request.path,
+                        response.status_code, stats)
+        return response
+
+    @app.teardown_request
+    def stop_counting(exception=None):
+        # The thread may serve another request next; its operations must not be counted towards this one.
+        _current_stats.set(None)
@@ -0,0 +1,70 @@
+from flaskr.backend import Backend
+from flaskr.blobstore import MemoryClient
+from flaskr.instrumentation import InstrumentedClient, StorageStats, counting
+from google.api_core.exceptions import NotFound
+import pytest
+import io
+
+
+@pytest.fixture
+def storage_client():
+    return InstrumentedClient(MemoryClient())
+
+
+def test_operations_and_bytes_are_counted(storage_client):
+    bucket = storage_client.bucket('wiki_info')
+    with counting(StorageStats()) as stats:
+        blob = bucket.blob('Park.txt')
+        blob.upload_from_string(b'A lovely park')
+        assert blob.download_as_bytes() == b'A lovely park'
+        assert blob.exists()
+        assert [blob.name for blob in bucket.list_blobs()] == ['Park.txt']
+        assert bucket.get_blob('Lake.txt') is None
+        with pytest.raises(NotFound):
+            bucket.blob('Lake.txt').download_as_bytes()
+
+    assert stats.operations == {
+        'upload': 1,
+        'download': 2,
+        'exists': 1,
+        'list': 1,
+        'reload': 1
+    }
+    assert (stats.bytes_read, stats.bytes_written) == (13, 13)
+    assert str(stats).startswith('6 storage operations')
+
+
+def test_operations_outside_requests_are_not_counted(storage_client):
+    stats = StorageStats()
+    with counting(stats):
+        pass
+    storage_client.bucket('wiki_info').blob('Park.txt').upload_from_string(
+        b'A lovely park')
+
+    assert stats.total == 0
+
+
+def test_blob_properties_are_set_on_the_wrapped_blob(storage_client):
+    blob = storage_client.bucket('wiki_info').blob('Park.txt')
+    blob.content_encoding = 'gzip'
+    blob.upload_from_string(b'compressed')
+
+    stored = storage_client.bucket('wiki_info').get_blob('Park.txt')
+    assert stored.content_encoding == 'gzip'
+    assert stored.generation == blob.generation
+
+
+def test_parallel_page_reads_are_counted(storage_client):
+    backend = Backend(storage_client=storage_client)
+    for name in ['Lake', 'Park', 'River']:
+        backend.upload(io.BytesIO(b'fake content'), name + '.txt',
+                       'fake_author')
+    backend.page_cache.clear()
+
+    with counting(StorageStats()) as stats:
+        pages = backend.get_wiki_pages(['Lake.txt', 'Park.txt', 'River.txt'],
+                                       max_workers=3)
+
+    assert all(pages.values())
+    # Each page and its vote record, read from the pool's threads.
+    assert stats.operations['download'] == 6
@@ -1,12 +1,52 @@
-from flask import render_template, Flask, url_for, flash, request, redirect
+from flask import render_template, Flask, url_for, flash, request, redirect, abort, Response
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from werkzeug.utils import secure_filename
-from google.cloud import storage
-from flaskr.backend import Backend, User
+from flaskr.thumbnails import PICTURE_SIZES
+from werkzeug.datastructures import ContentRange
+import mimetypes
+
+# How many seconds browsers and proxies may keep an image before checking whether it changed.
+IMAGE_MAX_AGE = 24 * 60 * 60
 
 
 def make_endpoints(app, backend):
 
+    def render_pages(**context):
+        ''' Renders pages.html , whose filter dropdown lists the years pages were created in
+            context : the variables passed to the template
+        '''
+        return render_template('pages.html',
+                               year_counts=backend.year_counts(),
+                               **context)
+
+    def requested_page_size():
+        '''Returns how many results to show at once, from the page_size parameter (50 by default, at most 500)'''
+        return min(max(request.values.get('page_size', 50, type=int), 1), 500)
+
+    def paginate(results, page_size, endpoint, **params):
+        ''' Returns the results to show and the url of the next page of results , or None if this is the last one.
+            results : the results as returned by the backend , which was asked for page_size + 1 of them
+            endpoint : the route serving the next page
+            params : the other parameters of that route
+        '''
+        if len(results) <= page_size:
+            return results, None
+        results = results[:page_size]
+        next_url = url_for(endpoint,
+                           cursor=results[-1][0],
+                           page_size=page_size,
+                           **params)
+        return results, next_url
+
+    @app.template_global()
+    def profile_picture_srcset(user_name):
+        ''' Returns the srcset of a user's profile picture , listing every size it was resized to
+            so the browser downloads the smallest one that fits where the picture is shown
+        '''
+        return ', '.join(
+            f"{url_for('profile_picture', user_name=user_name, size=size)} {edge}w"
+            for size, edge in PICTURE_SIZES.items())
+
     # Flask uses the "app.route" decorator to call methods when users
     # go to a specific route on the project's website.
     @app.route("/")
@@ -26,16 +66,15 @@ def make_endpoints(app, backend):
         page_content = backend.get_wiki_page(file_name)
 
         if current_user.is_authenticated:
-            backend.update_wikihistory(current_user.username, page_name)
+            backend.record_view(current_user.username, page_name)
 
         if request.method == 'POST':
             if request.form['submit_button'] == 'Yes!':
-                backend.update_page('upvote', current_user.username, file_name)
+                backend.vote('upvote', current_user.username, file_name)
                 return redirect(url_for('page', page_name=page_name))
 
             elif request.form['submit_button'] == 'Nope':
-                backend.update_page('downvote', current_user.username,
-                                    file_name)
+                backend.vote('downvote', current_user.username, file_name)
                 return redirect(url_for('page', page_name=page_name))
             elif request.form.get('submit_button') == 'post':
                 if current_user.is_authenticated:
@@ -48,27 +87,118 @@ def make_endpoints(app, backend):
                 else:
                     flash('Please login or signup to make a comment')
 
+        # Only the newest comments are shown , with a link to the ones posted before them.
+        comments, more_comments_url = [], None
+        if page_content:
+            earlier = page_content.get('comments', [])
+            try:
+                comments, cursor = backend.get_comments(
+                    page_name,
+                    cursor=request.args.get('comments_cursor'),
+                    earlier=earlier)
+            except ValueError:
+                comments, cursor = backend.get_comments(page_name,
+                                                        earlier=earlier)
+            if cursor is not None:
+                more_comments_url = url_for('page',
+                                            page_name=page_name,
+                                            comments_cursor=cursor)
+
         return render_template('page.html',
                                content=page_content,
-                               name=page_name)
+                               name=page_name,
+                               comments=comments,
+                               more_comments_url=more_comments_url)
 
     @app.route('/pages')
     def pages():
-        page_names = backend.get_all_page_names()
-        return render_template('pages.html', places=page_names)
+        '''This route lists the wiki pages page_size at a time , starting after the cursor page'''
+        page_size = requested_page_size()
+        page_names = backend.get_all_page_names(page_size + 1,
+                                                request.args.get('cursor'))
+        page_names, next_url = paginate(page_names, page_size, 'pages')
+        return render_pages(places=page_names, next_url=next_url)
 
     @app.route('/about')
     def about():
+        # The images are fetched by the browser from the image route , so they can be cached.
         author_images = {
-            'Manish': backend.get_image('manish.jpeg', 'wiki_info'),
-            'Gabriel': backend.get_image('gabrielPic.jpg', 'wiki_info'),
-            'Myles': backend.get_image('mylesPic.jpg', 'wiki_info')
+            'Manish': 'manish.jpeg',
+            'Gabriel': 'gabrielPic.jpg',
+            'Myles': 'mylesPic.jpg'
         }
         return render_template('about.html', author_images=author_images)
 
+    @app.route('/images/<image_name>')
+    def image(image_name):
+        '''This route serves the images of the wiki_info bucket , such as the authors' pictures on the about page'''
+        content_type, _ = mimetypes.guess_type(image_name)
+        if content_type is None or not content_type.startswith('image/'):
+            abort(404)
+        try:
+            data, generation = backend.read_image(image_name, 'wiki_info')
+        except ValueError:
+            abort(404)
+
+        # Browsers and proxies keep the image for a day , and then only download it again if it changed.
+        response = Response(data, mimetype=content_type)
+        response.set_etag(str(generation))
+        response.cache_control.public = True
+        response.cache_control.max_age = IMAGE_MAX_AGE
+        return response.make_conditional(request)
+
+    @app.route('/pfp/<user_name>')
+    def profile_picture(user_name):
+        '''This route streams a user's profile picture , honoring conditional and range requests'''
+        try:
+            blob = backend.open_profile_picture(user_name,
+                                                request.args.get('size'))
+        except ValueError:
+            abort(404)
+
+        # The generation changes whenever the picture is replaced , so it identifies this version of it.
+        etag = str(blob.generation)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        content_type = blob.content_type
+        if not content_type or not content_type.startswith('image/'):
+            content_type = mimetypes.guess_type(blob.name)[0] or 'image/jpeg'
+
+        # Only a single range is served , and only if the browser's copy is of this version of the picture.
+        start, stop, status = 0, blob.size, 200
+        byte_range = request.range
+        if (byte_range is not None and len(byte_range.ranges) == 1 and
+                request.if_range.date is None and
+                request.if_range.etag in (None, etag)):
+            bounds = byte_range.range_for_length(blob.size)
+            if bounds is None:
+                response = Response(status=416)
+                response.content_range = ContentRange('bytes', None, None,
+                                                      blob.size)
+                return response
+            (start, stop), status = bounds, 206
+
+        response = Response(backend.stream_blob(blob, start, stop),
+                            status=status,
+                            mimetype=content_type,
+                            direct_passthrough=True)
+        response.content_length = stop - start
+        if status == 206:
+            response.content_range = ContentRange('bytes', start, stop,
+                                                  blob.size)
+        response.accept_ranges = 'bytes'
+        response.set_etag(etag)
+
+        # Browsers keep the picture , but check with us that it did not change before showing it again.
+        response.cache_control.no_cache = True
+        return response
+
     @app.login_manager.user_loader
     def load_user(user_id):
-        return User.get(user_id)
+        return backend.load_user(user_id)
 
     @app.route('/login', methods=['GET', 'POST'])
     def login():
@@ -92,8 +222,11 @@ def make_endpoints(app, backend):
     def signup():
         msg = ''
         if request.method == 'POST':
-            user = backend.sign_up(request.form['username'],
-                                   request.form['password'])
+            try:
+                user = backend.sign_up(request.form['username'],
+                                       request.form['password'])
+            except ValueError as error:
+                return render_template('signup.html', message=str(error))
             if user:
                 login_user(user)
                 return redirect('/')
@@ -122,8 +255,11 @@ def make_endpoints(app, backend):
                 message = 'Please Select Files'
                 return render_template('upload.html', message=message)
             if file.filename and allowed_file(file.filename):
-                backend.upload(file, request.form['wikiname'] + ".txt",
-                               current_user.username)  #workaround
+                try:
+                    backend.upload(file, request.form['wikiname'] + ".txt",
+                                   current_user.username)  #workaround
+                except ValueError as error:
+                    return render_template('upload.html', message=str(error))
                 backend.update_wikiupload(current_user.username,
                                           request.form['wikiname'])
                 message = 'Uploaded Successfully'
@@ -144,80 +280,113 @@ def make_endpoints(app, backend):
     @app.route('/search', methods=["GET", "POST"])
     def search():
         '''  post the resulted pages from the user query in pages.html
+             the results come page_size at a time , starting after the cursor page
 
         '''
-        if request.method == "POST":
-            search_query = request.form.get('search_query')
-            search_by = request.form.get('search_by')
-            if search_by == 'title':
-                resulted_pages = backend.search_by_title(search_query)
-                if resulted_pages:
-                    return render_template('pages.html', places=resulted_pages)
-                else:
-                    message = f"No such pages found for '{search_query}' "
-                    return render_template('pages.html', message=message)
-            elif search_by == 'content':
-                resulted_pages = backend.search_by_content(search_query)
-                if resulted_pages:
-                    return render_template('pages.html', places=resulted_pages)
-                else:
-                    message = f"No such pages found with '{search_query}' in the content "
-                    return render_template('pages.html', message=message)
-        else:
+        search_query = request.values.get('search_query')
+        search_by = request.values.get('search_by')
+        if search_query is None:
             return redirect('/pages.html', 200)
 
+        page_size = requested_page_size()
+        cursor = request.values.get('cursor')
+        if search_by == 'title':
+            fuzzy = request.values.get('fuzzy') == '1'
+            resulted_pages = backend.search_by_title(search_query,
+                                                     fuzzy=fuzzy,
+                                                     limit=page_size + 1,
+                                                     cursor=cursor)
+            if not resulted_pages and not fuzzy and cursor is None:
+                # Nothing contains the exact query; maybe it has a typo.
+                fuzzy = True
+                resulted_pages = backend.search_by_title(search_query,
+                                                         fuzzy=True,
+                                                         limit=page_size + 1)
+            if resulted_pages:
+                resulted_pages, next_url = paginate(resulted_pages,
+                                                    page_size,
+                                                    'search',
+                                                    search_query=search_query,
+                                                    search_by=search_by,
+                                                    fuzzy='1' if fuzzy else '0')
+                return render_pages(places=resulted_pages, next_url=next_url)
+            else:
+                message = f"No such pages found for '{search_query}' "
+                return render_pages(message=message)
+        elif search_by == 'content':
+            resulted_pages = backend.search_by_content(search_query,
+                                                       limit=page_size + 1,
+                                                       cursor=cursor)
+            if resulted_pages:
+                resulted_pages, next_url = paginate(resulted_pages,
+                                                    page_size,
+                                                    'search',
+                                                    search_query=search_query,
+                                                    search_by=search_by)
+                return render_pages(places=resulted_pages, next_url=next_url)
+            else:
+                message = f"No such pages found with '{search_query}' in the content "
+                return render_pages(message=message)
+        return redirect('/pages.html', 200)
+
     @app.route('/sort', methods=["GET", "POST"])
     def sort():
         ''' post the resulted pages from user option of sorting 
             if resulted pages exist otherise redirect pages 
+            the results come page_size at a time , starting after the cursor page
 
         '''
-        if request.method == "POST":
-            user_option = request.form.get("sort_option")
-            required_pages = backend.sort_pages(user_option)
-            return render_template('pages.html',
-                                   places=required_pages,
-                                   sort_order=user_option)
+        user_option = request.values.get("sort_option")
+        if user_option:
+            # Only one page of results is read; the "next" link continues after its last page.
+            page_size = requested_page_size()
+            required_pages = backend.sort_pages(user_option, page_size + 1,
+                                                request.values.get('cursor'))
+            required_pages, next_url = paginate(required_pages,
+                                                page_size,
+                                                'sort',
+                                                sort_option=user_option)
+            return render_pages(places=required_pages,
+                                sort_order=user_option,
+                                next_url=next_url)
 
         return redirect('/pages.html')
 
     @app.route('/sortyears', methods=["GET", "POST"])
     def sort_by_year():
+        ''' post the pages created during the chosen year , or between the chosen start and end dates
+        '''
         if request.method == "POST":
+            start_date = request.form.get("start_date")
+            end_date = request.form.get("end_date")
+            if start_date or end_date:
+                # A missing bound leaves that side of the range open.
+                try:
+                    required_pages = backend.filter_by_dates(
+                        start_date or '0001-01-01', end_date or '9999-12-31')
+                except ValueError:
+                    return render_pages(
+                        message='Please enter dates as YYYY-MM-DD')
+                if not required_pages:
+                    return render_pages(
+                        message='No pages were created between these dates')
+                return render_pages(places=required_pages)
+
             user_option = request.form.get("list_years")
             required_pages = backend.filter_by_year(str(user_option))
-            return render_template('pages.html',
-                                   places=required_pages,
-                                   sort_order=user_option)
+            return render_pages(places=required_pages, sort_order=user_option)
 
         return redirect('/pages.html')
 
     @app.route('/account', methods=['GET', 'POST'])
     def account():
-        backend = Backend(user_bucket_name='wiki_login')
         account_metadata = backend.get_user_account(current_user.username)
-        if account_metadata["pfp_filename"]:
-            user_image = backend.get_image(account_metadata["pfp_filename"],
-                                           "wiki_login")
-            return render_template('account.html',
-                                   account_settings=account_metadata,
-                                   user_image=user_image)
         return render_template('account.html',
                                account_settings=account_metadata)
 
     @app.route('/account/<user_name>')
     def others_account(user_name):
-        backend = Backend(user_bucket_name='wiki_login')
         account_metadata = backend.get_user_account(user_name)
-
-        if account_metadata["pfp_filename"]:
-            user_image = backend.get_image(account_metadata["pfp_filename"],
-                                           "wiki_login")
-            return render_template('other_account.html',
-                                   account_settings=account_metadata,
-                                   user_image=user_image,
-                                   username=user_name)
-
         return render_template('other_account.html',
                                account_settings=account_metadata,
                                username=user_name)
@@ -226,7 +395,6 @@ def make_endpoints(app, backend):
     def update():
         if request.method == 'POST':
             if request.form['bio']:
-                backend = Backend(user_bucket_name='wiki_login')
                 backend.update_bio(current_user.username, request.form['bio'])
                 message = 'Uploaded Successfully'
                 return render_template('update.html', bio_message=message)
@@ -243,7 +411,6 @@ def make_endpoints(app, backend):
                 message = 'Please Select Files'
                 return render_template('upload.html', message=message)
             if file.filename and allowed_photo(file.filename):
-                backend = Backend(user_bucket_name='wiki_login')
                 backend.update_pfp(current_user.username, file)
                 message = 'Uploaded Successfully'
                 return render_template('update.html', message=message)
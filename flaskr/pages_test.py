@@ -1,9 +1,10 @@
 from flaskr import create_app
 from flaskr.backend import User, Backend
+from flaskr.blobstore import MemoryClient, shared_client
 from flask_login import LoginManager, login_user, current_user, logout_user, login_required
 from unittest.mock import patch
+import flask
 import pytest
-import base64
 import json
 import io
 
@@ -16,6 +17,8 @@ def app():
     app = create_app({
         'TESTING': True,
         'WTF_CSRF_ENABLED': False,
+        # Routes that are not patched read an empty in-memory wiki instead of GCS.
+        'STORAGE_BACKEND': 'memory',
     })
 
     return app
@@ -28,12 +31,86 @@ def client(app):
             yield client
 
 
+def assert_storage_budget(total=None, **per_operation):
+    ''' Asserts the last request made with the client stayed within a budget of storage operations.
+        total : The most storage operations the request may make.
+        per_operation : The most operations of each kind it may make , such as download=1 or upload=0.
+    '''
+    stats = flask.g.storage_stats
+    if total is not None:
+        assert stats.total <= total, stats
+    for operation, budget in per_operation.items():
+        assert stats.operations[operation] <= budget, stats
+
+
+def sign_up_and_upload(client, page_name, content):
+    '''Signs a user up , logs them in and uploads a page, going through the routes like a browser would'''
+    client.post('/signup', data={'username': 'fake_user', 'password': 'pw'})
+    client.post('/login', data={'username': 'fake_user', 'password': 'pw'})
+    client.post('/upload',
+                data={
+                    'file': (io.BytesIO(content), 'page.txt'),
+                    'wikiname': page_name
+                })
+
+
 # TODO(Checkpoint (groups of 4 only) Requirement 4): Change test to
 # match the changes made in the other Checkpoint Requirements.
 def test_home_page(client):
     resp = client.get("/")
     assert resp.status_code == 200
     assert b"Welcome To The Wiki Of Fun Local Places!" in resp.data
+    assert_storage_budget(total=0)
+
+
+def test_page_view_storage_budget(client):
+    sign_up_and_upload(client, 'Park', b'A lovely park')
+
+    # The user , the page and its votes are cached since the upload , so a view only looks up the newest
+    # comments. The view is added to the user's history later , not written right away.
+    for view in range(2):
+        resp = client.get('/pages/Park')
+        assert b'A lovely park' in resp.data
+        assert_storage_budget(total=1, download=0, upload=0)
+
+
+def test_listing_storage_budget(tmp_path):
+    # Another server fills the wiki , so the listing starts from a cold backend.
+    writer = Backend(storage_client=shared_client('local', str(tmp_path)),
+                     vote_flush_interval=0)
+    for number in range(60):
+        writer.upload(io.BytesIO(b'A lovely park'), f'Park {number:02d}.txt',
+                      'fake_author')
+        writer.vote('upvote', 'fake_user', f'Park {number:02d}.txt')
+        writer.update_metadata_with_comments(f'Park {number:02d}', 'fake_user',
+                                             'Nice!')
+
+    app = create_app({
+        'TESTING': True,
+        'STORAGE_BACKEND': 'local',
+        'STORAGE_ROOT': str(tmp_path),
+    })
+    with app.test_client() as client, app.app_context():
+        # The listing is served from the catalog , without listing or reading any page.
+        resp = client.get('/pages?page_size=50')
+        assert b'Park 49' in resp.data
+        assert_storage_budget(total=1, download=1, list=0)
+        resp = client.get('/pages?page_size=50&cursor=Park 49')
+        assert b'Park 59' in resp.data
+        assert_storage_budget(total=0)
+        # The first search lists the page titles to build the title index , and reads no page either.
+        client.get('/search?search_query=park&search_by=title')
+        assert_storage_budget(total=1, download=0)
+        client.get('/search?search_query=park&search_by=title')
+        assert_storage_budget(total=0)
+
+
+def test_account_storage_budget(client):
+    sign_up_and_upload(client, 'Park', b'A lovely park')
+
+    # Each part of the account is read once, and nothing is written.
+    client.get('/account')
+    assert_storage_budget(total=4, download=4, upload=0)
 
 
 # TODO(Project 1): Write tests for other routes.
@@ -43,15 +120,43 @@ def test_about_page(client):
         Arg : Client 
     '''
 
-    with patch('flaskr.backend.Backend.get_image') as mock_get_image:
-
-        expected = base64.b64encode(b'Fake_Image_Data').decode('utf-8')
-        mock_get_image.return_value = expected
+    with patch('flaskr.backend.Backend.read_image') as mock_read_image:
         response = client.get('/about')
 
         assert response.status_code == 200
-        expected_html = f"<img src='data:image/jpeg;base64,{expected}' alt='Author Image'>"
+        # The images are not inlined , but fetched from the image route.
+        expected_html = "<img src='/images/manish.jpeg' alt='Author Image'>"
         assert expected_html.encode() in response.data
+        mock_read_image.assert_not_called()
+
+
+def test_image(client):
+    with patch('flaskr.backend.Backend.read_image') as mock_read_image:
+        mock_read_image.return_value = (b'Fake_Image_Data', 1234)
+        response = client.get('/images/manish.jpeg')
+
+        assert response.status_code == 200
+        assert response.data == b'Fake_Image_Data'
+        assert response.mimetype == 'image/jpeg'
+        assert response.headers['ETag'] == '"1234"'
+        assert response.cache_control.public
+        assert response.cache_control.max_age == 24 * 60 * 60
+        mock_read_image.assert_called_once_with('manish.jpeg', 'wiki_info')
+
+        # A browser that already has this version of the image does not get it again.
+        response = client.get('/images/manish.jpeg',
+                              headers={'If-None-Match': '"1234"'})
+        assert response.status_code == 304
+        assert response.data == b''
+
+
+def test_image_not_found(client):
+    with patch('flaskr.backend.Backend.read_image') as mock_read_image:
+        mock_read_image.side_effect = ValueError()
+        assert client.get('/images/nobody.jpeg').status_code == 404
+
+        # Only images are served.
+        assert client.get('/images/_catalog.json').status_code == 404
 
 
 def test_pages_page(client):
@@ -111,6 +216,25 @@ def test_wiki_page_with_comments(client):
         assert b"This is a fake comment" in resp.data
 
 
+def test_wiki_page_with_more_comments(client):
+    # Only the newest comments are shown , with a link to the earlier ones.
+    with patch('flaskr.backend.Backend.get_wiki_page') as mock_page, patch(
+            'flaskr.backend.Backend.get_comments') as mock_comments:
+        mock_page.return_value = json.loads(
+            '{"wiki_page": "really_fake_page", "content": "really_fake_content", "date_created": "0000-00-00", "upvotes": 0, "who_upvoted": [], "downvotes": 0, "who_downvoted": [], "comments": []}'
+        )
+        mock_comments.return_value = ([{
+            'fake_commenter': 'The newest comment'
+        }], '4')
+
+        resp = client.get('/pages/Park?comments_cursor=5')
+
+        assert resp.status_code == 200
+        assert b'The newest comment' in resp.data
+        assert b'/pages/Park?comments_cursor=4' in resp.data
+        mock_comments.assert_called_once_with('Park', cursor='5', earlier=[])
+
+
 def test_login(client):
     # Send a response to the route trying to verify for the test user.
     with patch('flaskr.backend.Backend.sign_in') as mock_login:
@@ -182,6 +306,18 @@ def test_incorrect_signup(client):
         assert response.status_code == 200
 
 
+def test_signup_with_control_characters(client):
+    response = client.post('/signup',
+                           data={
+                               'username': 'bot0\nbot1',
+                               'password': 'pw'
+                           })
+
+    assert response.status_code == 200
+    assert b'Usernames can not contain control characters' in response.data
+    assert current_user.is_authenticated == False
+
+
 def test_other_account(client):
     ''' Testing the account parameterised route for a user profile.
          Args : 
@@ -213,31 +349,91 @@ def test_other_account_with_pfp(client):
     # Patch the get_user_account method.
     with patch('flaskr.backend.Backend.get_user_account') as mock_get_user:
 
-        with patch('flaskr.backend.Backend.get_image') as mock_get_image:
+        mock_get_user.return_value = {
+            'hashed_password': "whatever_pasword",
+            'account_creation': "anydate",
+            'wikis_uploaded': [],
+            'wiki_history': [],
+            'pfp_filename': "some_fake_image.jpg",
+            'about_me': 'some funny info about me',
+        }
+
+        # The picture is not embedded in the page, but linked so the browser can fetch and cache it.
+        expected_html = (
+            "<img src='/pfp/fake_user?size=card' srcset='/pfp/fake_user?size=avatar 64w, "
+            "/pfp/fake_user?size=card 320w, /pfp/fake_user?size=full 1024w' sizes='15vw' alt='Account Image'>"
+        )
+
+        resp = client.get('/account/fake_user')
 
-            expected = base64.b64encode(b'Fake_Image_Data').decode('utf-8')
+        # Assert the request succeeds and the user info, username and picture are reflected.
+        assert resp.status_code == 200
+        assert b"fake_user" in resp.data
+        assert b"some funny info about me" in resp.data
+        assert expected_html.encode() in resp.data
+        assert b"no pfp attached" not in resp.data
 
-            mock_get_image.return_value = expected
 
-            mock_get_user.return_value = {
-                'hashed_password': "whatever_pasword",
-                'account_creation': "anydate",
-                'wikis_uploaded': [],
-                'wiki_history': [],
-                'pfp_filename': "some_fake_image.jpg",
-                'about_me': 'some funny info about me',
-            }
+def stored_picture(data):
+    blob = MemoryClient().bucket('wiki_login').blob('fake_user.png')
+    blob.upload_from_string(data, content_type='image/png')
+    return blob
 
-            expected_html = f"<img src='data:image/jpeg;base64,{expected}' alt='Account Image'>"
 
-            resp = client.get('/account/fake_user')
+def test_profile_picture(client):
+    picture = stored_picture(b'Fake_Image_Data')
+    with patch('flaskr.backend.Backend.open_profile_picture') as mock_open:
+        mock_open.return_value = picture
+        response = client.get('/pfp/fake_user')
 
-            # Assert the request succeeds and the user info, username and picture are reflected.
-            assert resp.status_code == 200
-            assert b"fake_user" in resp.data
-            assert b"some funny info about me" in resp.data
-            assert expected_html.encode() in resp.data
-            assert b"no pfp attached" not in resp.data
+        assert response.status_code == 200
+        assert response.data == b'Fake_Image_Data'
+        assert response.mimetype == 'image/png'
+        assert response.headers['ETag'] == f'"{picture.generation}"'
+        assert response.headers['Accept-Ranges'] == 'bytes'
+        assert response.cache_control.no_cache
+        mock_open.assert_called_once_with('fake_user', None)
+
+        # The resized pictures are asked for by size.
+        client.get('/pfp/fake_user?size=avatar')
+        mock_open.assert_called_with('fake_user', 'avatar')
+
+        # A browser that already has this version of the picture does not get it again.
+        response = client.get(
+            '/pfp/fake_user',
+            headers={'If-None-Match': f'"{picture.generation}"'})
+        assert response.status_code == 304
+        assert response.data == b''
+
+
+def test_profile_picture_range(client):
+    picture = stored_picture(b'Fake_Image_Data')
+    with patch('flaskr.backend.Backend.open_profile_picture') as mock_open:
+        mock_open.return_value = picture
+
+        response = client.get('/pfp/fake_user', headers={'Range': 'bytes=5-9'})
+        assert response.status_code == 206
+        assert response.data == b'Image'
+        assert response.headers['Content-Range'] == 'bytes 5-9/15'
+
+        # A range of another version of the picture gets the whole new one.
+        response = client.get('/pfp/fake_user',
+                              headers={
+                                  'Range': 'bytes=5-9',
+                                  'If-Range': '"12345"'
+                              })
+        assert response.status_code == 200
+        assert response.data == b'Fake_Image_Data'
+
+        response = client.get('/pfp/fake_user', headers={'Range': 'bytes=100-'})
+        assert response.status_code == 416
+        assert response.headers['Content-Range'] == 'bytes */15'
+
+
+def test_profile_picture_not_found(client):
+    with patch('flaskr.backend.Backend.open_profile_picture') as mock_open:
+        mock_open.side_effect = ValueError()
+        assert client.get('/pfp/nobody').status_code == 404
 
 
 def fixit_test_upload(client):
@@ -305,6 +501,24 @@ def test_search_for_title_with_no_result(client):
             assert b'No such pages found' in response.data
 
 
+def test_search_for_title_with_typo(client):
+    ''' Testing the search route for search_by_title post falling back to a typo-tolerant search
+
+         Args : 
+            client : Flask Client Object 
+    '''
+    with patch('flaskr.backend.Backend.search_by_title') as mock_search:
+        mock_search.side_effect = [[], [['Georgetown', 0, 0]]]
+        response = client.post('/search',
+                               data={
+                                   'search_query': 'georgtown',
+                                   'search_by': 'title'
+                               })
+        assert response.status_code == 200
+        assert b'Georgetown' in response.data
+        mock_search.assert_called_with('georgtown', fuzzy=True, limit=51)
+
+
 def test_search_for_content_with_results(client):
     '''  Testing the search rout for search_by_content post with some results
 
@@ -420,6 +634,63 @@ def test_sort_route_for_option3(client):
             assert b'Page1' in response.data
 
 
+def test_sort_route_next_page(client):
+    ''' Testing that the sort route only asks for one page of results and links to the next one
+
+        Args : 
+            client : Flask Client Object 
+    '''
+    with patch('flaskr.backend.Backend.sort_pages') as mock_sort:
+        mock_sort.return_value = [['Lake', 0, 0], ['Park', 1, 0],
+                                  ['River', 0, 2]]
+        response = client.post('/sort',
+                               data={
+                                   'sort_option': 'a_z',
+                                   'page_size': '2'
+                               })
+
+        assert response.status_code == 200
+        mock_sort.assert_called_once_with('a_z', 3, None)
+        assert b'Park' in response.data
+        assert b'River' not in response.data
+        assert b'/sort?cursor=Park&amp;page_size=2&amp;sort_option=a_z' in response.data
+
+        # Following the link asks for the pages after the cursor.
+        mock_sort.reset_mock()
+        mock_sort.return_value = [['River', 0, 2]]
+        response = client.get('/sort?sort_option=a_z&cursor=Park&page_size=2')
+
+        assert response.status_code == 200
+        mock_sort.assert_called_once_with('a_z', 3, 'Park')
+        assert b'River' in response.data
+        assert b'NEXT PAGE' not in response.data
+
+
+def test_pages_route_next_page(client):
+    ''' Testing that the pages route only asks for one page of results and links to the next one
+
+        Args : 
+            client : Flask Client Object 
+    '''
+    with patch('flaskr.backend.Backend.get_all_page_names') as mock_page:
+        mock_page.return_value = [['Lake', 0, 0], ['Park', 1, 0]]
+
+        resp = client.get('/pages?page_size=1')
+
+        assert resp.status_code == 200
+        mock_page.assert_called_once_with(2, None)
+        assert b'Lake' in resp.data
+        assert b'/pages?cursor=Lake&amp;page_size=1' in resp.data
+
+        mock_page.reset_mock()
+        mock_page.return_value = [['Park', 1, 0]]
+        resp = client.get('/pages?cursor=Lake&page_size=1')
+
+        mock_page.assert_called_once_with(2, 'Lake')
+        assert b'Park' in resp.data
+        assert b'NEXT PAGE' not in resp.data
+
+
 def test_page_commenting(client):
     '''  Testing the post comment in page route with patching dependencies 
           get_wiki_page , update_metadata_with_comments , current_user , update_wikihistory
@@ -437,9 +708,9 @@ def test_page_commenting(client):
                   ) as mock_update_comment:
 
             with patch('flaskr.pages.current_user', User('fake_user')):
-                with patch('flaskr.backend.Backend.update_wikihistory'
-                          ) as mock_update_wikihistory:
-                    mock_update_wikihistory.return_value = None
+                with patch('flaskr.backend.Backend.record_view'
+                          ) as mock_record_view:
+                    mock_record_view.return_value = None
                     mock_update_comment.return_value = None
                     #just reflecting expected value to update to call update_metadata_with_comments
                     expected = {
@@ -496,32 +767,23 @@ def test_wiki_page_upvote(client):
             '{"wiki_page": "really_fake_page", "content": "really_fake_content", "date_created": "0000-00-00", "upvotes": 1, "who_upvoted": ["some_fake_user"], "downvotes": 0, "who_downvoted": [], "comments": []}'
         )
 
-        # Patch the backend method for update page.
-        with patch('flaskr.backend.Backend.update_page') as mock_update:
+        # Patch the backend method recording votes.
+        with patch('flaskr.backend.Backend.vote') as mock_vote:
 
             # Also patch the flask_login current_user module; replace with a fake user.
             with patch('flaskr.pages.current_user', User('some_fake_user')):
-                with patch('flaskr.backend.Backend.update_wikihistory'
-                          ) as mock_update_wikihistory:
-                    mock_update_wikihistory.return_value = None
-                    # Mock the update_page method by making it return a dictionary representing wiki page metadata.
-                    mock_update.return_value = {
-                        "wiki_page": "really_fake_page",
-                        "content": "really_fake_content",
-                        "date_created": "0000-00-00",
-                        "upvotes": 1,
-                        "who_upvoted": ['some_fake_user'],
-                        "downvotes": 0,
-                        "who_downvoted": [],
-                        "comments": []
-                    }
-
+                with patch('flaskr.backend.Backend.record_view'
+                          ) as mock_record_view:
+                    mock_record_view.return_value = None
                     resp = client.post('/pages/testingmetadata',
                                        data={'submit_button': 'Yes!'})
 
-                    # Assert the request succeeds and the vote count is reflected.
+                    # Assert the request succeeds and the vote is recorded.
                     assert resp.status_code == 302
                     assert b"1" in resp.data
+                    mock_vote.assert_called_once_with('upvote',
+                                                      'some_fake_user',
+                                                      'testingmetadata.txt')
 
 
 def test_wiki_page_downvotes(client):
@@ -536,34 +798,23 @@ def test_wiki_page_downvotes(client):
             '{"wiki_page": "really_fake_page", "content": "really_fake_content", "date_created": "0000-00-00", "upvotes": 0, "who_upvoted": [], "downvotes": 2, "who_downvoted": ["some_fake_user", "another_fake_user"], "comments": []}'
         )
 
-        # Patch the backend method for update page.
-        with patch('flaskr.backend.Backend.update_page') as mock_update:
+        # Patch the backend method recording votes.
+        with patch('flaskr.backend.Backend.vote') as mock_vote:
 
             # Also patch the flask_login current_user module; replace with a fake user.
 
             with patch('flaskr.pages.current_user', User('some_fake_user')):
-                with patch('flaskr.backend.Backend.update_wikihistory'
-                          ) as mock_update_wikihistory:
-                    mock_update_wikihistory.return_value = None
-                    # Mock the update_page method by making it return a dictionary representing wiki page metadata.
-                    mock_update.return_value = {
-                        "wiki_page": "really_fake_page",
-                        "content": "really_fake_content",
-                        "date_created": "0000-00-00",
-                        "upvotes": 0,
-                        "who_upvoted": [],
-                        "downvotes": 2,
-                        "who_downvoted": [
-                            'some_fake_user', 'another_fake_user'
-                        ],
-                        "comments": []
-                    }
-
+                with patch('flaskr.backend.Backend.record_view'
+                          ) as mock_record_view:
+                    mock_record_view.return_value = None
                     resp = client.post('/pages/testingmetadata',
                                        data={'submit_button': 'Nope'})
 
-                    # Assert the request succeeds and the vote count is reflected.
+                    # Assert the request succeeds and the vote is recorded.
                     assert resp.status_code == 302
+                    mock_vote.assert_called_once_with('downvote',
+                                                      'some_fake_user',
+                                                      'testingmetadata.txt')
 
 
 def test_update_bio(client):
@@ -643,3 +894,34 @@ def test_sort_years(client):
             assert resp.status_code == 200
             assert b'wikipage1' in resp.data
             assert b'wikipage2' in resp.data
+
+
+def test_sort_years_between_dates(client):
+    ''' Testing the filter by date range route
+         Args : 
+            client : Flask Client Object 
+    '''
+    with patch("flaskr.backend.Backend.filter_by_dates") as mock_filter:
+        mock_filter.return_value = [['wikipage1', 0, 1]]
+
+        resp = client.post('/sortyears', data={'start_date': '2021-01-01'})
+
+        assert resp.status_code == 200
+        assert b'wikipage1' in resp.data
+        mock_filter.assert_called_once_with('2021-01-01', '9999-12-31')
+
+
+def test_year_dropdown_comes_from_histogram(client):
+    ''' Testing that the filter dropdown only lists the years pages were created in
+         Args : 
+            client : Flask Client Object 
+    '''
+    with patch('flaskr.backend.Backend.year_counts') as mock_year_counts:
+        mock_year_counts.return_value = {'2023': 4, '2021': 1}
+
+        resp = client.get('/pages')
+
+        assert resp.status_code == 200
+        assert b'<option value="2023" >2023 (4)</option>' in resp.data
+        assert b'2021 (1)' in resp.data
+        assert b'1900' not in resp.data
@@ -0,0 +1,72 @@
+from flaskr.records import BINARY_MAGIC, BinaryCodec, JsonCodec, benchmark, decode_record, get_codec
+import pytest
+import json
+import io
+
+
+@pytest.fixture
+def page():
+    return {
+        'wiki_page': 'Park.txt',
+        'author': 'fake_author',
+        'content': 'A lovely "park" by the café ☃\n' * 10,
+        'date_created': '2023-01-01',
+        'upvotes': 2,
+        'who_upvoted': ['alice', 'bob'],
+        'downvotes': 0,
+        'who_downvoted': [],
+        'comments': [{
+            'carol': 'Nice!'
+        }],
+        'pfp_filename': None,
+        'archived': False,
+    }
+
+
+def test_binary_round_trip(page):
+    stored = BinaryCodec().encode(page)
+
+    assert stored.startswith(BINARY_MAGIC)
+    assert len(stored) < len(JsonCodec().encode(page))
+    assert decode_record(stored) == page
+    assert BinaryCodec().decode(stored) == page
+
+
+def test_json_records_are_still_read(page):
+    assert decode_record(JsonCodec().encode(page)) == page
+    assert decode_record(json.dumps(page)) == page
+
+
+def test_unknown_binary_version_is_refused(page):
+    stored = bytearray(BinaryCodec().encode(page))
+    stored[len(BINARY_MAGIC)] = 99
+
+    with pytest.raises(ValueError):
+        decode_record(bytes(stored))
+
+
+@pytest.mark.parametrize('codec', [JsonCodec(), BinaryCodec()])
+def test_stream(codec, page):
+    content = page['content']
+    chunks = [content[start:start + 7] for start in range(0, len(content), 7)]
+    document = io.BytesIO()
+
+    passed_on = list(
+        codec.stream(document, dict(page, content=''), 'content', chunks))
+
+    assert passed_on == chunks
+    assert decode_record(document.getvalue()) == page
+    assert document.tell() == len(document.getvalue())
+
+
+def test_get_codec():
+    assert isinstance(get_codec('binary'), BinaryCodec)
+    with pytest.raises(ValueError):
+        get_codec('xml')
+
+
+def test_benchmark():
+    results = benchmark(content_sizes=(100,), repeat=2)
+
+    assert [(size, name) for size, name, *times in results] == [(100, 'json'),
+                                                                (100, 'binary')]
@@ -0,0 +1,402 @@
+'''
+Search indexes over the wiki pages.
+
+Contains two classes:
+ContentIndex, a persisted inverted index from words to the pages containing them, which ranks the
+pages matching a query with BM25 so a search only looks at the pages that match.
+TitleIndex, an in-memory trigram index over the page titles answering substring and typo-tolerant queries.
+'''
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from collections import Counter
+import heapq
+import json
+import math
+import re
+import threading
+import time
+
+CONTENT_INDEX_BLOB_NAME = '_index/content.json'
+
+
+def tokenize(text):
+    ''' Splits a text into lowercase words.
+        Example : 'Georgetown Waterfront-Park!' -> ['georgetown', 'waterfront', 'park']
+    '''
+    return re.findall(r'\w+', text.lower())
+
+
+def count_words(chunks):
+    ''' Counts the lowercase words of a text read in chunks, without ever joining the chunks.
+        A word cut in two by the end of a chunk is counted once, whole.
+        Example : ['Waterfront Pa', 'rk park'] -> Counter({'park': 2, 'waterfront': 1})
+    '''
+    counts = Counter()
+    partial = ''
+    for chunk in chunks:
+        text = partial + chunk
+        # The last word of the chunk may go on in the next one.
+        cut = re.search(r'\w*$', text).start()
+        counts.update(tokenize(text[:cut]))
+        partial = text[cut:]
+    counts.update(tokenize(partial))
+    return counts
+
+
+class ContentIndex:
+    '''
+    Maps every word to the wiki pages containing it, along with how many times it appears in each one.
+
+    The index is kept in memory and persisted as a single object of the content bucket so every process
+    serving the wiki shares it. Writes are generation-preconditioned and retried on conflict, and the
+    in-memory copy is refreshed when another process changed the stored one.
+
+    Attributes:
+        bucket = The content bucket storing the index.
+        rebuild = Function returning (page name, content) pairs for every page, used when the index does not exist yet.
+        blob_name = Name of the index object inside the bucket.
+        refresh_interval = Seconds between checks for changes made to the stored index by other processes.
+        max_attempts = How many times a conflicting write is retried before giving up.
+        k1, b = The BM25 ranking parameters.
+    '''
+
+    def __init__(self,
+                 bucket,
+                 rebuild,
+                 blob_name=CONTENT_INDEX_BLOB_NAME,
+                 refresh_interval=30,
+                 max_attempts=5,
+                 k1=1.5,
+                 b=0.75):
+        '''Initializes a ContentIndex object'''
+        self.bucket = bucket
+        self.rebuild = rebuild
+        self.blob_name = blob_name
+        self.refresh_interval = refresh_interval
+        self.max_attempts = max_attempts
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._postings = None
+        self._lengths = {}
+        self._terms = {}
+        self._total_length = 0
+        self._generation = None
+        self._checked_at = 0
+
+    def _reset(self, postings, lengths):
+        '''Replaces the in-memory index'''
+        self._postings = postings
+        self._lengths = lengths
+        self._total_length = sum(lengths.values())
+
+        # Remember which words each page contains so a page can be re-indexed without scanning every word.
+        self._terms = {}
+        for token, pages in postings.items():
+            for page in pages:
+                self._terms.setdefault(page, set()).add(token)
+
+    def _apply(self, page_name, counts):
+        '''Indexes a page in memory from how many times it contains each word, replacing its previous content if any'''
+        self._remove(page_name)
+        for token, count in counts.items():
+            self._postings.setdefault(token, {})[page_name] = count
+        self._lengths[page_name] = sum(counts.values())
+        self._total_length += self._lengths[page_name]
+        self._terms[page_name] = set(counts)
+
+    def _remove(self, page_name):
+        '''Removes a page from the in-memory index'''
+        if page_name not in self._lengths:
+            return
+        self._total_length -= self._lengths.pop(page_name)
+        for token in self._terms.pop(page_name, ()):
+            pages = self._postings[token]
+            del pages[page_name]
+            if not pages:
+                del self._postings[token]
+
+    def _load(self):
+        '''Loads the stored index into memory, building and storing it first if it does not exist'''
+        blob = self.bucket.blob(self.blob_name)
+        try:
+            stored = json.loads(blob.download_as_bytes())
+        except NotFound:
+            self._reset({}, {})
+            for page_name, content in self.rebuild():
+                self._apply(page_name, Counter(tokenize(content)))
+            try:
+                self._store(if_generation_match=0)
+            except PreconditionFailed:
+                # Another process built it at the same time; use theirs next time.
+                self._generation = None
+        else:
+            self._reset(stored['postings'], stored['lengths'])
+            self._generation = blob.generation
+        self._checked_at = time.monotonic()
+
+    def _store(self, if_generation_match=None):
+        '''Persists the in-memory index'''
+        blob = self.bucket.blob(self.blob_name)
+        index = {'postings': self._postings, 'lengths': self._lengths}
+        blob.upload_from_string(json.dumps(index),
+                                content_type='application/json',
+                                if_generation_match=if_generation_match)
+        self._generation = blob.generation
+
+    def _refresh(self):
+        '''Makes sure the in-memory index exists and is not older than refresh_interval'''
+        if self._postings is None:
+            self._load()
+            return
+        if time.monotonic() - self._checked_at < self.refresh_interval:
+            return
+        blob = self.bucket.blob(self.blob_name)
+        try:
+            blob.reload()
+        except NotFound:
+            self._load()
+            return
+        if blob.generation != self._generation:
+            self._load()
+        self._checked_at = time.monotonic()
+
+    def add(self, page_name, content):
+        ''' Indexes a page that was just uploaded and persists the index.
+            page_name : Name of the wiki page, without the '.txt' extension.
+            content : The page's text.
+        '''
+        self.add_counts(page_name, Counter(tokenize(content)))
+
+    def add_counts(self, page_name, counts):
+        ''' Indexes a page that was just uploaded from the words it contains, and persists the index.
+            page_name : Name of the wiki page, without the '.txt' extension.
+            counts : Counter of the page's words, as returned by count_words.
+        '''
+        with self._lock:
+            self._refresh()
+            for attempt in range(self.max_attempts):
+                self._apply(page_name, counts)
+                try:
+                    self._store(if_generation_match=self._generation or 0)
+                    return
+                except PreconditionFailed:
+                    # Another process changed the index; start over from its version.
+                    self._load()
+            raise PreconditionFailed(
+                f'Could not update {self.blob_name} after {self.max_attempts} attempts'
+            )
+
+    def search(self, query, limit=None):
+        ''' Returns the names of the pages containing every word of the query, best matches first.
+            query : Text typed in by the user.
+            limit : Maximum number of page names to return; all of them by default.
+        '''
+        tokens = set(tokenize(query))
+        if not tokens:
+            return []
+
+        with self._lock:
+            self._refresh()
+            postings = [self._postings.get(token, {}) for token in tokens]
+
+            # Only pages containing the rarest word can match, so start from its (short) list.
+            postings.sort(key=len)
+            matches = [
+                page for page in postings[0]
+                if all(page in pages for pages in postings[1:])
+            ]
+            if not matches:
+                return []
+
+            page_count = len(self._lengths)
+            average_length = self._total_length / page_count
+            scores = {}
+            for page in matches:
+                scores[page] = sum(
+                    self._score(pages, page, page_count, average_length)
+                    for pages in postings)
+
+        # Highest scores first, ties broken by page name.
+        order = lambda item: (-item[1], item[0])
+        if limit is None:
+            ranked = sorted(scores.items(), key=order)
+        else:
+            ranked = heapq.nsmallest(limit, scores.items(), key=order)
+        return [page for page, _ in ranked]
+
+    def _score(self, pages, page, page_count, average_length):
+        ''' Returns the BM25 score of one query word for one page.
+            pages : The posting list of the word, mapping page names to the word's count in them.
+        '''
+        frequency = pages[page]
+        idf = math.log(1 + (page_count - len(pages) + 0.5) / (len(pages) + 0.5))
+        length_ratio = self._lengths[
+            page] / average_length if average_length else 1
+        return idf * frequency * (self.k1 +
+                                  1) / (frequency + self.k1 *
+                                        (1 - self.b + self.b * length_ratio))
+
+
+def trigrams(text):
+    ''' Returns the set of three-character sequences found in a text.
+        Example : 'park' -> {'par', 'ark'}
+    '''
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def pairs(text):
+    ''' Returns the set of two-character sequences found in a text.
+        Example : 'park' -> {'pa', 'ar', 'rk'}
+    '''
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def substring_distance(pattern, text):
+    ''' Returns the smallest edit distance between the pattern and any part of the text.
+        Example : ('georgtown', 'Georgetown Park'.lower()) -> 1
+    '''
+    # Sellers' algorithm: the edit distance table, except that a match may start anywhere in the text.
+    column = list(range(len(pattern) + 1))
+    best = column[-1]
+    for char in text:
+        diagonal, column[0] = column[0], 0
+        for i in range(1, len(pattern) + 1):
+            current = min(column[i] + 1, column[i - 1] + 1,
+                          diagonal + (pattern[i - 1] != char))
+            diagonal, column[i] = column[i], current
+        best = min(best, column[-1])
+    return best
+
+
+class TitleIndex:
+    '''
+    Maps every trigram to the page titles containing it, so titles can be searched without scanning all of them.
+
+    The index only lives in memory. It is built from the list of page titles on first use, rebuilt every
+    refresh_interval seconds to pick up pages uploaded by other processes, and updated right away when
+    this process uploads a page.
+
+    Attributes:
+        load_titles = Function returning the title of every page.
+        refresh_interval = Seconds after which the index is rebuilt from load_titles.
+    '''
+
+    def __init__(self, load_titles, refresh_interval=300):
+        '''Initializes a TitleIndex object'''
+        self.load_titles = load_titles
+        self.refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        self._lowercase = None
+        self._grams = {}
+        self._pairs = {}
+        self._built_at = 0
+
+    def _refresh(self):
+        '''Builds the index if it does not exist yet or is older than refresh_interval'''
+        if self._lowercase is not None and time.monotonic(
+        ) - self._built_at < self.refresh_interval:
+            return
+        self._lowercase = {}
+        self._grams = {}
+        self._pairs = {}
+        for title in self.load_titles():
+            self._add(title)
+        self._built_at = time.monotonic()
+
+    def _add(self, title):
+        '''Adds a title to the in-memory index'''
+        lowercase = title.lower()
+        self._lowercase[title] = lowercase
+        for gram in trigrams(lowercase):
+            self._grams.setdefault(gram, set()).add(title)
+        for pair in pairs(lowercase):
+            self._pairs.setdefault(pair, set()).add(title)
+
+    def add(self, title):
+        ''' Indexes the title of a page that was just uploaded.
+            title : Name of the wiki page, without the '.txt' extension.
+        '''
+        with self._lock:
+            self._refresh()
+            if title not in self._lowercase:
+                self._add(title)
+
+    def search(self, query):
+        ''' Returns the titles containing the query, ignoring case, sorted alphabetically.
+            query : Text typed in by the user.
+        '''
+        query = query.lower()
+        with self._lock:
+            self._refresh()
+            grams = trigrams(query)
+
+            # Queries shorter than a trigram can not use the index.
+            if not grams:
+                return sorted(
+                    title for title, lowercase in self._lowercase.items()
+                    if query in lowercase)
+
+            # A title containing the query contains all of its trigrams, so intersect their (short) title sets.
+            candidates = sorted(
+                (self._grams.get(gram, set()) for gram in grams), key=len)
+            matches = set(candidates[0]).intersection(*candidates[1:])
+            return sorted(
+                title for title in matches if query in self._lowercase[title])
+
+    def fuzzy_search(self,
+                     query,
+                     max_distance=2,
+                     limit=None,
+                     max_candidates=100):
+        ''' Returns the titles containing the query with at most max_distance typos, closest matches first.
+            query : Text typed in by the user.
+            max_distance : Maximum number of inserted, deleted or replaced characters. Short queries allow fewer,
+                so that at least two of their characters match.
+            limit : Maximum number of titles to return; all of them by default.
+            max_candidates : How many of the titles sharing the most trigrams with the query get compared to it.
+                Queries too short for a title to share a trigram with them despite typos use pairs of characters instead.
+        '''
+        query = query.lower()
+        grams = trigrams(query)
+        if not grams:
+            return self.search(query)[:limit]
+        max_distance = min(max_distance, len(query) - 2)
+
+        with self._lock:
+            self._refresh()
+
+            # Count the query trigrams found in each title. Every typo breaks at most three of them,
+            # so a close enough title shares at least this many.
+            needed = len(grams) - 3 * max_distance
+            shared = Counter()
+            if needed > 0:
+                for gram in grams:
+                    shared.update(self._grams.get(gram, ()))
+            else:
+                # The typos may have broken every trigram of the query, e.g. 'prak' shares none with 'park'.
+                # Look for its pairs of characters instead, including the ones a character apart, which are
+                # next to each other once a character is swapped, inserted or replaced: 'p?a' and 'r?k' in 'prak'.
+                needed = 1
+                for pair in pairs(query) | {
+                        query[i] + query[i + 2] for i in range(len(query) - 2)
+                }:
+                    shared.update(self._pairs.get(pair, ()))
+
+            # Common trigrams are shared by lots of titles; only compare the most promising ones.
+            candidates = [(title, self._lowercase[title])
+                          for title, count in shared.most_common(max_candidates)
+                          if count >= needed]
+
+        # The titles are compared outside the lock, so searches and uploads do not wait for each other.
+        ranked = []
+        for title, lowercase in candidates:
+            distance = substring_distance(query, lowercase)
+            if distance <= max_distance:
+                # Between equally close titles, prefer the ones sharing more trigrams with the query.
+                title_grams = trigrams(lowercase)
+                similarity = len(grams & title_grams) / len(grams | title_grams)
+                ranked.append((distance, -similarity, title))
+
+        ranked.sort()
+        return [title for _, _, title in ranked[:limit]]
@@ -0,0 +1,219 @@
+from flaskr.backend import Backend
+from flaskr.blobstore import MemoryClient
+from flaskr.search import ContentIndex, TitleIndex, count_words, substring_distance, tokenize, trigrams
+from unittest.mock import MagicMock, patch
+from collections import Counter
+import pytest
+import io
+
+
+@pytest.fixture
+def bucket():
+    return MemoryClient().bucket('wiki_info')
+
+
+@pytest.fixture
+def content_index(bucket):
+    ''' an empty content index stored in memory '''
+
+    return ContentIndex(bucket, rebuild=MagicMock(return_value=[]))
+
+
+def test_tokenize():
+    assert tokenize('Georgetown Waterfront-Park!') == [
+        'georgetown', 'waterfront', 'park'
+    ]
+    assert tokenize('  ') == []
+
+
+def test_count_words_across_chunks():
+    assert count_words(['Waterfront Pa', 'rk park']) == {
+        'waterfront': 1,
+        'park': 2
+    }
+    text = 'A quiet park, by the river. ' * 10
+    chunks = [text[start:start + 7] for start in range(0, len(text), 7)]
+    assert count_words(chunks) == Counter(tokenize(text))
+    assert count_words([]) == {}
+
+
+def test_search_requires_every_word(content_index):
+    content_index.add('Park', 'A quiet park by the river')
+    content_index.add('Lake', 'A quiet lake')
+
+    assert content_index.search('quiet') == ['Lake', 'Park']
+    assert content_index.search('QUIET river') == ['Park']
+    assert content_index.search('quiet desert') == []
+    assert content_index.search('!!') == []
+
+
+def test_search_ranks_best_matches_first(content_index):
+    content_index.add('Mentions', 'tacos are sold here among many other things')
+    content_index.add('About Tacos', 'tacos tacos tacos')
+    content_index.add('Unrelated', 'nothing to see')
+
+    assert content_index.search('tacos') == ['About Tacos', 'Mentions']
+    assert content_index.search('tacos', limit=1) == ['About Tacos']
+
+
+def test_add_replaces_previous_content(content_index):
+    content_index.add('Park', 'old words')
+    content_index.add('Park', 'new words')
+
+    assert content_index.search('old') == []
+    assert content_index.search('new') == ['Park']
+    assert content_index.search('words') == ['Park']
+
+
+def test_index_is_built_once_and_shared(bucket):
+    rebuild = MagicMock(return_value=[('Park', 'A lovely park')])
+    first = ContentIndex(bucket, rebuild)
+
+    assert first.search('lovely') == ['Park']
+    rebuild.assert_called_once()
+
+    # Another process loads the stored index instead of building it again.
+    second = ContentIndex(bucket, rebuild)
+    assert second.search('lovely') == ['Park']
+    rebuild.assert_called_once()
+
+
+def test_index_picks_up_changes_from_other_processes(bucket):
+    first = ContentIndex(bucket, MagicMock(return_value=[]), refresh_interval=0)
+    second = ContentIndex(bucket,
+                          MagicMock(return_value=[]),
+                          refresh_interval=0)
+    first.search('anything')
+    second.search('anything')
+
+    first.add('Park', 'A lovely park')
+    assert second.search('lovely') == ['Park']
+
+    # Pages added by both processes are kept.
+    second.add('Lake', 'A lovely lake')
+    first.add('River', 'A lovely river')
+    assert first.search('lovely') == ['Lake', 'Park', 'River']
+
+
+def test_backend_search_by_content_uses_index():
+    backend = Backend(storage_client=MemoryClient())
+    backend.upload(io.BytesIO(b'A lovely park'), 'Park.txt', 'fake_author')
+    backend.upload(io.BytesIO(b'A lovely lake'), 'Lake.txt', 'fake_author')
+    backend.update_page('upvote', 'fake_user', 'Park.txt')
+
+    # Searching does not download a single page.
+    with patch.object(Backend, 'get_wiki_page') as mock_get_wiki:
+        assert backend.search_by_content('lovely') == [['Lake', 0, 0],
+                                                       ['Park', 1, 0]]
+        assert backend.search_by_content('park') == [['Park', 1, 0]]
+        assert backend.search_by_content('lovely', limit=1) == [['Lake', 0, 0]]
+        mock_get_wiki.assert_not_called()
+
+
+@pytest.fixture
+def title_index():
+    ''' a title index built from a fixed list of titles '''
+
+    return TitleIndex(load_titles=MagicMock(return_value=[
+        'Georgetown Waterfront Park', 'George Mason Memorial', 'Rock Creek',
+        'Lake Artemesia'
+    ]))
+
+
+def test_trigrams():
+    assert trigrams('park') == {'par', 'ark'}
+    assert trigrams('pa') == set()
+
+
+def test_substring_distance():
+    assert substring_distance('georgetown', 'georgetown waterfront park') == 0
+    assert substring_distance('georgtown', 'georgetown waterfront park') == 1
+    assert substring_distance('waterfrnt prk',
+                              'georgetown waterfront park') == 2
+    assert substring_distance('zzz', 'park') == 3
+
+
+def test_title_search(title_index):
+    assert title_index.search('GEORGE') == [
+        'George Mason Memorial', 'Georgetown Waterfront Park'
+    ]
+    assert title_index.search('front park') == ['Georgetown Waterfront Park']
+    assert title_index.search('k c') == ['Rock Creek']
+    assert title_index.search('zoo') == []
+
+    # The index is built once from the titles.
+    title_index.load_titles.assert_called_once()
+
+
+def test_title_fuzzy_search(title_index):
+    assert title_index.fuzzy_search('georgtown') == [
+        'Georgetown Waterfront Park'
+    ]
+    assert title_index.fuzzy_search('lake artemisia') == ['Lake Artemesia']
+    assert title_index.fuzzy_search('rokc creek', max_distance=1) == []
+    assert title_index.fuzzy_search('rokc creek') == ['Rock Creek']
+
+    # Exact matches come before the ones with typos.
+    assert title_index.fuzzy_search('george') == [
+        'George Mason Memorial', 'Georgetown Waterfront Park'
+    ]
+    assert title_index.fuzzy_search('george',
+                                    limit=1) == ['George Mason Memorial']
+
+
+def test_title_fuzzy_search_without_shared_trigrams():
+    title_index = TitleIndex(load_titles=MagicMock(
+        return_value=['Park', 'Museum', 'Zoo']))
+
+    # These typos break every trigram the query shares with the title.
+    assert title_index.fuzzy_search('Prak') == ['Park']
+    assert title_index.fuzzy_search('Pak') == ['Park']
+    assert title_index.fuzzy_search('Muesum') == ['Museum']
+    assert title_index.fuzzy_search('zo0') == ['Zoo']
+
+
+def test_title_fuzzy_search_short_queries():
+    title_index = TitleIndex(load_titles=MagicMock(
+        return_value=['Park', 'Apple'] + [f'Title {i}' for i in range(200)]))
+
+    # Three characters only allow one typo, so a title sharing a single letter is not a match.
+    assert title_index.fuzzy_search('pak') == ['Park']
+
+    # Only the titles sharing pairs of characters with the query are compared to it, here 'pa' and 'rk'.
+    with patch('flaskr.search.substring_distance',
+               wraps=substring_distance) as mock_distance:
+        assert title_index.fuzzy_search('prak') == ['Park']
+    mock_distance.assert_called_once_with('prak', 'park')
+
+
+def test_title_index_add(title_index):
+    title_index.add('Great Falls')
+
+    assert title_index.search('falls') == ['Great Falls']
+    assert title_index.fuzzy_search('graet falls') == ['Great Falls']
+
+
+def test_title_index_rebuilds_after_refresh_interval(title_index):
+    title_index.refresh_interval = 0
+    title_index.search('park')
+    title_index.search('park')
+
+    assert title_index.load_titles.call_count == 2
+
+
+def test_backend_search_by_title_uses_index():
+    backend = Backend(storage_client=MemoryClient())
+    backend.upload(io.BytesIO(b'A lovely park'), 'Rock Creek Park.txt',
+                   'fake_author')
+
+    assert backend.search_by_title('creek') == [['Rock Creek Park', 0, 0]]
+    assert backend.search_by_title('rock crek') == []
+    assert backend.search_by_title('rock crek',
+                                   fuzzy=True) == [['Rock Creek Park', 0, 0]]
+    assert backend.search_by_title('rokc',
+                                   fuzzy=True) == [['Rock Creek Park', 0, 0]]
+
+    # Pages uploaded after the index was built are found too.
+    backend.upload(io.BytesIO(b'A lovely lake'), 'Lake Artemesia.txt',
+                   'fake_author')
+    assert backend.search_by_title('lake') == [['Lake Artemesia', 0, 0]]
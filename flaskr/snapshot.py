@@ -0,0 +1,159 @@
+'''
+A point-in-time view of the whole wiki.
+
+Contains the CorpusSnapshot class, which the listing, sorting, filtering and search methods of the
+backend all read from, so a request never downloads the same page twice.
+'''
+
+from collections import Counter
+import bisect
+import threading
+import time
+
+
+class CorpusSnapshot:
+    '''
+    Holds the catalog row of every wiki page, as read at one point in time.
+
+    The names, ratings and creation dates come straight from the catalog rows. The page contents are
+    only downloaded the first time they are asked for, and then kept for the lifetime of the snapshot.
+    Pages uploaded and votes written by this process are applied to the snapshot as they happen, so it
+    does not have to be read again after every change.
+
+    Attributes:
+        rows = The catalog rows of every wiki page, sorted by page name.
+        load_pages = Function taking page file names and returning a dictionary mapping each of them to its
+            metadata (or None), such as Backend.get_wiki_pages.
+        created_at = When the snapshot was taken, as a time.monotonic() value.
+    '''
+
+    def __init__(self, rows, load_pages):
+        '''Initializes a CorpusSnapshot object'''
+        self.rows = list(rows)
+        self.load_pages = load_pages
+        self.created_at = time.monotonic()
+        self._names = [row['name'] for row in rows]
+        self._rows_by_name = {row['name']: row for row in rows}
+        self._years = None
+        # The content of every page read so far by name, None for the pages that could not be read.
+        self._contents = None
+        self._lock = threading.Lock()
+        self._contents_lock = threading.Lock()
+
+    def age(self):
+        '''Returns how many seconds ago the snapshot was taken'''
+        return time.monotonic() - self.created_at
+
+    def put(self, row):
+        ''' Adds the row of a page that was just uploaded, replacing its previous row if any.
+            row : A row as built by catalog.summarize.
+        '''
+        name = row['name']
+        with self._lock:
+            previous = self._rows_by_name.get(name)
+            index = bisect.bisect_left(self._names, name)
+            if previous is None:
+                self._names.insert(index, name)
+                self.rows.insert(index, row)
+            else:
+                self.rows[index] = row
+            self._rows_by_name[name] = row
+            if self._years is not None:
+                if previous is not None:
+                    self._years[previous['date_created'][:4]] -= 1
+                self._years[row['date_created'][:4]] += 1
+            if self._contents is not None:
+                # The new content is read the next time the contents are asked for.
+                self._contents.pop(name, None)
+
+    def update(self, name, **fields):
+        ''' Changes some fields of a page's row, such as its vote counts. Does nothing if the page has no row.
+            name : Name of the wiki page, without the '.txt' extension.
+            fields : The new values, e.g. upvotes=3.
+        '''
+        with self._lock:
+            row = self._rows_by_name.get(name)
+            if row is None:
+                return
+            # Rows are replaced rather than changed, since the lists handed out may still be read.
+            row = dict(row, **fields)
+            self.rows[bisect.bisect_left(self._names, name)] = row
+            self._rows_by_name[name] = row
+
+    def pages(self, page_size=None, cursor=None):
+        ''' Returns a [page name, upvotes, downvotes] list for the pages coming after the cursor, sorted by name.
+            Example : [['page1', 0, 1]]
+            page_size : Maximum number of pages to return; all of them by default.
+            cursor : Name of the last page of the previous results; the results start from the first page by default.
+        '''
+        with self._lock:
+            start = 0 if cursor is None else bisect.bisect_right(
+                self._names, cursor)
+            end = None if page_size is None else start + page_size
+            return [[row['name'], row['upvotes'], row['downvotes']]
+                    for row in self.rows[start:end]]
+
+    def ratings(self, page_names):
+        ''' Returns a [page name, upvotes, downvotes] list for each of the given pages that exists, in the same order.
+            Example : ['page1', 'missing'] -> [['page1', 0, 1]]
+        '''
+        with self._lock:
+            rows = [self._rows_by_name.get(name) for name in page_names]
+        return [[row['name'], row['upvotes'], row['downvotes']]
+                for row in rows
+                if row is not None]
+
+    def dates(self):
+        ''' Returns a dictionary mapping (page name, upvotes, downvotes) to the page's creation date.
+            Example : {('page1', 0, 1): '2022-01-03'}
+        '''
+        with self._lock:
+            rows = list(self.rows)
+        return {(row['name'], row['upvotes'], row['downvotes']):
+                row['date_created'] for row in rows}
+
+    def year_counts(self):
+        ''' Returns how many pages were created each year, from the latest year to the oldest.
+            Example : {'2023': 4, '2021': 1}
+        '''
+        with self._lock:
+            if self._years is None:
+                self._years = Counter(
+                    row['date_created'][:4] for row in self.rows)
+            return {
+                year: self._years[year]
+                for year in sorted(self._years, reverse=True)
+                if self._years[year]
+            }
+
+    def contents(self):
+        ''' Returns a dictionary mapping (page name, upvotes, downvotes) to the page's content.
+            Pages that could not be read are left out.
+            Example : {('page1', 0, 1): 'content'}
+        '''
+        with self._contents_lock:
+            with self._lock:
+                rows = list(self.rows)
+                if self._contents is None:
+                    self._contents = {}
+                missing = [
+                    row['name']
+                    for row in rows
+                    if row['name'] not in self._contents
+                ]
+            if missing:
+                pages_metadata = self.load_pages(
+                    name + '.txt' for name in missing)
+                loaded = {}
+                for name in missing:
+                    page_metadata = pages_metadata.get(name + '.txt')
+                    loaded[name] = page_metadata.get(
+                        'content') if page_metadata else None
+                with self._lock:
+                    self._contents.update(loaded)
+            with self._lock:
+                contents = dict(self._contents)
+        return {(row['name'], row['upvotes'], row['downvotes']):
+                contents[row['name']]
+                for row in rows
+                if contents.get(row['name']) is not None}
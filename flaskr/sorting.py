@@ -0,0 +1,223 @@
+'''
+Precomputed orderings of the wiki pages.
+
+Contains the SortIndex class, which keeps the page names sorted alphabetically and from the latest
+to the oldest, along with the pages created each year, so sorted and filtered listings can be served
+without sorting or scanning the whole wiki on every request.
+'''
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+import bisect
+import json
+import threading
+import time
+
+SORT_INDEX_BLOB_NAME = '_index/sort.json'
+
+SORT_ORDERS = ('a_z', 'z_a', 'latest')
+
+# Replacing every digit d by 9 - d turns a 'YYYY-MM-DD' date into a string sorting from the latest date to the oldest.
+_LATEST_FIRST = str.maketrans('0123456789', '9876543210')
+
+
+def _year(date_created):
+    ''' Returns the year of a 'YYYY-MM-DD' date.
+        Example : '2022-01-03' -> '2022'
+    '''
+    return date_created[:4]
+
+
+def _latest_key(name, date_created):
+    ''' Returns the key ordering pages from the latest to the oldest, and alphabetically for the same date.
+        Example : ('Park', '2022-01-03') -> ('7977-98-96', 'Park')
+    '''
+    return (date_created.translate(_LATEST_FIRST), name)
+
+
+class SortIndex:
+    '''
+    Keeps the names of the wiki pages in the a_z and latest orders, z_a being a_z read backwards,
+    and the alphabetically sorted names of the pages created each year.
+
+    The orderings are kept in memory as sorted lists, updated with a binary search insertion when a page is
+    uploaded, and persisted as a single object of the content bucket so every process serving the wiki
+    shares them. Writes are generation-preconditioned and retried on conflict, and the in-memory copy is
+    refreshed when another process changed the stored one.
+
+    Attributes:
+        bucket = The content bucket storing the index.
+        rebuild = Function returning the catalog row of every page, used when the index does not exist yet.
+        blob_name = Name of the index object inside the bucket.
+        refresh_interval = Seconds between checks for changes made to the stored index by other processes.
+        max_attempts = How many times a conflicting write is retried before giving up.
+    '''
+
+    def __init__(self,
+                 bucket,
+                 rebuild,
+                 blob_name=SORT_INDEX_BLOB_NAME,
+                 refresh_interval=30,
+                 max_attempts=5):
+        '''Initializes a SortIndex object'''
+        self.bucket = bucket
+        self.rebuild = rebuild
+        self.blob_name = blob_name
+        self.refresh_interval = refresh_interval
+        self.max_attempts = max_attempts
+        self._lock = threading.RLock()
+        self._names = None
+        self._latest = []
+        self._dates = {}
+        self._years = {}
+        self._generation = None
+        self._checked_at = 0
+
+    def _reset(self, dates):
+        ''' Replaces the in-memory orderings.
+            dates : Dictionary mapping every page name to its creation date.
+        '''
+        self._dates = dict(dates)
+        self._names = sorted(self._dates)
+        self._latest = sorted(
+            _latest_key(name, date) for name, date in self._dates.items())
+        self._years = {}
+        for name in self._names:
+            self._years.setdefault(_year(self._dates[name]), []).append(name)
+
+    def _apply(self, page_name, date_created):
+        '''Inserts a page in the in-memory orderings, moving it if it was already there'''
+        if page_name in self._dates:
+            previous_date = self._dates[page_name]
+            previous = _latest_key(page_name, previous_date)
+            del self._latest[bisect.bisect_left(self._latest, previous)]
+            year = self._years[_year(previous_date)]
+            del year[bisect.bisect_left(year, page_name)]
+            if not year:
+                del self._years[_year(previous_date)]
+        else:
+            bisect.insort(self._names, page_name)
+        self._dates[page_name] = date_created
+        bisect.insort(self._latest, _latest_key(page_name, date_created))
+        bisect.insort(self._years.setdefault(_year(date_created), []),
+                      page_name)
+
+    def _load(self):
+        '''Loads the stored index into memory, building and storing it first if it does not exist'''
+        blob = self.bucket.blob(self.blob_name)
+        try:
+            stored = json.loads(blob.download_as_bytes())
+        except NotFound:
+            self._reset(
+                {row['name']: row['date_created'] for row in self.rebuild()})
+            try:
+                self._store(if_generation_match=0)
+            except PreconditionFailed:
+                # Another process built it at the same time; use theirs next time.
+                self._generation = None
+        else:
+            self._reset(stored['dates'])
+            self._generation = blob.generation
+        self._checked_at = time.monotonic()
+
+    def _store(self, if_generation_match=None):
+        '''Persists the in-memory index'''
+        blob = self.bucket.blob(self.blob_name)
+        blob.upload_from_string(json.dumps({'dates': self._dates}),
+                                content_type='application/json',
+                                if_generation_match=if_generation_match)
+        self._generation = blob.generation
+
+    def _refresh(self):
+        '''Makes sure the in-memory index exists and is not older than refresh_interval'''
+        if self._names is None:
+            self._load()
+            return
+        if time.monotonic() - self._checked_at < self.refresh_interval:
+            return
+        blob = self.bucket.blob(self.blob_name)
+        try:
+            blob.reload()
+        except NotFound:
+            self._load()
+            return
+        if blob.generation != self._generation:
+            self._load()
+        self._checked_at = time.monotonic()
+
+    def add(self, page_name, date_created):
+        ''' Adds a page that was just uploaded to every ordering and persists the index.
+            page_name : Name of the wiki page, without the '.txt' extension.
+            date_created : The page's creation date, as 'YYYY-MM-DD'.
+        '''
+        with self._lock:
+            self._refresh()
+            for attempt in range(self.max_attempts):
+                self._apply(page_name, date_created)
+                try:
+                    self._store(if_generation_match=self._generation or 0)
+                    return
+                except PreconditionFailed:
+                    # Another process changed the index; start over from its version.
+                    self._load()
+            raise PreconditionFailed(
+                f'Could not update {self.blob_name} after {self.max_attempts} attempts'
+            )
+
+    def page(self, order, page_size=None, cursor=None):
+        ''' Returns the names of the pages in the given order, starting right after the cursor.
+            order : One of 'a_z', 'z_a' or 'latest'.
+            page_size : Maximum number of names to return; all of them by default.
+            cursor : Name of the last page of the previous results; the results start from the first page by default.
+        '''
+        if order not in SORT_ORDERS:
+            raise ValueError(f'Unknown sort order {order!r}')
+
+        with self._lock:
+            self._refresh()
+            end_of = lambda start: None if page_size is None else start + page_size
+
+            if order == 'a_z':
+                start = 0
+                if cursor is not None:
+                    start = bisect.bisect_right(self._names, cursor)
+                return self._names[start:end_of(start)]
+
+            if order == 'z_a':
+                # Read the alphabetical order backwards, from right before the cursor.
+                end = len(self._names)
+                if cursor is not None:
+                    end = bisect.bisect_left(self._names, cursor)
+                start = 0 if page_size is None else max(0, end - page_size)
+                return self._names[start:end][::-1]
+
+            start = 0
+            if cursor is not None:
+                # A cursor that is not a known page has nothing after it.
+                if cursor not in self._dates:
+                    return []
+                start = bisect.bisect_right(
+                    self._latest, _latest_key(cursor, self._dates[cursor]))
+            return [name for _, name in self._latest[start:end_of(start)]]
+
+    def by_year(self, year):
+        ''' Returns the names of the pages created during a year, sorted alphabetically.
+            year : The year, as a str such as '2022'.
+        '''
+        with self._lock:
+            self._refresh()
+            return list(self._years.get(year, []))
+
+    def between(self, start_date, end_date):
+        ''' Returns the names of the pages created between two dates included, from the latest to the oldest.
+            start_date : The earliest creation date, as 'YYYY-MM-DD'.
+            end_date : The latest creation date, as 'YYYY-MM-DD'.
+        '''
+        with self._lock:
+            self._refresh()
+
+            # The latest order is sorted by date, so the pages in the range are next to each other.
+            start = bisect.bisect_left(self._latest,
+                                       (end_date.translate(_LATEST_FIRST),))
+            end = bisect.bisect_left(
+                self._latest, (start_date.translate(_LATEST_FIRST) + '\0',))
+            return [name for _, name in self._latest[start:end]]
@@ -0,0 +1,63 @@
+'''
+Resized variants of the profile pictures.
+
+Contains the make_thumbnails function, which resizes an uploaded picture to each of the PICTURE_SIZES,
+so pages showing a small picture do not download the full resolution one, and the variant_blob_name
+function, which names the variants.
+
+Resizing needs Pillow. Without it, no variant is made and the original picture is served for every size.
+'''
+
+import io
+import logging
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# The longest edge, in pixels, of each variant of a picture, from the smallest to the largest.
+PICTURE_SIZES = {
+    'avatar': 64,
+    'card': 320,
+    'full': 1024,
+}
+
+# Quality of the stored variants; high enough that the resizing shows more than the compression.
+JPEG_QUALITY = 85
+
+
+def variant_blob_name(username, size):
+    ''' Returns the name of the object storing a variant of a user's profile picture.
+        Example : ('user1', 'card') -> '_pfp/user1/card.jpg'
+    '''
+    return f'_pfp/{username}/{size}.jpg'
+
+
+def make_thumbnails(data):
+    ''' Returns a dictionary mapping each size to the JPEG bytes of the picture resized to it.
+        Pictures are only ever shrunk, keeping their proportions. Returns an empty dictionary if Pillow is
+        not installed or the data is not a picture it can read.
+        data : Bytes of the uploaded picture.
+    '''
+    if Image is None:
+        return {}
+    thumbnails = {}
+    try:
+        for size, edge in PICTURE_SIZES.items():
+            image = Image.open(io.BytesIO(data))
+            # Lets JPEG pictures be decoded at a fraction of their resolution instead of in full.
+            image.draft('RGB', (edge, edge))
+            image.thumbnail((edge, edge))
+            output = io.BytesIO()
+            image.convert('RGB').save(output,
+                                      'JPEG',
+                                      quality=JPEG_QUALITY,
+                                      optimize=True)
+            thumbnails[size] = output.getvalue()
+    except (OSError, Image.DecompressionBombError):
+        logger.exception('Could not resize a picture of %d bytes', len(data))
+        return {}
+    return thumbnails
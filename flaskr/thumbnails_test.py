@@ -0,0 +1,43 @@
+from flaskr import thumbnails
+from flaskr.thumbnails import PICTURE_SIZES, make_thumbnails, variant_blob_name
+from unittest.mock import patch
+import pytest
+import io
+
+
+def test_variant_blob_name():
+    assert variant_blob_name('user1', 'card') == '_pfp/user1/card.jpg'
+
+
+def test_thumbnails_are_shrunk_to_each_size():
+    Image = pytest.importorskip('PIL.Image')
+    picture = io.BytesIO()
+    Image.new('RGB', (2000, 1000), 'green').save(picture, 'JPEG')
+
+    resized = make_thumbnails(picture.getvalue())
+
+    assert list(resized) == list(PICTURE_SIZES)
+    for size, edge in PICTURE_SIZES.items():
+        assert Image.open(io.BytesIO(resized[size])).size == (edge, edge // 2)
+    assert len(resized['avatar']) < len(resized['full'])
+
+
+def test_small_pictures_are_not_enlarged():
+    Image = pytest.importorskip('PIL.Image')
+    picture = io.BytesIO()
+    Image.new('RGB', (100, 50), 'green').save(picture, 'JPEG')
+
+    resized = make_thumbnails(picture.getvalue())
+
+    assert Image.open(io.BytesIO(resized['avatar'])).size == (64, 32)
+    assert Image.open(io.BytesIO(resized['full'])).size == (100, 50)
+
+
+def test_no_thumbnails_without_pillow():
+    with patch.object(thumbnails, 'Image', None):
+        assert make_thumbnails(b'Fake_Image_Data') == {}
+
+
+def test_no_thumbnails_of_what_is_not_a_picture():
+    pytest.importorskip('PIL.Image')
+    assert make_thumbnails(b'Fake_Image_Data') == {}
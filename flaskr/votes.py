@@ -0,0 +1,224 @@
+'''
+Buffering of the votes cast on wiki pages.
+
+Contains the VoteAggregator class, which collects the votes cast on the pages for a short time and hands
+them over in batches, so a popular page is rewritten once per flush instead of once per click, and
+the Voters class, which holds the users who voted one way on a page.
+'''
+
+import bisect
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Separated the usernames of the Voters objects stored as a single string, before they were stored as lists.
+_LEGACY_SEPARATOR = '\n'
+
+# Key of the front coded string of usernames in the stored form of a Voters object.
+_FRONT_CODED = 'front_coded'
+
+
+class Voters(list):
+    '''
+    The usernames of the users who voted one way on a wiki page, kept sorted and without duplicates.
+
+    Voters is a list, so it can be compared to a plain list of usernames. Checking whether someone voted,
+    adding and removing a voter are binary searches rather than scans of the whole list. It is stored
+    front coded: each username only stores what it does not share with the one before it, and says how
+    long that part is, so a username holding any character, even a line break, is stored as a single voter.
+    '''
+
+    def __init__(self, usernames=()):
+        '''Initializes a Voters object'''
+        if not isinstance(usernames, Voters):
+            usernames = list(usernames)
+            # Stored and copied voters are already sorted, and do not need sorting again.
+            if any(previous >= username
+                   for previous, username in zip(usernames, usernames[1:])):
+                usernames = sorted(set(usernames))
+        super().__init__(usernames)
+
+    def _find(self, username):
+        '''Returns where the username is, or would be inserted'''
+        return bisect.bisect_left(self, username)
+
+    def __contains__(self, username):
+        index = self._find(username)
+        return index < len(self) and self[index] == username
+
+    def add(self, username):
+        '''Adds a voter, unless they already voted'''
+        index = self._find(username)
+        if index == len(self) or self[index] != username:
+            self.insert(index, username)
+
+    def discard(self, username):
+        '''Removes a voter, if they voted'''
+        index = self._find(username)
+        if index < len(self) and self[index] == username:
+            del self[index]
+
+    def encode(self):
+        ''' Returns the stored form of the voters: for each username, how many characters it shares with the
+            previous one and how many follow, then the characters that follow.
+            Example : Voters(['user10', 'user1', 'bob']) -> {'front_coded': '0,3:bob0,5:user15,1:0'}
+        '''
+        parts = []
+        previous = ''
+        for username in self:
+            shared = len(os.path.commonprefix((previous, username)))
+            suffix = username[shared:]
+            parts.append(f'{shared},{len(suffix)}:{suffix}')
+            previous = username
+        return {_FRONT_CODED: ''.join(parts)}
+
+    @classmethod
+    def decode(cls, encoded):
+        ''' Returns the Voters object stored in the given form.
+            The lists of usernames, and the single strings of usernames one per line, stored by earlier
+            versions are accepted too.
+        '''
+        if isinstance(encoded, cls):
+            return encoded
+        if isinstance(encoded, dict):
+            coded = encoded[_FRONT_CODED]
+            usernames = []
+            previous = ''
+            start = 0
+            while start < len(coded):
+                comma = coded.index(',', start)
+                colon = coded.index(':', comma)
+                end = colon + 1 + int(coded[comma + 1:colon])
+                previous = previous[:int(coded[start:comma])] + coded[colon +
+                                                                      1:end]
+                usernames.append(previous)
+                start = end
+            return cls(usernames)
+        if isinstance(encoded, str):
+            return cls(encoded.split(_LEGACY_SEPARATOR) if encoded else ())
+        return cls(encoded)
+
+
+def encode_votes(votes):
+    ''' Returns the stored form of a page's votes.
+        votes : Dictionary holding the upvotes, who_upvoted, downvotes and who_downvoted of a page.
+        Example : {'upvotes': 2, 'who_upvoted': ['bob', 'alice'], ...} -> {'upvotes': 2, 'who_upvoted': {'front_coded': '0,5:alice0,3:bob'}, ...}
+    '''
+    return {
+        'upvotes': votes['upvotes'],
+        'who_upvoted': Voters.decode(votes['who_upvoted']).encode(),
+        'downvotes': votes['downvotes'],
+        'who_downvoted': Voters.decode(votes['who_downvoted']).encode()
+    }
+
+
+def decode_votes(stored):
+    ''' Returns a page's votes from their stored form, with the voters as Voters objects.
+        stored : Dictionary holding the upvotes, who_upvoted, downvotes and who_downvoted of a page, such as
+            a vote record or a page file.
+    '''
+    upvoters = Voters.decode(stored['who_upvoted'])
+    downvoters = Voters.decode(stored['who_downvoted'])
+    return {
+        'upvotes': len(upvoters),
+        'who_upvoted': upvoters,
+        'downvotes': len(downvoters),
+        'who_downvoted': downvoters
+    }
+
+
+def copy_votes(votes):
+    ''' Returns a copy of a page's decoded votes that can be changed without changing them.
+        votes : Dictionary holding the upvotes, who_upvoted, downvotes and who_downvoted of a page, as
+            returned by decode_votes.
+    '''
+    return dict(votes,
+                who_upvoted=Voters(votes['who_upvoted']),
+                who_downvoted=Voters(votes['who_downvoted']))
+
+
+class VoteAggregator:
+    '''
+    Collects the votes cast on the wiki pages and flushes them together.
+
+    The first vote cast after a flush starts a timer; when it fires, the votes cast on each page in the
+    meantime are passed, in order, to the apply function, which is expected to write them as a single
+    update. Votes are toggles (voting twice takes the vote back), which is why they are kept in order
+    rather than summed. Once every page was written, the after_flush function gets what apply returned
+    for each of them, so whatever summarizes several pages, such as the catalog, is written once per
+    flush rather than once per page.
+
+    Attributes:
+        apply = Function taking a page name and a list of (username, action) tuples, writing them and
+            returning the page's new votes.
+        flush_interval = Seconds during which the votes are collected before being written.
+            With 0, every vote is written right away.
+        after_flush = Function taking a dictionary mapping the name of every page written by a flush to
+            what apply returned for it, or None.
+    '''
+
+    def __init__(self, apply, flush_interval=0.5, after_flush=None):
+        '''Initializes a VoteAggregator object'''
+        self.apply = apply
+        self.flush_interval = flush_interval
+        self.after_flush = after_flush
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, page_name, username, action):
+        ''' Records a vote, to be written at the next flush.
+            page_name : Name of the wiki page's file, including the '.txt' extension.
+            username : The user who voted.
+            action : Either 'upvote' or 'downvote'.
+        '''
+        with self._lock:
+            self._pending.setdefault(page_name, []).append((username, action))
+            if self.flush_interval and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if not self.flush_interval:
+            self.flush(page_name)
+
+    def pending(self, page_name):
+        '''Returns the (username, action) votes cast on a page that were not written yet'''
+        with self._lock:
+            return list(self._pending.get(page_name, ()))
+
+    def flush(self, page_name=None):
+        ''' Writes the pending votes of a page, or of every page if no name is given.
+            A batch that can not be written is logged and dropped, so it does not block the next ones.
+        '''
+        with self._lock:
+            if page_name is None:
+                names = list(self._pending)
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            else:
+                # The timer is left running for the other pages.
+                names = [page_name]
+            batches = []
+            for name in names:
+                votes = self._pending.pop(name, None)
+                if votes:
+                    batches.append((name, votes))
+
+        written = {}
+        for name, votes in batches:
+            try:
+                written[name] = self.apply(name, votes)
+            except Exception:
+                logger.exception('Could not write %d votes on %s', len(votes),
+                                 name)
+
+        if written and self.after_flush is not None:
+            try:
+                self.after_flush(written)
+            except Exception:
+                logger.exception(
+                    'Could not finish writing the votes on %d pages',
+                    len(written))
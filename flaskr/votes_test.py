@@ -0,0 +1,322 @@
+from flaskr.backend import Backend
+from flaskr.blobstore import Blob, MemoryClient
+from flaskr.votes import VoteAggregator, Voters, decode_votes, encode_votes
+from google.api_core.exceptions import PreconditionFailed
+from unittest.mock import MagicMock, patch
+import threading
+import json
+import io
+
+
+def test_votes_are_flushed_together():
+    votes = VoteAggregator(apply=MagicMock(), flush_interval=60)
+    votes.add('Park.txt', 'user1', 'upvote')
+    votes.add('Park.txt', 'user2', 'downvote')
+    votes.add('Lake.txt', 'user1', 'upvote')
+
+    assert votes.pending('Park.txt') == [('user1', 'upvote'),
+                                         ('user2', 'downvote')]
+    votes.apply.assert_not_called()
+
+    votes.flush('Park.txt')
+    votes.apply.assert_called_once_with('Park.txt', [('user1', 'upvote'),
+                                                     ('user2', 'downvote')])
+    assert votes.pending('Park.txt') == []
+
+    # Flushing everything writes the other pages too.
+    votes.flush()
+    votes.apply.assert_called_with('Lake.txt', [('user1', 'upvote')])
+    assert votes.apply.call_count == 2
+
+
+def test_votes_are_flushed_after_interval():
+    flushed = threading.Event()
+    votes = VoteAggregator(
+        apply=MagicMock(side_effect=lambda *args: flushed.set()),
+        flush_interval=0.01)
+    votes.add('Park.txt', 'user1', 'upvote')
+    votes.add('Park.txt', 'user2', 'upvote')
+
+    assert flushed.wait(timeout=5)
+    votes.apply.assert_called_once_with('Park.txt', [('user1', 'upvote'),
+                                                     ('user2', 'upvote')])
+
+
+def test_votes_without_interval_are_written_right_away():
+    votes = VoteAggregator(apply=MagicMock(), flush_interval=0)
+    votes.add('Park.txt', 'user1', 'upvote')
+
+    votes.apply.assert_called_once_with('Park.txt', [('user1', 'upvote')])
+
+
+def test_votes_on_several_pages_are_flushed_by_one_timer():
+    flushed = threading.Event()
+    votes = VoteAggregator(
+        apply=MagicMock(side_effect=lambda name, votes: len(votes)),
+        flush_interval=0.1,
+        after_flush=MagicMock(side_effect=lambda written: flushed.set()))
+    votes.add('Park.txt', 'user1', 'upvote')
+    votes.add('Lake.txt', 'user1', 'upvote')
+    votes.add('Park.txt', 'user2', 'upvote')
+
+    assert flushed.wait(timeout=5)
+    votes.after_flush.assert_called_once_with({'Park.txt': 2, 'Lake.txt': 1})
+
+
+def test_failed_flush_does_not_raise():
+    votes = VoteAggregator(apply=MagicMock(side_effect=ValueError()),
+                           flush_interval=60)
+    votes.add('Park.txt', 'user1', 'upvote')
+
+    votes.flush()
+    assert votes.pending('Park.txt') == []
+
+
+def stored_page(backend, name):
+    return json.loads(backend.info_bucket.blob(name).download_as_bytes())
+
+
+def stored_votes(backend, name):
+    return decode_votes(stored_page(backend, Backend._votes_blob_name(name)))
+
+
+def test_backend_writes_votes_once_per_flush():
+    backend = Backend(storage_client=MemoryClient(), vote_flush_interval=60)
+    backend.upload(io.BytesIO(b'A lovely park'), 'Park.txt', 'fake_author')
+
+    with patch.object(Blob,
+                      'upload_from_string',
+                      autospec=True,
+                      side_effect=Blob.upload_from_string) as mock_upload:
+        backend.vote('upvote', 'user1', 'Park.txt')
+        backend.vote('upvote', 'user2', 'Park.txt')
+        backend.vote('downvote', 'user3', 'Park.txt')
+        backend.vote('upvote', 'user2', 'Park.txt')
+
+        # Nothing is written yet, but the votes already show on the page.
+        mock_upload.assert_not_called()
+        assert stored_page(backend, 'Park.txt')['upvotes'] == 0
+        page = backend.get_wiki_page('Park.txt')
+        assert page['who_upvoted'] == ['user1']
+        assert page['who_downvoted'] == ['user3']
+
+        backend.votes.flush()
+
+        # The vote record and the catalog are each written once, and the page file not at all.
+        assert [call.args[0].name for call in mock_upload.call_args_list
+               ] == ['_votes/Park.json', '_catalog.json']
+
+    votes = stored_votes(backend, 'Park.txt')
+    assert (votes['upvotes'], votes['downvotes']) == (1, 1)
+    assert backend.get_wiki_page('Park.txt')['upvotes'] == 1
+    assert backend.get_all_page_names() == [['Park', 1, 1]]
+
+
+def test_backend_retries_votes_on_conflict():
+    backend = Backend(storage_client=MemoryClient(), vote_flush_interval=60)
+    backend.upload(io.BytesIO(b'A lovely park'), 'Park.txt', 'fake_author')
+    backend.update_page('downvote', 'user3', 'Park.txt')
+    backend.vote('upvote', 'user1', 'Park.txt')
+    other_process = Backend(storage_client=backend.storage_client)
+
+    original_download = Blob.download_as_bytes
+    downloads = []
+
+    def download_then_vote(blob, *args, **kwargs):
+        # Someone votes on the page from another process right after our first read.
+        data = original_download(blob, *args, **kwargs)
+        downloads.append(blob.name)
+        if len(downloads) == 1:
+            other_process.update_page('upvote', 'user2', 'Park.txt')
+        return data
+
+    with patch.object(Blob,
+                      'download_as_bytes',
+                      autospec=True,
+                      side_effect=download_then_vote):
+        backend._apply_votes('Park.txt', backend.votes.pending('Park.txt'))
+
+    # Neither vote was lost.
+    votes = stored_votes(backend, 'Park.txt')
+    assert votes['who_upvoted'] == ['user1', 'user2']
+    assert votes['who_downvoted'] == ['user3']
+
+
+def test_comments_do_not_conflict_with_votes():
+    backend = Backend(storage_client=MemoryClient(), vote_flush_interval=0)
+    backend.upload(io.BytesIO(b'A lovely park'), 'Park.txt', 'fake_author')
+    backend.vote('upvote', 'user1', 'Park.txt')
+    backend.update_metadata_with_comments('Park', 'user2', 'Nice!')
+
+    assert backend.get_wiki_page('Park.txt')['who_upvoted'] == ['user1']
+    assert backend.get_comments('Park') == ([{'user2': 'Nice!'}], None)
+
+
+def test_vote_writes_do_not_grow_with_the_page():
+    backend = Backend(storage_client=MemoryClient(), vote_flush_interval=0)
+    backend.upload(io.BytesIO(b'short'), 'Short.txt', 'fake_author')
+    backend.upload(io.BytesIO(b'long ' * 100000), 'Long.txt', 'fake_author')
+
+    with patch.object(Blob,
+                      'upload_from_string',
+                      autospec=True,
+                      side_effect=Blob.upload_from_string) as mock_upload:
+        backend.vote('upvote', 'user1', 'Short.txt')
+        backend.vote('upvote', 'user1', 'Long.txt')
+
+    written = {
+        call.args[0].name: len(call.args[1])
+        for call in mock_upload.call_args_list
+        if call.args[0].name.startswith('_votes/')
+    }
+    assert written['_votes/Short.json'] == written['_votes/Long.json']
+
+
+def test_voters_stay_sorted_without_duplicates():
+    voters = Voters(['carol', 'alice', 'carol'])
+    voters.add('bob')
+    voters.add('alice')
+
+    assert voters == ['alice', 'bob', 'carol']
+    assert 'bob' in voters
+    assert 'dave' not in voters
+
+    voters.discard('bob')
+    voters.discard('dave')
+    assert voters == ['alice', 'carol']
+
+
+def test_votes_are_stored_front_coded():
+    votes = {
+        'upvotes': 3,
+        'who_upvoted': ['user10', 'bob', 'user1'],
+        'downvotes': 0,
+        'who_downvoted': []
+    }
+    stored = encode_votes(votes)
+    assert stored == {
+        'upvotes': 3,
+        'who_upvoted': {
+            'front_coded': '0,3:bob0,5:user15,1:0'
+        },
+        'downvotes': 0,
+        'who_downvoted': {
+            'front_coded': ''
+        }
+    }
+
+    decoded = decode_votes(stored)
+    assert decoded['who_upvoted'] == ['bob', 'user1', 'user10']
+    assert isinstance(decoded['who_upvoted'], Voters)
+
+    # Votes stored as unsorted lists, or as single strings of usernames, are read as well.
+    assert decode_votes(votes) == decoded
+    assert decode_votes({
+        'who_upvoted': 'user1\nbob\nuser10',
+        'who_downvoted': ''
+    }) == decoded
+
+
+def test_popular_page_votes_are_decoded_once():
+    backend = Backend(storage_client=MemoryClient(), vote_flush_interval=0)
+    backend.upload(io.BytesIO(b'A lovely park'), 'Park.txt', 'fake_author')
+    backend.vote('upvote', 'user1', 'Park.txt')
+
+    # Another process reads the record once and decodes it once.
+    other_process = Backend(storage_client=backend.storage_client)
+    with patch('flaskr.backend.decode_votes',
+               wraps=decode_votes) as mock_decode:
+        first = other_process.get_wiki_page('Park.txt')
+        first['who_upvoted'].add('user2')
+        second = other_process.get_wiki_page('Park.txt')
+    mock_decode.assert_called_once()
+
+    # Every view gets its own copy of the voters.
+    assert second['who_upvoted'] == ['user1']
+
+    # A new vote is a new generation of the record.
+    backend.vote('upvote', 'user2', 'Park.txt')
+    assert backend.get_wiki_page('Park.txt')['who_upvoted'] == [
+        'user1', 'user2'
+    ]
+
+
+def test_username_with_line_breaks_is_one_voter():
+    backend = Backend(storage_client=MemoryClient(), vote_flush_interval=0)
+    backend.upload(io.BytesIO(b'A lovely park'), 'Park.txt', 'fake_author')
+    backend.vote('upvote', 'user1', 'Park.txt')
+    backend.vote('upvote', 'bot0\nbot1\nuser1', 'Park.txt')
+
+    page = backend.get_wiki_page('Park.txt')
+    assert page['upvotes'] == 2
+    assert page['who_upvoted'] == ['bot0\nbot1\nuser1', 'user1']
+
+
+def test_uploading_a_page_again_resets_its_votes():
+    backend = Backend(storage_client=MemoryClient(), vote_flush_interval=0)
+    backend.upload(io.BytesIO(b'A lovely park'), 'Park.txt', 'fake_author')
+    backend.vote('upvote', 'user1', 'Park.txt')
+    backend.vote('upvote', 'user2', 'Park.txt')
+    assert backend.get_wiki_page('Park.txt')['upvotes'] == 2
+
+    backend.upload(io.BytesIO(b'A new park'), 'Park.txt', 'fake_author')
+
+    # The listing and the page agree that the new page has no votes yet.
+    assert backend.get_all_page_names() == [['Park', 0, 0]]
+    assert backend.get_wiki_page('Park.txt')['who_upvoted'] == []
+    backend.vote('upvote', 'user1', 'Park.txt')
+    assert backend.get_wiki_page('Park.txt')['who_upvoted'] == ['user1']
+
+
+def test_catalog_is_written_once_per_flush():
+    backend = Backend(storage_client=MemoryClient(), vote_flush_interval=60)
+    backend.upload(io.BytesIO(b'A lovely park'), 'Park.txt', 'fake_author')
+    backend.upload(io.BytesIO(b'A lovely lake'), 'Lake.txt', 'fake_author')
+    backend.vote('upvote', 'user1', 'Park.txt')
+    backend.vote('downvote', 'user1', 'Lake.txt')
+
+    with patch.object(Blob,
+                      'upload_from_string',
+                      autospec=True,
+                      side_effect=Blob.upload_from_string) as mock_upload:
+        backend.votes.flush()
+
+    assert sorted(call.args[0].name for call in mock_upload.call_args_list) == [
+        '_catalog.json', '_votes/Lake.json', '_votes/Park.json'
+    ]
+    assert backend.get_all_page_names() == [['Lake', 0, 1], ['Park', 1, 0]]
+
+
+def test_catalog_conflicts_do_not_lose_votes():
+    backend = Backend(storage_client=MemoryClient(), vote_flush_interval=60)
+    backend.upload(io.BytesIO(b'A lovely park'), 'Park.txt', 'fake_author')
+    backend.upload(io.BytesIO(b'A lovely lake'), 'Lake.txt', 'fake_author')
+    update_many = backend.catalog.update_many
+
+    backend.vote('upvote', 'user1', 'Park.txt')
+    with patch.object(backend.catalog,
+                      'update_many',
+                      side_effect=PreconditionFailed('catalog changed')):
+        backend.votes.flush()
+
+    # The vote was written and is listed even though the catalog could not be written.
+    assert backend.get_wiki_page('Park.txt')['upvotes'] == 1
+    assert backend.get_all_page_names() == [['Lake', 0, 0], ['Park', 1, 0]]
+    assert [row['upvotes'] for row in backend.catalog.rows()] == [0, 0]
+
+    # Its count is written to the catalog along with the next votes.
+    backend.vote('upvote', 'user1', 'Lake.txt')
+    with patch.object(backend.catalog, 'update_many',
+                      wraps=update_many) as mock_update:
+        backend.votes.flush()
+    mock_update.assert_called_once_with({
+        'Park': {
+            'upvotes': 1,
+            'downvotes': 0
+        },
+        'Lake': {
+            'upvotes': 1,
+            'downvotes': 0
+        }
+    })
+    assert backend.get_all_page_names() == [['Lake', 1, 0], ['Park', 1, 0]]